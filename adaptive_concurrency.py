@@ -0,0 +1,224 @@
+"""
+Adaptive Concurrency
+An AIMD controller for how much work is in flight at the model server at once.
+A request's weight is its prompt tokens in units of token_unit (at least 1), so
+one long Instagram thread holds the room of several short comments, and a
+request is admitted once the weights in flight leave room for it under the
+limit. The limit moves once per epoch of about limit requests, climbing
+towards the server's throughput knee: it goes up by one while requests are
+waiting for room, and keeps going down by one while that costs no tokens per
+second. A step up that doesn't raise tokens per second, or a step down that
+lowers them, is taken back and the limit holds for a few epochs before probing
+again. It is cut by a factor when the error or timeout rate passes
+error_threshold or latency per unit of weight grows past latency_tolerance
+times its recent baseline.
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from statistics import median
+from typing import Callable, Optional
+
+
+class Outcome:
+    """Set tokens inside AdaptiveLimiter.admit() to the tokens the server processed; cached answers leave it at 0."""
+
+    def __init__(self):
+        self.tokens = 0
+        self.started = time.monotonic()
+
+    def start(self) -> None:
+        """Restart the latency clock when the request is actually sent, so waiting for an endpoint isn't latency."""
+        self.started = time.monotonic()
+
+
+def processed_tokens(usage) -> int:
+    """The prompt tokens the server didn't have cached plus the completion tokens, from a response's usage."""
+    if usage is None:
+        return 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+    return max((usage.prompt_tokens or 0) - cached, 0) + (usage.completion_tokens or 0)
+
+
+def is_timeout(error: BaseException) -> bool:
+    return isinstance(error, (TimeoutError, asyncio.TimeoutError)) or "Timeout" in type(error).__name__
+
+
+class AdaptiveLimiter:
+    def __init__(self, initial: float, min_limit: float = 1.0, max_limit: Optional[float] = None,
+                 token_unit: int = 500, latency_tolerance: float = 2.0, error_threshold: float = 0.1,
+                 decrease: float = 0.7, min_gain: float = 0.05, probe_every: int = 5, min_epoch: int = 4,
+                 log: Optional[Callable[[str], None]] = None):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit or 2 * initial, min_limit)
+        self.limit = min(max(float(initial), min_limit), self.max_limit)
+        self.token_unit = token_unit
+        self.latency_tolerance = latency_tolerance
+        self.error_threshold = error_threshold
+        self.decrease = decrease
+        self.min_gain = min_gain
+        self.probe_every = probe_every
+        self.min_epoch = min_epoch
+        self.log = log
+
+        self.in_flight = 0.0
+        self.requests_in_flight = 0
+        self.waiters = deque()
+        # seconds per unit of weight of recent requests, for the latency baseline
+        self.unit_latencies = deque(maxlen=200)
+        self.throughput = 0.0
+        # +1 or -1 for the step the last epoch took, 0 if it held
+        self.last_step = 0
+        self.hold = 0
+        self.changes = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.new_epoch()
+
+    def weight(self, prompt_tokens: int) -> float:
+        return max(1.0, prompt_tokens / self.token_unit)
+
+    def can_admit(self, weight: float) -> bool:
+        # a request heavier than the whole limit still runs, on its own
+        return self.requests_in_flight == 0 or self.in_flight + weight <= self.limit + 1e-9
+
+    def take(self, weight: float) -> None:
+        self.in_flight += weight
+        self.requests_in_flight += 1
+
+    async def acquire(self, prompt_tokens: int) -> float:
+        """Wait for room for a request of prompt_tokens, first come first served, and return its weight."""
+        weight = self.weight(prompt_tokens)
+        if not self.waiters and self.can_admit(weight):
+            self.take(weight)
+            return weight
+        self.saturated = True
+        future = asyncio.get_running_loop().create_future()
+        entry = (weight, future)
+        self.waiters.append(entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                if entry in self.waiters:
+                    self.waiters.remove(entry)
+                self.wake()
+            else:
+                # admitted just as we were cancelled
+                self.release(weight)
+            raise
+        return weight
+
+    def release(self, weight: float) -> None:
+        self.in_flight = max(self.in_flight - weight, 0.0)
+        self.requests_in_flight -= 1
+        self.wake()
+
+    def wake(self) -> None:
+        while self.waiters:
+            weight, future = self.waiters[0]
+            if future.done():
+                self.waiters.popleft()
+                continue
+            if not self.can_admit(weight):
+                break
+            self.waiters.popleft()
+            self.take(weight)
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def admit(self, prompt_tokens: int):
+        """Hold room for one request while the body runs, and learn from how it went."""
+        weight = await self.acquire(prompt_tokens)
+        outcome = Outcome()
+        try:
+            yield outcome
+        except asyncio.CancelledError:
+            self.release(weight)
+            raise
+        except Exception as e:
+            self.release(weight)
+            self.record_error(is_timeout(e))
+            raise
+        self.release(weight)
+        if outcome.tokens:
+            self.record(weight, time.monotonic() - outcome.started, outcome.tokens)
+
+    def new_epoch(self) -> None:
+        self.epoch_started = time.monotonic()
+        self.epoch_done = 0
+        self.epoch_errors = 0
+        self.epoch_tokens = 0
+        self.epoch_latencies = []
+        self.saturated = bool(self.waiters)
+
+    def record(self, weight: float, latency: float, tokens: int) -> None:
+        self.unit_latencies.append(latency / weight)
+        self.epoch_latencies.append(latency / weight)
+        self.epoch_done += 1
+        self.epoch_tokens += tokens
+        self.maybe_adjust()
+
+    def record_error(self, timeout: bool = False) -> None:
+        self.errors += 1
+        self.timeouts += timeout
+        self.epoch_errors += 1
+        self.maybe_adjust()
+
+    def baseline(self) -> float:
+        # a low percentile rather than the minimum, so one lucky request doesn't set it
+        latencies = sorted(self.unit_latencies)
+        return latencies[len(latencies) // 10] if latencies else 0.0
+
+    def set_limit(self, limit: float, reason: str) -> None:
+        limit = min(max(limit, self.min_limit), self.max_limit)
+        if limit != self.limit:
+            if self.log is not None:
+                self.log(f"Concurrency limit {self.limit:.1f} -> {limit:.1f} ({reason})")
+            self.limit = limit
+            self.changes += 1
+            self.wake()
+
+    def maybe_adjust(self) -> None:
+        finished = self.epoch_done + self.epoch_errors
+        if finished < max(self.limit, self.min_epoch):
+            return
+        throughput = self.epoch_tokens / max(time.monotonic() - self.epoch_started, 1e-6)
+        error_rate = self.epoch_errors / finished
+        baseline = self.baseline()
+        latency_ratio = median(self.epoch_latencies) / baseline if self.epoch_latencies and baseline else 1.0
+        before = self.limit
+        step = 0
+        if error_rate > self.error_threshold:
+            self.set_limit(self.limit * self.decrease, f"{error_rate:.0%} errors or timeouts")
+            self.hold = self.probe_every
+        elif latency_ratio > self.latency_tolerance:
+            # queueing at the server; keep stepping down while throughput holds
+            self.set_limit(self.limit * self.decrease, f"latency {latency_ratio:.1f}x the baseline")
+            step = -1
+        elif self.last_step > 0 and throughput < self.throughput * (1 + self.min_gain):
+            self.set_limit(self.limit - 1, f"{throughput:.0f} tokens/s, no gain from the last step up")
+            self.hold = self.probe_every
+        elif self.last_step < 0 and throughput < self.throughput * (1 - self.min_gain):
+            self.set_limit(self.limit + 1, f"{throughput:.0f} tokens/s, down from the last step down")
+            self.hold = self.probe_every
+        elif self.last_step < 0 and self.saturated:
+            # the requests that went still didn't cost throughput, so we may still be above the knee
+            self.set_limit(self.limit - 1, f"{throughput:.0f} tokens/s with fewer requests in flight")
+            step = -1
+        elif self.hold:
+            # stay put for a few epochs before probing above the knee again
+            self.hold -= 1
+        elif self.saturated:
+            self.set_limit(self.limit + 1, f"{throughput:.0f} tokens/s, requests waiting")
+            step = 1
+        self.last_step = step if self.limit != before else 0
+        self.throughput = throughput
+        self.new_epoch()
+
+    def summary(self) -> str:
+        return (f"Concurrency limit {self.limit:.1f} (between {self.min_limit:g} and {self.max_limit:g}), "
+                f"{self.changes} changes, {self.errors} errors, {self.timeouts} timeouts")
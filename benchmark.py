@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Pipeline Benchmark
+Measures the pipeline end to end without LM Studio. Synthetic exports are
+generated (synthetic_exports.py), parsed into records, chunked, voted on by the
+like voter against the mock server (mock_llm_server.py) and tallied in a
+results store. Each stage runs in its own process, so its wall time and peak
+RSS are its own, and the report gives comments per second for every stage and
+prompt tokens per comment for the LLM stage. Results are saved as JSON with the
+git commit they were measured at, and --compare prints the change from an
+earlier result file.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+from typing import Dict, List, Optional
+
+REPO = Path(__file__).resolve().parent
+STAGES = ["generate", "parse", "chunk", "llm", "tally"]
+
+
+def peak_rss_mb(rusage) -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_process(command: List[str], cwd: Path, log_path: Path) -> Dict:
+    """Run a stage's process and return its wall time and peak RSS (including its worker processes)."""
+    started = time.perf_counter()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(REPO), os.environ.get("PYTHONPATH")])))
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed with exit code {process.returncode}, see {log_path}")
+    return {"seconds": time.perf_counter() - started, "peak_rss_mb": peak_rss_mb(rusage)}
+
+
+def stage_generate(workdir: Path, settings: Dict) -> Dict:
+    from synthetic_exports import write_instagram_export, write_tiktok_export
+
+    exports = workdir / "exports"
+    exports.mkdir(parents=True, exist_ok=True)
+    write_tiktok_export(str(exports / "tiktok.md"), settings["comments"], settings["seed"])
+    write_instagram_export(str(exports / "instagram.md"), settings["comments"], settings["seed"] + 1)
+    return {"items": settings["comments"] * 2,
+            "bytes": sum(path.stat().st_size for path in exports.iterdir())}
+
+
+def stage_parse(workdir: Path, settings: Dict) -> Dict:
+    from parse_comments import parse_exports
+
+    records = workdir / "records"
+    shutil.rmtree(records, ignore_errors=True)
+    paths = sorted(str(path) for path in (workdir / "exports").iterdir())
+    counts = parse_exports(paths, str(records), workers=settings["workers"])
+    return {"items": sum(counts.values()), "per_platform": counts}
+
+
+def stage_chunk(workdir: Path, settings: Dict) -> Dict:
+    import tiktoken
+
+    from comment_chunking import TokenCounter
+    from comment_records import iter_records, record_text
+
+    count_tokens = TokenCounter(tiktoken.encoding_for_model("gpt-4o"))
+    records = chunks = tokens = 0
+    for record in iter_records(str(workdir / "records")):
+        text = record_text(record)
+        pieces = count_tokens.chunks(text, settings["max_comment_tokens"], settings["chunk_overlap_tokens"])
+        records += 1
+        chunks += len(pieces)
+        tokens += count_tokens(text)
+    return {"items": records, "chunks": chunks, "tokens_per_comment": tokens / records if records else 0.0}
+
+
+def stage_tally(workdir: Path, settings: Dict) -> Dict:
+    from results_store import LIKE_WEIGHTED_TALLY, ResultsStore
+
+    llm = workdir / "llm"
+    db = workdir / "tally.db"
+    for path in db.parent.glob(db.name + "*"):
+        path.unlink()
+    store = ResultsStore(str(db))
+    store.import_json(str(llm / "like_weighted_complaints.json"), str(llm / "comments_to_complaints.json"),
+                      LIKE_WEIGHTED_TALLY, "all")
+    tally = store.tally(LIKE_WEIGHTED_TALLY)
+    comments = len(store.comments_to_complaints(LIKE_WEIGHTED_TALLY))
+    store.close()
+    return {"items": comments, "complaints": len(tally)}
+
+
+def prepare_llm_stage(workdir: Path, settings: Dict) -> int:
+    """Set up a working directory for the like voter with a sample of the parsed comments."""
+    from comment_records import iter_records, record_text
+
+    llm = workdir / "llm"
+    shutil.rmtree(llm, ignore_errors=True)
+    written = 0
+    for platform in ("tiktok", "instagram"):
+        folder = llm / "comments" / platform
+        folder.mkdir(parents=True)
+        for i, record in enumerate(iter_records(str(workdir / "records"), platform)):
+            if i >= settings["llm_comments"] // 2:
+                break
+            (folder / f"{i:07d}.txt").write_text(record_text(record), encoding="utf-8")
+            written += 1
+    (llm / "complaints.json").write_text("{}")
+    (llm / "comments_to_complaints.json").write_text("{}")
+    return written
+
+
+def server_stats(port: int) -> Dict[str, int]:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return json.load(response)
+
+
+def run_llm_stage(workdir: Path, settings: Dict) -> Dict:
+    from mock_llm_server import MockConfig, start_server
+
+    comments = prepare_llm_stage(workdir, settings)
+    config = MockConfig(latency=settings["latency"], tokens_per_second=settings["tps"],
+                        prompt_tokens_per_second=settings["prompt_tps"], think_tokens=settings["think_tokens"],
+                        error_rate=settings["error_rate"], slots=settings["slots"])
+    server = start_server(config, port=settings["port"])
+    # point the like voter at the mock, with as many requests in flight as it has slots
+    endpoint = f"http://127.0.0.1:{settings['port']}/v1,{settings['slots']}"
+    try:
+        result = run_process([sys.executable, str(REPO / "comment_like_voter_llm.py"), "--endpoint", endpoint],
+                             workdir / "llm", workdir / "llm.log")
+        stats = server_stats(settings["port"])
+    finally:
+        server.shutdown()
+        server.server_close()
+    if not stats.get("requests"):
+        raise RuntimeError(f"The like voter sent no requests to the mock server, see {workdir / 'llm.log'}")
+    with open(workdir / "llm" / "voter_metrics.json", "r") as f:
+        failed = json.load(f)["counters"].get("failed_comments", 0)
+    if failed:
+        raise RuntimeError(f"The like voter failed on {failed} comments, see {workdir / 'llm.log'}")
+    result.update({
+        "items": comments,
+        "requests": stats.get("requests", 0),
+        "errors": stats.get("errors", 0),
+        "prompt_tokens_per_comment": stats.get("prompt_tokens", 0) / comments if comments else 0.0,
+        "cached_prompt_share": stats.get("cached_prompt_tokens", 0) / max(stats.get("prompt_tokens", 0), 1),
+        "completion_tokens_per_comment": stats.get("completion_tokens", 0) / comments if comments else 0.0,
+    })
+    return result
+
+
+STAGE_FUNCTIONS = {"generate": stage_generate, "parse": stage_parse, "chunk": stage_chunk, "tally": stage_tally}
+
+
+def run_stage(name: str, workdir: Path, settings: Dict) -> Dict:
+    if name == "llm":
+        return run_llm_stage(workdir, settings)
+    result_path = workdir / f"{name}.json"
+    result = run_process([sys.executable, str(Path(__file__).resolve()), "--stage", name, "--workdir", str(workdir)],
+                         REPO, workdir / f"{name}.log")
+    with open(result_path, "r") as f:
+        result.update(json.load(f))
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def format_report(results: Dict, previous: Optional[Dict] = None) -> str:
+    lines = [f"{'stage':<10}{'wall s':>10}{'peak MB':>10}{'comments':>11}{'comments/s':>12}"
+             + ("   vs previous" if previous else "")]
+    for name, stage in results["stages"].items():
+        rate = stage["items"] / stage["seconds"] if stage["seconds"] else 0.0
+        line = f"{name:<10}{stage['seconds']:>10.2f}{stage['peak_rss_mb']:>10.0f}{stage['items']:>11}{rate:>12.0f}"
+        before = (previous or {}).get("stages", {}).get(name)
+        if before and before.get("seconds"):
+            line += f"   {stage['seconds'] / before['seconds']:.2f}x time, {stage['peak_rss_mb'] - before['peak_rss_mb']:+.0f} MB"
+        lines.append(line)
+    llm = results["stages"].get("llm")
+    if llm:
+        lines.append(f"LLM: {llm['requests']} requests ({llm['errors']} errors), "
+                     f"{llm['prompt_tokens_per_comment']:.0f} prompt tokens and "
+                     f"{llm['completion_tokens_per_comment']:.0f} completion tokens per comment, "
+                     f"{100 * llm.get('cached_prompt_share', 0):.0f}% of prompt tokens from the prefix cache")
+    chunk = results["stages"].get("chunk")
+    if chunk:
+        lines.append(f"Chunking: {chunk['chunks']} chunks from {chunk['items']} comments, "
+                     f"{chunk['tokens_per_comment']:.0f} tokens per comment")
+    return "\n".join(lines)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the comment pipeline against a mock LLM server")
+    parser.add_argument("--comments", type=int, default=10000, help="comments per synthetic export")
+    parser.add_argument("--llm-comments", type=int, default=1000, help="comments sent to the like voter")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma-separated stages to run")
+    parser.add_argument("--workdir", default="benchmark_work")
+    parser.add_argument("--workers", type=int, help="parser processes (default: one per CPU)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-comment-tokens", type=int, default=4096)
+    parser.add_argument("--chunk-overlap-tokens", type=int, default=200)
+    parser.add_argument("--port", type=int, default=1234, help="port for the mock server")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--tps", type=float, default=200.0, help="mock answer tokens per second")
+    parser.add_argument("--prompt-tps", type=float, default=5000.0, help="mock prompt tokens per second")
+    parser.add_argument("--think-tokens", type=int, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--slots", type=int, default=4)
+    parser.add_argument("--output", default="benchmark_results.json", help="where to save the results")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    workdir = Path(args.workdir).resolve()
+    settings_path = workdir / "settings.json"
+    if args.stage:
+        # running one stage in its own process for the driver below
+        with open(settings_path, "r") as f:
+            settings = json.load(f)
+        result = STAGE_FUNCTIONS[args.stage](workdir, settings)
+        with open(workdir / f"{args.stage}.json", "w") as f:
+            json.dump(result, f)
+        return
+
+    settings = {key: value for key, value in vars(args).items()
+                if key not in ("stage", "compare", "output", "stages", "workdir")}
+    workdir.mkdir(parents=True, exist_ok=True)
+    with open(settings_path, "w") as f:
+        json.dump(settings, f)
+    results = {"commit": git_commit(), "time": time.strftime("%Y-%m-%d %H:%M:%S"), "settings": settings, "stages": {}}
+    for name in args.stages.split(","):
+        print(f"Running {name}...")
+        results["stages"][name] = run_stage(name, workdir, settings)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            previous = json.load(f)
+    print(format_report(results, previous))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
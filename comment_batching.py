@@ -0,0 +1,50 @@
+"""
+Comment Batching
+Packs several short comments into a single LLM request so the complaints list
+at the top of the prompt is paid for once per batch instead of once per comment.
+Each comment gets a numeric id that the model echoes back in its tool calls.
+"""
+
+from typing import Callable, Dict, Iterable, Iterator, List
+
+
+def pack_batches(comments: Iterable[str], count_tokens: Callable[[str], int],
+                 max_tokens: int = 3000, max_comments: int = 10) -> Iterator[List[str]]:
+    """Group comments into batches of at most max_comments whose token total fits max_tokens.
+
+    A comment that is over the budget on its own is yielded as a batch of one,
+    so callers can send it through their single-comment path.
+    """
+    batch = []
+    batch_tokens = 0
+    for comment in comments:
+        tokens = count_tokens(comment)
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_comments):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(comment)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def format_batch(comments: List[str]) -> str:
+    """Render a batch as numbered comment blocks the model can refer to by id."""
+    return "\n\n".join(
+        f'<comment id="{comment_id}">\n{comment}\n</comment>'
+        for comment_id, comment in enumerate(comments, 1)
+    )
+
+
+def group_by_comment_id(calls: Iterable[Dict], batch_size: int) -> Dict[int, List[Dict]]:
+    """Group tool call arguments by their comment_id (1-based), dropping ids outside the batch."""
+    grouped = {comment_id: [] for comment_id in range(1, batch_size + 1)}
+    for args in calls:
+        try:
+            comment_id = int(args.get("comment_id"))
+        except (TypeError, ValueError):
+            continue
+        if comment_id in grouped:
+            grouped[comment_id].append(args)
+    return grouped
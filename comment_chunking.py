@@ -0,0 +1,78 @@
+"""
+Comment Chunking
+Splits comments that are too long for one request into token-sized chunks.
+Each text is encoded once; the token array is cut into windows of at most
+max_tokens that end on an Instagram "--- Comment i ---" separator, a paragraph
+or a sentence where possible, and consecutive windows overlap by a few
+sentences so a complaint that straddles a cut is still seen whole.
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from typing import Dict, List
+
+# positions where a new piece of text starts, best first
+COMMENT_BOUNDARY = re.compile(r'^(?=--- Comment \d+ ---$)', re.MULTILINE)
+SENTENCE_BOUNDARY = re.compile(r'\n\s*\n|(?<=[.!?])\s+')
+
+
+class TokenCounter:
+    """Counts and chunks texts with a tiktoken encoding, remembering each text's token count."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.counts: Dict[str, int] = {}
+
+    def __call__(self, text: str) -> int:
+        count = self.counts.get(text)
+        if count is None:
+            count = self.counts[text] = len(self.encoding.encode(text))
+        return count
+
+    def chunks(self, text: str, max_tokens: int = 4096, overlap: int = 200) -> List[str]:
+        """Split text into chunks of at most max_tokens tokens; short texts come back whole."""
+        if self.counts.get(text, max_tokens + 1) <= max_tokens:
+            return [text]
+        tokens = self.encoding.encode(text)
+        self.counts[text] = len(tokens)
+        if len(tokens) <= max_tokens:
+            return [text]
+        # character offset where each token starts, to map boundaries to token indices and back
+        _, offsets = self.encoding.decode_with_offsets(tokens)
+        comment_starts = _token_starts(COMMENT_BOUNDARY, text, offsets)
+        sentence_starts = _token_starts(SENTENCE_BOUNDARY, text, offsets)
+        chunks = []
+        start = 0
+        while True:
+            limit = start + max_tokens
+            if limit >= len(tokens):
+                chunks.append(text[offsets[start]:])
+                return chunks
+            # cut at the last comment boundary in the back half of the window, else the last sentence boundary
+            end = (_last_between(comment_starts, start + max_tokens // 2, limit)
+                   or _last_between(sentence_starts, start + max_tokens // 2, limit)
+                   or limit)
+            chunks.append(text[offsets[start]:offsets[end]])
+            # start the next chunk on a boundary inside the overlap
+            next_start = end - min(overlap, max_tokens // 4)
+            next_start = (_first_between(comment_starts, next_start, end)
+                          or _first_between(sentence_starts, next_start, end)
+                          or next_start)
+            start = max(next_start, start + 1)
+
+
+def _token_starts(pattern: re.Pattern, text: str, offsets: List[int]) -> List[int]:
+    """Index of the token each match end falls in, since tokens usually carry their leading whitespace."""
+    return sorted({bisect_right(offsets, match.end()) - 1 for match in pattern.finditer(text)})
+
+
+def _last_between(positions: List[int], low: int, high: int) -> int:
+    """Largest position in (low, high], or 0 if there is none."""
+    i = bisect_left(positions, high + 1)
+    return positions[i - 1] if i and positions[i - 1] > low else 0
+
+
+def _first_between(positions: List[int], low: int, high: int) -> int:
+    """Smallest position in [low, high), or 0 if there is none."""
+    i = bisect_left(positions, low)
+    return positions[i] if i < len(positions) and positions[i] < high else 0
@@ -0,0 +1,112 @@
+"""
+Comment Digest
+Stable digests of normalized comment text, and an on-disk index of the comments
+that have already been processed. The digest ignores the username, timestamp and
+raw-text sections of the parsed comment files, markdown links and whitespace, so
+the same comment reposted on TikTok and Instagram gets the same digest and can
+be counted again without another LLM call.
+"""
+
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from vote_journal import comment_id
+
+# the Content: section runs to the Raw Text: section in comment files, or to the end in record texts
+CONTENT_SECTION = re.compile(r'^Content:\n(.*?)\n(?:\nRaw Text:|\Z)', re.MULTILINE | re.DOTALL)
+MARKDOWN_IMAGE = re.compile(r'!\[[^\]]*\]\([^)]*\)')
+MARKDOWN_LINK = re.compile(r'\[([^\]]*)\]\([^)]*\)')
+MARKDOWN_NOISE = re.compile(r'[*_~`#>|]+')
+WHITESPACE = re.compile(r'\s+')
+
+
+def comment_body(text: str) -> str:
+    """Return the Content: sections of a parsed comment or thread file or record text, or the text itself."""
+    sections = CONTENT_SECTION.findall(text)
+    return "\n".join(sections) if sections else text
+
+
+def normalize_comment(text: str) -> str:
+    """Lowercase the comment body with markdown, links and extra whitespace removed."""
+    text = comment_body(text)
+    text = MARKDOWN_IMAGE.sub(" ", text)
+    text = MARKDOWN_LINK.sub(r"\1", text)
+    text = MARKDOWN_NOISE.sub(" ", text)
+    return WHITESPACE.sub(" ", text).strip().lower()
+
+
+def comment_digest(text: str) -> str:
+    """Digest of the normalized comment, shared by reposts of the same text."""
+    return hashlib.blake2b(normalize_comment(text).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def comment_ref(text: str) -> str:
+    """A short reference to a comment for logs, instead of its full text."""
+    return f"comment {comment_digest(text)[:12]} ({len(text)} chars)"
+
+
+class ProcessedIndex:
+    """Digests of processed comments and the complaints found in them.
+
+    Stored as one line per comment, '<digest> <comment id> <complaints json>',
+    where the comment id is the exact-text id used by the vote journal. New
+    entries are kept in memory until flush() appends them to the file.
+    """
+
+    def __init__(self, path: str = "processed_comments.idx"):
+        self.path = Path(path)
+        self.complaints: Dict[str, str] = {}
+        self.comment_ids = set()
+        self.pending: List[str] = []
+        if self.path.exists():
+            self.load()
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self.complaints
+
+    def __len__(self) -> int:
+        return len(self.comment_ids)
+
+    def load(self) -> None:
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split(" ", 2)
+                if len(parts) != 3:
+                    continue  # torn final line from a crash
+                digest, exact_id, complaints = parts
+                # the complaints stay as JSON text until get() needs them
+                self.complaints.setdefault(digest, complaints)
+                self.comment_ids.add(exact_id)
+
+    def get(self, digest: str) -> Optional[List[str]]:
+        """Complaints found in the first processed comment with this digest."""
+        complaints = self.complaints.get(digest)
+        return json.loads(complaints) if complaints is not None else None
+
+    def has_comment(self, comment: str) -> bool:
+        """Whether this exact comment text has been processed."""
+        return comment_id(comment) in self.comment_ids
+
+    def add(self, comment: str, complaints: List[str], digest: Optional[str] = None) -> None:
+        exact_id = comment_id(comment)
+        if exact_id in self.comment_ids:
+            return
+        digest = digest or comment_digest(comment)
+        encoded = json.dumps(complaints)
+        self.complaints.setdefault(digest, encoded)
+        self.comment_ids.add(exact_id)
+        self.pending.append(f"{digest} {exact_id} {encoded}\n")
+
+    def flush(self) -> None:
+        """Append the entries added since the last flush and fsync them."""
+        if not self.pending:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(self.pending)
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
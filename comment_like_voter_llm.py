@@ -1,144 +1,1185 @@
+"""
+Like-Weighted Complaint Voter
+Asks the local model which complaints each comment makes and gives each of them
+the comment's like count as votes. LikeVoter can be imported without side
+effects: the tokenizer, the OpenAI client, the stores and the checkpoint are
+only loaded when something needs them, so --stats, --dry-run and resumed runs
+get to their first useful work without waiting on tiktoken or the client.
+"""
+
 import os
 import json
+import asyncio
 import logging
-from openai import OpenAI
-import tiktoken
-
-# Setup logging
-logging.basicConfig(
-    filename='comment_like_voter_llm.log',
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s %(message)s'
-)
+import time
+import traceback
+from pathlib import Path
+from collections import deque
+from functools import cached_property
+from comment_batching import pack_batches, format_batch, group_by_comment_id
+from comment_chunking import TokenCounter
+from vote_journal import VoteJournal, write_json_atomic
+from results_store import ResultsStore, LIKE_WEIGHTED_TALLY
+from comment_digest import ProcessedIndex, comment_digest, comment_ref
+from like_counts import like_votes, likes_to_votes
+from llm_cache import ResponseCache, cache_key
+from comment_records import iter_records, record_text
+from pipeline_metrics import Metrics, Profiler
+from prompt_builder import ComplaintCatalog, PromptBuilder
+from adaptive_concurrency import AdaptiveLimiter, processed_tokens
+from structured_output import (INSTRUCTIONS as STRUCTURED_INSTRUCTIONS, BATCH_INSTRUCTIONS as STRUCTURED_BATCH_INSTRUCTIONS,
+                               InvalidOutput, parse_answer, parse_batch_answer, repair_messages, response_format)
+
 logger = logging.getLogger(__name__)
 
-# Tokenizer for token counting
-encoding = tiktoken.encoding_for_model("gpt-4o")
-def count_tokens(text):
-    return len(encoding.encode(text))
+# Defaults for the command line options below; LikeVoter takes the same names as keyword arguments.
+
+MODEL = "qwq-32b-mlx"
+
+# Comments longer than max_comment_tokens are split on comment and sentence
+# boundaries into chunks that overlap by chunk_overlap_tokens
+max_comment_tokens = 4096
+chunk_overlap_tokens = 200
+
+# LM Studio / llama.cpp servers as (base_url, concurrency) pairs; requests go to
+# the server with the fewest in-flight requests for its concurrency, and move to
+# another server if one fails (match concurrency to each server's parallel slots)
+llm_endpoints = [("http://127.0.0.1:1234/v1", 4)]
+
+# Processing mode: with use_async the servers get up to max_concurrent_requests
+# comments at once, by default (None) the total of their concurrencies.
+# Set use_async = False to fall back to one request at a time.
+use_async = True
+max_concurrent_requests = None
+
+# With adaptive_concurrency that is only where the limit starts: it moves with the
+# servers' tokens per second, latency and error rate (see adaptive_concurrency.py),
+# up to max_adaptive_requests (None for twice the endpoints' total concurrency).
+# Requests are weighed by their comment tokens in units of request_token_unit, so
+# a long thread takes the room of several short comments.
+adaptive_concurrency = True
+max_adaptive_requests = None
+request_token_unit = 500
+
+# Batch mode packs several short comments into one request so the complaints
+# list is sent once per batch rather than once per comment.
+batch_mode = False
+max_batch_comments = 10
+max_batch_tokens = 3000
+
+# Retrieval shows the model only the retrieval_k existing complaints most similar
+# to each comment instead of the whole list. Needs an embedding model loaded in LM Studio.
+use_retrieval = False
+retrieval_k = 30
+embedding_model = "text-embedding-nomic-embed-text-v1.5"
+
+# Votes are appended to vote_journal.jsonl (fsynced every journal_fsync_every
+# comments) and folded into the snapshot files every compact_every comments.
+journal_fsync_every = 50
+compact_every = 1000
 
-# Connect to LM Studio
-client = OpenAI(base_url="http://127.0.0.1:1234/v1", api_key="lm-studio")
+# Near-duplicate clustering sends one comment per cluster of copy-pasted or
+# near-identical comments to the model and counts its complaints for the rest
+cluster_near_duplicates = False
+near_duplicate_threshold = 0.8
 
-# Tool function to record votes
-def record_vote(complaint: str, votes: int):
-    logger.info(f"Recording {votes} votes for complaint: {complaint}")
-    global complaints
-    complaints[complaint] = complaints.get(complaint, 0) + votes
-    with open("like_weighted_complaints.json", "w") as f:
-        json.dump(complaints, f, indent=2)
+# Structured output asks for a JSON answer through the request's response_format
+# (see structured_output.py) instead of a tool call, so the server's grammar keeps
+# the reply to the schema. A comment whose reply is missing or doesn't validate
+# is asked again on its own, up to max_repairs times, in either mode.
+structured_output = False
+max_repairs = 1
+
+# Responses are cached on disk by model, prompt template, comment and candidate
+# complaints, so re-runs don't ask the model again. Bump PROMPT_TEMPLATE_VERSION
+# when the prompt wording changes. Set response_cache_path = None to disable.
+PROMPT_TEMPLATE_VERSION = "2"
+response_cache_path = "llm_response_cache.db"
+response_cache_max_mb = 512
+
+# Complaints merged by complaint_merge.py are recorded under the complaint they were merged into
+aliases_path = "complaint_aliases.json"
+
+# Also record comments and votes in this SQLite results store (None to skip)
+results_db = None  # e.g. "comment_reader.db"
+
+# With queue_path set, comments go into this SQLite work queue (see work_queue.py)
+# and the tally is kept there, so several voter processes, on this host or on
+# others sharing the filesystem, can work through the same comments at once.
+# A comment whose worker stops for lease_seconds goes to another worker; a failed
+# one is retried after backoff_seconds, doubling each time, and quarantined after
+# max_attempts attempts. Set queue_path = None for the journal and checkpoint files.
+queue_path = None  # e.g. "work_queue.db"
+lease_seconds = 900
+max_attempts = 5
+backoff_seconds = 30
+
+# Timers and counters for each stage are logged every metrics_report_every
+# seconds and written to metrics_path at the end (Prometheus text if it ends
+# in .prom, JSON otherwise). Set profile_mode to "cprofile" or "tracemalloc"
+# to profile the whole run into voter_profile.*.
+metrics_report_every = 60
+metrics_path = "voter_metrics.json"
+profile_mode = None
+
+# Comment folders
+tiktok_folder = "comments/tiktok"
+instagram_folder = "comments/instagram"
+
+# Read comments from the parsers' JSONL records in this directory instead of
+# the comment folders (see comment_records.py)
+records_dir = None  # e.g. "parsed_comments"
+# Only read the record shards whose names start with this, e.g. "ingest-20240101-120000"
+# for the new comments from one incremental_ingest.py run
+records_prefix = ""
+
+# Register tool for LLM. The model only says which complaints a comment makes;
+# the votes come from the comment's like count.
+complaint_properties = {
+    "complaint_ids": {
+        "type": "array",
+        "items": {"type": "integer"},
+        "description": "The ids of the existing complaints the comment makes"
+    },
+    "new_complaints": {
+        "type": "array",
+        "items": {"type": "string"},
+        "description": "Normalized complaints the comment makes that aren't in the list yet"
+    }
+}
 
-# Register tool for LLM
 tools = [
     {
         "type": "function",
         "function": {
-            "name": "record_vote",
-            "description": "Records a number of votes for a complaint",
+            "name": "record_complaints",
+            "description": "Records the complaints made in the comment",
+            "parameters": {
+                "type": "object",
+                "properties": complaint_properties,
+                "required": ["complaint_ids", "new_complaints"]
+            }
+        }
+    }
+]
+
+# Batch prompts use the same tool with the id of the comment the complaints are from
+batch_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "record_complaints",
+            "description": "Records the complaints made in one of the comments",
             "parameters": {
                 "type": "object",
                 "properties": {
-                    "complaint": {
-                        "type": "string",
-                        "description": "The normalized complaint"
-                    },
-                    "votes": {
+                    "comment_id": {
                         "type": "integer",
-                        "description": "Number of votes (likes) to record"
-                    }
+                        "description": "The id of the comment the complaints come from"
+                    },
+                    **complaint_properties
                 },
-                "required": ["complaint", "votes"]
+                "required": ["comment_id", "complaint_ids", "new_complaints"]
             }
         }
     }
 ]
 
-# Load complaints
-with open("complaints.json", "r") as f:
-    complaints = json.load(f)
 
-# Comment folders
-tiktok_folder = "comments/tiktok"
-instagram_folder = "comments/instagram"
+# The prompt is laid out for the server's prompt cache (see prompt_builder.py): these
+# instructions and the complaint catalog make up a system message that only grows at
+# the end, and the user message holds just the comment(s).
+INSTRUCTIONS = """
+You normalize the complaints made in comments so they can be tallied. The user's message is a comment.
 
-platforms = [
-    ("tiktok", tiktok_folder),
-    ("instagram", instagram_folder)
-]
+1. Normalize the complaint(s) in the comment. Use the existing complaints list if possible. If not, add a new complaint.
+2. Call the record_complaints tool once, with the ids of the existing complaints the comment makes and any new complaints it makes that aren't in the list.
+3. If the comment doesn't make any complaint, call record_complaints with empty lists.
 
-with open("comments_to_complaints.json", "r") as f:
-    comments_to_complaints = json.load(f)
-
-
-for platform, folder in platforms:
-    logger.info(f"Processing {platform} comments from {folder}")
-    comments = []
-    for file in os.listdir(folder):
-        with open(os.path.join(folder, file), "r") as f:
-            comment = f.read()
-            ## is the comment longer than 4096 tokens?
-            if count_tokens(comment) > 4096:
-                ## chunk it into 4096 token chunks
-                chunks = [comment[i:i+4096] for i in range(0, len(comment), 4096)]
-                for chunk in chunks:
-                    comments.append(chunk)
-            else:
-                comments.append(comment)
-        
-                
-    logger.info(f"Loaded {len(comments)} comments from {platform}")
-
-    for comment in comments:
-        if comment in comments_to_complaints:
-            logger.info(f"Comment {comment} already processed")
-            continue
-        try:
-            
-            logger.info(f"Processing comment ({count_tokens(comment)} tokens)")
-            prompt = f"""
-            Here is a comment: "{comment}"
-
-            1. Normalize the complaint(s) in this comment. Use the existing complaints list below if possible. If not, add a new complaint.
-            2. If you can tell how many likes this comment has, use the record_vote tool to record that many votes for each normalized complaint you extract from the comment. If you can't tell, just record 1 vote per complaint.
-            2.5. If you can't tell how many likes this comment has, just record 1 vote per complaint.
-            3. Only use the record_vote tool for each complaint.
-            
-            The end goal is to have a vote tally of all the complaints in the list, where slight variations, different ways of saying the same thing, and other variations are all counted as the same complaint. If it's meaningfully different, add another complaint to the list.
-            The user will be using this vote tally to make a video about the complaints, so please make sure the complaints are as normalized as possible.
-
-            Complaints list (so far, you can add to this list):
-            {'\n- '.join(complaints.keys())}
-            """
-            response = client.chat.completions.create(
-                model="qwq-32b-mlx",
-                messages=[{"role": "user", "content": prompt}],
+The end goal is to have a vote tally of all the complaints in the list, where slight variations, different ways of saying the same thing, and other variations are all counted as the same complaint. If it's meaningfully different, add another complaint to the list.
+The user will be using this vote tally to make a video about the complaints, so please make sure the complaints are as normalized as possible.
+"""
+
+BATCH_INSTRUCTIONS = """
+You normalize the complaints made in comments so they can be tallied. The user's message holds several comments, each wrapped in a <comment id="..."> tag.
+
+For each comment separately:
+1. Normalize the complaint(s) in the comment. Use the existing complaints list if possible. If not, add a new complaint.
+2. Call the record_complaints tool once, with the comment's id as comment_id, the ids of the existing complaints the comment makes and any new complaints it makes that aren't in the list.
+3. Don't call the tool for a comment with no complaint.
+
+The end goal is to have a vote tally of all the complaints in the list, where slight variations, different ways of saying the same thing, and other variations are all counted as the same complaint. If it's meaningfully different, add another complaint to the list.
+The user will be using this vote tally to make a video about the complaints, so please make sure the complaints are as normalized as possible.
+"""
+
+CATALOG_HEADING = "Complaints list (so far, you can add to this list), as [id] complaint:"
+
+
+class LikeVoter:
+    """Votes on the comments of each platform and keeps the like-weighted tally.
+
+    Constructing one only stores its settings. The tokenizer, the endpoint pool
+    (and with it the OpenAI client), the journal, the stores and the caches are
+    created the first time they are used, and the tally is loaded by load().
+    """
+
+    def __init__(self, llm_endpoints=llm_endpoints, model=MODEL, use_async=use_async,
+                 max_concurrent_requests=max_concurrent_requests, adaptive_concurrency=adaptive_concurrency,
+                 max_adaptive_requests=max_adaptive_requests, request_token_unit=request_token_unit,
+                 batch_mode=batch_mode,
+                 max_batch_comments=max_batch_comments, max_batch_tokens=max_batch_tokens,
+                 max_comment_tokens=max_comment_tokens, chunk_overlap_tokens=chunk_overlap_tokens,
+                 use_retrieval=use_retrieval, retrieval_k=retrieval_k, embedding_model=embedding_model,
+                 journal_fsync_every=journal_fsync_every, compact_every=compact_every,
+                 cluster_near_duplicates=cluster_near_duplicates, near_duplicate_threshold=near_duplicate_threshold,
+                 structured_output=structured_output, max_repairs=max_repairs,
+                 response_cache_path=response_cache_path, response_cache_max_mb=response_cache_max_mb,
+                 aliases_path=aliases_path, results_db=results_db, queue_path=queue_path,
+                 lease_seconds=lease_seconds, max_attempts=max_attempts, backoff_seconds=backoff_seconds,
+                 tiktok_folder=tiktok_folder, instagram_folder=instagram_folder, records_dir=records_dir, records_prefix=records_prefix,
+                 metrics_report_every=metrics_report_every, metrics_path=metrics_path, profile_mode=profile_mode):
+        self.llm_endpoints = llm_endpoints
+        self.model = model
+        self.use_async = use_async
+        self.max_concurrent_requests = max_concurrent_requests
+        self.adaptive_concurrency = adaptive_concurrency
+        self.max_adaptive_requests = max_adaptive_requests
+        self.request_token_unit = request_token_unit
+        self.batch_mode = batch_mode
+        self.max_batch_comments = max_batch_comments
+        self.max_batch_tokens = max_batch_tokens
+        self.max_comment_tokens = max_comment_tokens
+        self.chunk_overlap_tokens = chunk_overlap_tokens
+        self.use_retrieval = use_retrieval
+        self.retrieval_k = retrieval_k
+        self.embedding_model = embedding_model
+        self.journal_fsync_every = journal_fsync_every
+        self.compact_every = compact_every
+        self.cluster_near_duplicates = cluster_near_duplicates
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.structured_output = structured_output
+        self.max_repairs = max_repairs
+        self.response_cache_path = response_cache_path
+        self.response_cache_max_mb = response_cache_max_mb
+        self.aliases_path = aliases_path
+        self.results_db = results_db
+        self.queue_path = queue_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.platforms = [("tiktok", tiktok_folder), ("instagram", instagram_folder)]
+        self.records_dir = records_dir
+        self.records_prefix = records_prefix
+        self.metrics_path = metrics_path
+        self.metrics = Metrics(metrics_report_every)
+        self.profiler = Profiler(profile_mode, "voter_profile")
+
+        self.complaints = {}
+        self.comments_to_complaints = {}
+        self.applied_like_updates = []
+        # Complaint ids shown in the prompt: positions in the tally, which only grows at the end
+        self.catalog = ComplaintCatalog()
+        if self.structured_output:
+            self.prompts = PromptBuilder(STRUCTURED_INSTRUCTIONS, self.catalog, CATALOG_HEADING)
+            self.batch_prompts = PromptBuilder(STRUCTURED_BATCH_INSTRUCTIONS, self.catalog, CATALOG_HEADING)
+        else:
+            self.prompts = PromptBuilder(INSTRUCTIONS, self.catalog, CATALOG_HEADING)
+            self.batch_prompts = PromptBuilder(BATCH_INSTRUCTIONS, self.catalog, CATALOG_HEADING)
+        # id of the last work queue complaint added to the catalog
+        self.catalog_synced = 0
+
+    @cached_property
+    def count_tokens(self):
+        # Tokenizer for token counting; each comment's count is remembered so it's only encoded once
+        import tiktoken
+        return TokenCounter(tiktoken.encoding_for_model("gpt-4o"))
+
+    @cached_property
+    def endpoints(self):
+        from endpoint_pool import EndpointPool
+        return EndpointPool(self.llm_endpoints)
+
+    @cached_property
+    def concurrency(self):
+        return self.max_concurrent_requests or self.endpoints.capacity
+
+    @cached_property
+    def limiter(self):
+        # Admission for the async requests, weighed by their comment tokens; the limit stays at
+        # concurrency unless adaptive_concurrency lets it follow the servers
+        if not self.use_async:
+            return AdaptiveLimiter(1, min_limit=1, max_limit=1, token_unit=self.request_token_unit)
+        if not self.adaptive_concurrency:
+            return AdaptiveLimiter(self.concurrency, min_limit=self.concurrency, max_limit=self.concurrency,
+                                   token_unit=self.request_token_unit)
+        max_limit = self.max_adaptive_requests or max(2 * self.endpoints.capacity, self.concurrency)
+        # the limiter alone decides what is in flight, so requests above the servers'
+        # concurrency reach them and the limiter sees what they do to latency
+        self.endpoints.cap_in_flight = False
+        return AdaptiveLimiter(self.concurrency, max_limit=max_limit, token_unit=self.request_token_unit,
+                               log=logger.info)
+
+    @cached_property
+    def window(self):
+        # Keep a few more requests queued than can be in flight so a slow comment
+        # at the head of the queue doesn't leave the server idle.
+        return int(self.limiter.max_limit) * 2
+
+    @cached_property
+    def aliases(self):
+        from complaint_merge import ComplaintAliases
+        return ComplaintAliases(self.aliases_path)
+
+    @cached_property
+    def journal(self):
+        return VoteJournal("vote_journal.jsonl", fsync_every=self.journal_fsync_every)
+
+    @cached_property
+    def store(self):
+        return ResultsStore(self.results_db) if self.results_db else None
+
+    @cached_property
+    def queue(self):
+        from work_queue import WorkQueue
+        return WorkQueue(self.queue_path, lease_seconds=self.lease_seconds, max_attempts=self.max_attempts,
+                         backoff_seconds=self.backoff_seconds)
+
+    @cached_property
+    def response_cache(self):
+        if not self.response_cache_path:
+            return None
+        return ResponseCache(self.response_cache_path, self.response_cache_max_mb * 1024 * 1024)
+
+    @cached_property
+    def processed_index(self):
+        # Digests of the processed comments, so re-runs and reposts are found without
+        # looking comment texts up in comments_to_complaints
+        return ProcessedIndex("processed_comments.idx")
+
+    @cached_property
+    def complaint_index(self):
+        # Embedding index of the complaints, saved next to complaints.json
+        if not self.use_retrieval:
+            return None
+        from complaint_index import ComplaintIndex, openai_embedder
+        index = ComplaintIndex(openai_embedder(self.endpoints, self.embedding_model), "complaint_index.npz",
+                               model=self.embedding_model)
+        index.add(self.complaints.keys())
+        return index
+
+    def load(self, update_index=True):
+        """Load the last checkpoint, or complaints.json on a fresh run, and replay the votes journaled since.
+
+        With update_index the processed index gets the comments it is missing,
+        as a resumed run needs; --stats leaves it alone. Returns how many
+        comments were replayed from the journal.
+        """
+        if os.path.exists("vote_checkpoint.json"):
+            with open("vote_checkpoint.json", "r") as f:
+                checkpoint = json.load(f)
+            self.complaints = checkpoint["complaints"]
+            self.comments_to_complaints = checkpoint["comments_to_complaints"]
+            self.applied_like_updates = checkpoint.get("applied_like_updates", [])
+            del checkpoint
+        else:
+            with open("complaints.json", "r") as f:
+                self.complaints = json.load(f)
+            with open("comments_to_complaints.json", "r") as f:
+                self.comments_to_complaints = json.load(f)
+            self.applied_like_updates = []
+
+        if update_index and not len(self.processed_index) and self.comments_to_complaints:
+            for comment, comment_complaints in self.comments_to_complaints.items():
+                self.processed_index.add(comment, comment_complaints)
+            self.processed_index.flush()
+
+        # Replay votes journaled since the last checkpoint
+        replayed = 0
+        for event in self.journal.replay():
+            if update_index:
+                self.processed_index.add(event["comment"], [complaint for complaint, _ in event["votes"]])
+            if event["comment"] in self.comments_to_complaints:
+                continue
+            for complaint, vote_count in event["votes"]:
+                self.complaints[complaint] = self.complaints.get(complaint, 0) + vote_count
+            self.comments_to_complaints[event["comment"]] = [complaint for complaint, _ in event["votes"]]
+            replayed += 1
+
+        self.catalog.extend(self.complaints)
+        return replayed
+
+    def compact(self):
+        """Fold the journal into the snapshot files and empty it.
+
+        vote_checkpoint.json is written first and holds everything needed to
+        resume. If we crash before the journal is emptied, replay skips the
+        comments the checkpoint already has, so no vote is counted twice, and
+        puts any entries processed_index hadn't flushed yet back into it.
+        """
+        with self.metrics.timer("disk_write"):
+            self.journal.flush()
+            write_json_atomic("vote_checkpoint.json", {
+                "complaints": self.complaints,
+                "comments_to_complaints": self.comments_to_complaints,
+                "applied_like_updates": self.applied_like_updates,
+            })
+            self.processed_index.flush()
+            if self.complaint_index is not None:
+                self.complaint_index.flush()
+            self.journal.truncate()
+            write_json_atomic("like_weighted_complaints.json", self.complaints, indent=2)
+            write_json_atomic("comments_to_complaints.json", self.comments_to_complaints, indent=2)
+        logger.info(f"Compacted vote journal ({len(self.comments_to_complaints)} comments)")
+
+    # Adds votes for a complaint to the tally
+    def record_vote(self, complaint: str, votes: int):
+        logger.info(f"Recording {votes} votes for complaint: {complaint}")
+        if complaint not in self.complaints:
+            if self.complaint_index is not None:
+                self.complaint_index.add([complaint])
+            self.catalog.add(complaint)
+        self.complaints[complaint] = self.complaints.get(complaint, 0) + votes
+
+    def read_comments(self, platform, folder):
+        """Yield the comment texts for a platform, streamed from its records or read from its folder."""
+        if self.records_dir:
+            for record in iter_records(self.records_dir, platform, self.records_prefix):
+                yield record_text(record)
+            return
+        for file in os.listdir(folder):
+            with open(os.path.join(folder, file), "r") as f:
+                yield f.read()
+
+    def load_comments(self, platform, folder):
+        """Read a platform's comments and split the long ones into chunks."""
+        with self.metrics.timer("read"):
+            texts = list(self.read_comments(platform, folder))
+        comments = []
+        with self.metrics.timer("tokenize"):
+            for comment in texts:
+                comments.extend(self.count_tokens.chunks(comment, self.max_comment_tokens, self.chunk_overlap_tokens))
+        return comments
+
+    def find_near_duplicates(self, comments):
+        if not self.cluster_near_duplicates:
+            return {}
+        from near_duplicates import representative_digests
+        near_duplicates = representative_digests(comments, self.near_duplicate_threshold)
+        logger.info(f"Found {len(near_duplicates)} comments in near-duplicate clusters")
+        return near_duplicates
+
+    def candidate_complaints(self, batch):
+        """Return the closest complaints to each comment with use_retrieval, or None to show the whole catalog."""
+        if self.complaint_index is None:
+            return None
+        candidates = {}
+        for matches in self.complaint_index.search(batch, self.retrieval_k):
+            candidates.update(dict.fromkeys(matches))
+        return list(candidates)
+
+    def build_request(self, batch):
+        """Return the chat completion arguments for a batch of one or more comments, and its cache key."""
+        candidates = self.candidate_complaints(batch)
+        if len(batch) == 1:
+            request = dict(
+                model=self.model,
+                messages=self.prompts.messages(batch[0], candidates),
                 tools=tools
             )
-            complaints_returned = []
-            # Handle tool calls
-            for choice in response.choices:
-                tool_calls = getattr(choice.message, "tool_calls", [])
-                if tool_calls is None:
-                    logger.error(f"No tool calls found for comment: {comment}")
-                    comments_to_complaints[comment] = []
-                    with open("comments_to_complaints.json", "w") as f:
-                        json.dump(comments_to_complaints, f, indent=2)
-                    continue
-                for tool_call in tool_calls:
-                    if tool_call.function.name == "record_vote":
-                        args = json.loads(tool_call.function.arguments)
-                        complaints_returned.append(args["complaint"])
-                        record_vote(args["complaint"], args["votes"])
-            comments_to_complaints[comment] = complaints_returned
-            with open("comments_to_complaints.json", "w") as f:
-                json.dump(comments_to_complaints, f, indent=2)
-            
+        else:
+            request = dict(
+                model=self.model,
+                messages=self.batch_prompts.messages(format_batch(batch), candidates),
+                tools=batch_tools
+            )
+        if self.structured_output:
+            del request["tools"]
+            request["response_format"] = response_format(len(self.catalog), len(batch))
+            answer_format = request["response_format"]["json_schema"]["name"]
+        else:
+            answer_format = request["tools"][0]["function"]["name"]
+        # the catalog as of this call: process_comments_async calls it when a batch is
+        # queued, so the complaints shown are the same on every run with the same window
+        shown = self.catalog.complaints if candidates is None else candidates
+        key = cache_key(
+            request["model"],
+            PROMPT_TEMPLATE_VERSION,
+            [comment_digest(comment) for comment in batch],
+            [f"{self.catalog.ids[complaint]}:{complaint}" for complaint in shown],
+            extra=answer_format + str(len(batch))
+        )
+        return request, key
+
+    def cached_response(self, key):
+        if self.response_cache is None:
+            return None
+        cached = self.response_cache.get(key)
+        if cached is None:
+            return None
+        logger.info("Using cached response")
+        self.metrics.count("cache_hits")
+        from openai.types.chat import ChatCompletion
+        return ChatCompletion.model_validate(cached)
+
+    def cache_response(self, key, response):
+        # only called once the reply has validated, so failures are asked again on the next run
+        if self.response_cache is not None:
+            self.response_cache.put(key, response.model_dump())
+
+    def create_completion(self, batch):
+        """Return the response for a batch, and its cache key if it's new and should be cached once it validates."""
+        with self.metrics.timer("prompt_build"):
+            request, key = self.build_request(batch)
+        response = self.cached_response(key)
+        if response is not None:
+            return response, None
+        with self.metrics.timer("model"):
+            response = self.endpoints.create(**request)
+        self.metrics.count("requests")
+        self.metrics.record_usage(response.usage)
+        return response, key
+
+    async def create_completion_async(self, request, key, on_start=None):
+        """Like create_completion, for a request built with build_request when its batch was queued."""
+        response = self.cached_response(key)
+        if response is not None:
+            return response, None
+        # with requests in flight at once this is each request's latency, so the timers add up to more than the run
+        with self.metrics.timer("model"):
+            response = await self.endpoints.acreate(on_start=on_start, **request)
+        self.metrics.count("requests")
+        self.metrics.record_usage(response.usage)
+        return response, key
+
+    def resolve_complaints(self, args):
+        """Turn record_complaints arguments into complaint strings, dropping ids that aren't in the list."""
+        found = []
+        for complaint_id in args.get("complaint_ids") or []:
+            try:
+                complaint_id = int(complaint_id)
+            except (TypeError, ValueError):
+                continue
+            if 0 <= complaint_id < len(self.catalog):
+                found.append(self.catalog[complaint_id])
+        for complaint in args.get("new_complaints") or []:
+            if isinstance(complaint, str) and complaint.strip():
+                found.append(complaint.strip())
+        return found
+
+    def weigh(self, comment, found):
+        votes = like_votes(comment)
+        return [(complaint, votes) for complaint in dict.fromkeys(self.aliases.resolve(complaint) for complaint in found)]
+
+    def extract_votes(self, response, comment):
+        """Return the (complaint, votes) pairs for the comment, or None if the model made no tool calls."""
+        found = []
+        for choice in response.choices:
+            tool_calls = getattr(choice.message, "tool_calls", [])
+            if tool_calls is None:
+                return None
+            self.metrics.count("tool_calls", len(tool_calls))
+            for tool_call in tool_calls:
+                if tool_call.function.name == "record_complaints":
+                    found.extend(self.resolve_complaints(json.loads(tool_call.function.arguments)))
+        return self.weigh(comment, found)
+
+    def extract_batch_votes(self, response, batch):
+        """Return one list of (complaint, votes) pairs per comment in the batch."""
+        calls = []
+        for choice in response.choices:
+            tool_calls = getattr(choice.message, "tool_calls", [])
+            if tool_calls is None:
+                return [None] * len(batch)
+            self.metrics.count("tool_calls", len(tool_calls))
+            for tool_call in tool_calls:
+                if tool_call.function.name == "record_complaints":
+                    calls.append(json.loads(tool_call.function.arguments))
+        grouped = group_by_comment_id(calls, len(batch))
+        return [
+            self.weigh(comment, [complaint for args in grouped[comment_id] for complaint in self.resolve_complaints(args)])
+            for comment_id, comment in enumerate(batch, 1)
+        ]
+
+    def extract_structured_votes(self, response, batch):
+        """Return the (complaint, votes) pairs for each comment from a JSON answer, and what was wrong with it if anything."""
+        content = response.choices[0].message.content or ""
+        try:
+            if len(batch) == 1:
+                answers = {1: parse_answer(content, len(self.catalog))}
+            else:
+                answers = parse_batch_answer(content, len(self.catalog), len(batch))
+        except InvalidOutput as e:
+            return [None] * len(batch), str(e)
+        results = [self.weigh(comment, self.resolve_complaints(answers[comment_id])) if comment_id in answers else None
+                   for comment_id, comment in enumerate(batch, 1)]
+        missing = len(batch) - len(answers)
+        return results, f"{missing} comments missing or invalid" if missing else None
+
+    def extract_results(self, response, batch):
+        """Return one list of (complaint, votes) pairs per comment, None for each the reply didn't answer, and the error."""
+        if self.structured_output:
+            return self.extract_structured_votes(response, batch)
+        if len(batch) == 1:
+            results = [self.extract_votes(response, batch[0])]
+        else:
+            results = self.extract_batch_votes(response, batch)
+        return results, "no tool calls" if None in results else None
+
+    def repair_request(self, comment, response, error, alone):
+        """The request to ask about one comment again, with the invalid JSON reply and its error if it had the reply to itself."""
+        request, _ = self.build_request([comment])
+        content = response.choices[0].message.content
+        if self.structured_output and alone and content:
+            request["messages"] = repair_messages(request["messages"], content, error)
+        return request
+
+    def repaired(self, comment, response):
+        """Count a repair request and return the comment's votes from it, or None and the next request to try."""
+        self.metrics.count("requests")
+        self.metrics.count("repairs")
+        self.metrics.record_usage(response.usage)
+        (votes,), error = self.extract_results(response, [comment])
+        if votes is not None:
+            self.metrics.count("repaired")
+            return votes, None
+        logger.warning(f"Repair failed for {comment_ref(comment)}: {error}")
+        return None, self.repair_request(comment, response, error, True)
+
+    def failed_indexes(self, batch, results, response, error, key):
+        """Cache a fully valid response; otherwise log what's wrong and return the comments to repair."""
+        if error is None:
+            if key is not None:
+                self.cache_response(key, response)
+            return []
+        logger.warning(f"Invalid reply for {len(batch)} comments ({error}), asking again about the failed ones")
+        return [i for i, votes in enumerate(results) if votes is None]
+
+    def request_votes(self, batch):
+        """Ask the model about a batch, asking again about each comment it didn't answer validly."""
+        self.log_request(batch)
+        response, key = self.create_completion(batch)
+        results, error = self.extract_results(response, batch)
+        for i in self.failed_indexes(batch, results, response, error, key):
+            request = self.repair_request(batch[i], response, error, len(batch) == 1)
+            for _ in range(self.max_repairs):
+                with self.metrics.timer("model"):
+                    repair_response = self.endpoints.create(**request)
+                results[i], request = self.repaired(batch[i], repair_response)
+                if results[i] is not None:
+                    break
+        return results
+
+    def commit_result(self, comment, votes, platform, digest=None):
+        """Apply a comment's votes to the tally and record its complaints."""
+        if votes is None:
+            # not recorded as processed, so the next run asks about it again
+            logger.error(f"No valid answer for {comment_ref(comment)}")
+            self.metrics.count("failed_comments")
+            return
+        self.metrics.count("comments")
+        with self.metrics.timer("disk_write"):
+            self.journal.append(comment, votes)
+        self.processed_index.add(comment, [complaint for complaint, _ in votes], digest)
+        if self.store is not None:
+            self.store.record_votes(comment, platform, votes, LIKE_WEIGHTED_TALLY)
+        for complaint, vote_count in votes:
+            self.record_vote(complaint, vote_count)
+        self.comments_to_complaints[comment] = [complaint for complaint, _ in votes]
+
+    def commit_results(self, batch, results, platform):
+        """Commit every comment in a batch, compacting the journal when it's due."""
+        for comment, votes in zip(batch, results):
+            self.commit_result(comment, votes, platform)
+        if self.journal.events_since_compaction >= self.compact_every:
+            self.compact()
+        self.metrics.maybe_report(logger.info)
+
+    def commit_reposts(self, reposts, platform):
+        """Count reposts and near-duplicates of processed comments with the original's complaints and their own likes."""
+        for comment, digest in reposts:
+            original_complaints = self.processed_index.get(digest)
+            if original_complaints is None:
+                # the original failed this run; the repost is picked up on the next one
+                continue
+            logger.info(f"Counting repost of a processed comment ({len(original_complaints)} complaints)")
+            self.commit_result(comment, self.weigh(comment, original_complaints), platform, digest)
+        if self.journal.events_since_compaction >= self.compact_every:
+            self.compact()
+
+    def log_failure(self, batch, e):
+        self.metrics.count("failed_comments", len(batch))
+        logger.error(f"Error processing comment: {e}")
+        ## print the stack trace
+        logger.error(traceback.format_exc())
+        for comment in batch:
+            logger.error(f"Failed {comment_ref(comment)}")
+
+    def pending_batches(self, comments, reposts, near_duplicates):
+        """Group the comments that need the model into requests.
+
+        Comments already processed are skipped. Reposts of a processed comment,
+        or of one earlier in this list, are added to reposts as (comment, digest)
+        to be counted with commit_reposts once the original has been committed.
+        near_duplicates maps clustered comments to their representative's digest,
+        so only the representative is sent to the model.
+        """
+        seen = set()
+        queued_digests = set()
+        unprocessed = []
+        for comment in comments:
+            if comment in seen or self.processed_index.has_comment(comment):
+                logger.info(f"{comment_ref(comment)} already processed")
+                continue
+            seen.add(comment)
+            digest = near_duplicates.get(comment) or comment_digest(comment)
+            if digest in self.processed_index or digest in queued_digests:
+                reposts.append((comment, digest))
+                continue
+            queued_digests.add(digest)
+            unprocessed.append(comment)
+        if self.batch_mode:
+            return list(pack_batches(unprocessed, self.count_tokens, self.max_batch_tokens, self.max_batch_comments))
+        return [[comment] for comment in unprocessed]
+
+    def log_request(self, batch):
+        tokens = sum(self.count_tokens(comment) for comment in batch)
+        if len(batch) == 1:
+            logger.info(f"Processing comment ({tokens} tokens)")
+        else:
+            logger.info(f"Processing batch of {len(batch)} comments ({tokens} tokens)")
+
+    def process_comments(self, comments, platform, near_duplicates):
+        """Send comments to the model one request at a time."""
+        reposts = []
+        for batch in self.pending_batches(comments, reposts, near_duplicates):
+            try:
+                self.commit_results(batch, self.request_votes(batch), platform)
+            except Exception as e:
+                self.log_failure(batch, e)
+                continue
+        self.commit_reposts(reposts, platform)
+
+    def queue_request(self, batch):
+        """Start asking about a batch, with its prompt built from the catalog as it is now."""
+        with self.metrics.timer("prompt_build"):
+            request, key = self.build_request(batch)
+        return asyncio.create_task(self.request_votes_async(batch, request, key))
+
+    async def request_votes_async(self, batch, request, key):
+        async with self.limiter.admit(sum(map(self.count_tokens, batch))) as outcome:
+            self.log_request(batch)
+            response, key = await self.create_completion_async(request, key, outcome.start)
+            if key is not None:
+                # a fresh response, not one from the cache
+                outcome.tokens = processed_tokens(response.usage)
+        results, error = self.extract_results(response, batch)
+        for i in self.failed_indexes(batch, results, response, error, key):
+            request = self.repair_request(batch[i], response, error, len(batch) == 1)
+            for _ in range(self.max_repairs):
+                async with self.limiter.admit(self.count_tokens(batch[i])) as outcome:
+                    with self.metrics.timer("model"):
+                        repair_response = await self.endpoints.acreate(on_start=outcome.start, **request)
+                    outcome.tokens = processed_tokens(repair_response.usage)
+                results[i], request = self.repaired(batch[i], repair_response)
+                if results[i] is not None:
+                    break
+        return results
+
+    async def process_comments_async(self, comments, platform, near_duplicates):
+        """Keep as many requests in flight at once as the limiter admits.
+
+        Results are committed in the order the comments were read, so the tally
+        and comments_to_complaints.json end up the same as a sequential run.
+        Each prompt is built when its batch is queued, not when the request
+        gets a slot: with commits in input order and a fixed window, the
+        catalog a prompt shows doesn't depend on which requests finished
+        first, so a re-run builds the same prompts and hits the response cache.
+        """
+        pending = deque()
+
+        async def commit_next():
+            batch, task = pending.popleft()
+            try:
+                self.commit_results(batch, await task, platform)
+            except Exception as e:
+                self.log_failure(batch, e)
+
+        reposts = []
+        for batch in self.pending_batches(comments, reposts, near_duplicates):
+            pending.append((batch, self.queue_request(batch)))
+            if len(pending) >= self.window:
+                await commit_next()
+        while pending:
+            await commit_next()
+        self.commit_reposts(reposts, platform)
+
+    def sync_catalog(self):
+        """Add the complaints found since the last sync, by any worker, to the catalog in the queue's id order.
+
+        Every worker's catalog is built this way, so a complaint has the same
+        id in all their prompts and a response's ids mean the same everywhere.
+        """
+        for complaint_id, complaint in self.queue.complaints_since(self.catalog_synced):
+            if complaint not in self.catalog and self.complaint_index is not None:
+                self.complaint_index.add([complaint])
+            self.catalog.add(complaint)
+            self.catalog_synced = complaint_id
+
+    def queue_batches(self, items):
+        if self.batch_mode:
+            return list(pack_batches(items, lambda item: self.count_tokens(item.text),
+                                     self.max_batch_tokens, self.max_batch_comments))
+        return [[item] for item in items]
+
+    def finish(self, item, votes):
+        """Complete a leased comment, adding its votes to the queue's tally unless its lease was lost."""
+        with self.metrics.timer("disk_write"):
+            completed = self.queue.complete(item, votes)
+        if not completed:
+            # the lease ran out and another worker took the comment; its votes are counted there
+            logger.warning(f"Lost the lease on {comment_ref(item.text)}, discarding its votes")
+            self.metrics.count("lost_leases")
+            return
+        self.metrics.count("comments")
+        if self.store is not None:
+            self.store.record_votes(item.text, item.platform, votes, LIKE_WEIGHTED_TALLY)
+        self.metrics.maybe_report(logger.info)
+
+    def queue_failure(self, items, error):
+        """Put comments whose request failed back in the queue to retry after a backoff, or quarantine them."""
+        for item in items:
+            state = self.queue.fail(item, error)
+            if state == "failed":
+                logger.error(f"Quarantined {comment_ref(item.text)} after {item.attempts} attempts: {error}")
+                self.metrics.count("quarantined")
+            else:
+                logger.error(f"Failed {comment_ref(item.text)} (attempt {item.attempts}), retrying later")
+                self.metrics.count("failed_comments")
+
+    async def work_batch(self, items):
+        """Vote on leased comments and complete them in the queue."""
+        self.sync_catalog()
+        batch = []
+        for item in items:
+            original_complaints = self.queue.done_complaints(item.digest)
+            if original_complaints is None:
+                batch.append(item)
+            else:
+                logger.info(f"Counting repost of a processed comment ({len(original_complaints)} complaints)")
+                self.finish(item, self.weigh(item.text, original_complaints))
+        if not batch:
+            return
+        try:
+            results = await self.queue_request([item.text for item in batch])
         except Exception as e:
-            import traceback
             logger.error(f"Error processing comment: {e}")
-            ## print the stack trace
             logger.error(traceback.format_exc())
-            logger.error(f"Comment: {comment}")
-            continue
+            self.queue_failure(batch, f"{type(e).__name__}: {e}")
+            return
+        for item, votes in zip(batch, results):
+            if votes is None:
+                self.queue_failure([item], "no valid answer in the response")
+            else:
+                self.finish(item, votes)
+
+    async def drain_queue(self):
+        """Lease comments from the queue and vote on them until no comment is pending or leased by anyone.
+
+        Comments waiting out a backoff, or leased by a worker that may have
+        stopped, are waited for. Comments this worker still holds when it is
+        stopped are released so another worker can take them straight away.
+        """
+        per_request = self.max_batch_comments if self.batch_mode else 1
+        running = {}
+        try:
+            while True:
+                if len(running) < self.window:
+                    items = self.queue.lease((self.window - len(running)) * per_request)
+                    for batch in self.queue_batches(items):
+                        running[asyncio.create_task(self.work_batch(batch))] = batch
+                if running:
+                    done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        running.pop(task)
+                        task.result()
+                    continue
+                due = self.queue.next_due()
+                if due is None:
+                    break
+                # poll at least every few seconds, as other workers may finish what they hold before it's due
+                await asyncio.sleep(min(max(due - time.time(), 0.1), 5.0))
+        finally:
+            for task in running:
+                task.cancel()
+            self.queue.release(item for batch in running.values() for item in batch)
+
+    def run_queue(self):
+        """Queue every platform's comments and work through the queue alongside any other workers.
+
+        The first worker seeds the queue with the tally from the checkpoint or
+        complaints.json. Comments already in the queue aren't queued again, so
+        every worker can be started the same way.
+        """
+        if not self.queue.seeded:
+            self.load(update_index=False)
+            if self.queue.seed(self.complaints, self.comments_to_complaints, self.applied_like_updates):
+                logger.info(f"Seeded the work queue with {len(self.comments_to_complaints)} processed comments")
+        self.complaints = self.queue.tally()
+        self.sync_catalog()
+
+        for platform, folder in self.platforms:
+            comments = self.load_comments(platform, folder)
+            near_duplicates = self.find_near_duplicates(comments)
+            with self.metrics.timer("disk_write"):
+                added = self.queue.enqueue((platform, comment, near_duplicates.get(comment) or comment_digest(comment))
+                                           for comment in comments)
+            logger.info(f"Queued {added} of {len(comments)} {platform} comments")
+
+        logger.info(f"Work queue: {self.queue.summary()}")
+        asyncio.run(self.drain_queue())
+        self.apply_like_updates()
+        self.export_queue()
+
+    def export_queue(self):
+        """Write the queue's tally to the files the rest of the pipeline reads."""
+        with self.metrics.timer("disk_write"):
+            write_json_atomic("like_weighted_complaints.json", self.queue.tally(), indent=2)
+            write_json_atomic("comments_to_complaints.json", self.queue.comments_to_complaints(), indent=2)
+        logger.info(f"Work queue: {self.queue.summary()}")
+
+    def platform_comments(self):
+        """Yield each platform's comments and near-duplicate clusters, loading them as they're needed."""
+        for platform, folder in self.platforms:
+            logger.info(f"Processing {platform} comments from {self.records_dir or folder}")
+            comments = self.load_comments(platform, folder)
+            logger.info(f"Loaded {len(comments)} comments from {platform}")
+            yield platform, comments, self.find_near_duplicates(comments)
+
+    async def process_platforms_async(self):
+        # one event loop for every platform, as the async clients stay bound to the loop they were first used in
+        for platform, comments, near_duplicates in self.platform_comments():
+            await self.process_comments_async(comments, platform, near_duplicates)
+
+    def apply_like_updates(self):
+        """Apply the like count changes incremental_ingest.py found to the tally, without asking the model.
+
+        Each complaint of an updated comment gets the difference between its new
+        and old votes. The runs applied are saved in the checkpoint, in the same
+        write as the tally they changed, so an update is never applied twice.
+        With a work queue they're applied to the queue's tally and marked there
+        instead.
+        """
+        if not self.records_dir:
+            return
+        applied = set(self.applied_like_updates)
+        for path in sorted(Path(self.records_dir).glob("like_updates-*.jsonl")):
+            run = path.stem[len("like_updates-"):]
+            if self.queue_path:
+                self.apply_queue_like_updates(run, path)
+                continue
+            if run in applied:
+                continue
+            updated = 0
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    update = json.loads(line)
+                    complaints_found = self.processed_index.get(update["digest"])
+                    if complaints_found is None:
+                        # not voted on yet; its record is counted with its current likes when it is
+                        continue
+                    delta = likes_to_votes(update["new_likes"]) - likes_to_votes(update["old_likes"])
+                    if not delta or not complaints_found:
+                        continue
+                    votes = [(complaint, delta) for complaint in dict.fromkeys(map(self.aliases.resolve, complaints_found))]
+                    for complaint, vote_count in votes:
+                        self.record_vote(complaint, vote_count)
+                    if self.store is not None:
+                        self.store.adjust_votes(votes, LIKE_WEIGHTED_TALLY)
+                    updated += 1
+            self.applied_like_updates.append(run)
+            logger.info(f"Applied like count changes for {updated} comments from {path}")
+
+    def apply_queue_like_updates(self, run, path):
+        """Apply one like update run to the work queue's tally, unless a worker already has."""
+        with open(path, "r", encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f]
+        applied = self.queue.apply_like_updates(run, updates, self.aliases.resolve)
+        if applied is None:
+            return
+        if self.store is not None:
+            for votes in applied:
+                self.store.adjust_votes(votes, LIKE_WEIGHTED_TALLY)
+        logger.info(f"Applied like count changes for {len(applied)} comments from {path}")
+
+    def run(self):
+        """Vote on every platform's unprocessed comments, picking up where the last run stopped."""
+        self.profiler.start()
+        if self.queue_path:
+            self.run_queue()
+        else:
+            replayed = self.load()
+            if replayed:
+                logger.info(f"Replayed {replayed} comments from vote_journal.jsonl")
+                self.compact()
+
+            if self.use_async:
+                asyncio.run(self.process_platforms_async())
+            else:
+                for platform, comments, near_duplicates in self.platform_comments():
+                    self.process_comments(comments, platform, near_duplicates)
+
+            self.apply_like_updates()
+            self.compact()
+        self.close()
+        logger.info(f"Metrics: {self.metrics.summary()}")
+        self.metrics.dump(self.metrics_path)
+        profile_report = self.profiler.stop()
+        if profile_report:
+            logger.info(profile_report)
+        logger.info("Processing complete. Complaints tally saved to like_weighted_complaints.json.")
+
+    def dry_run(self):
+        """Return what a run would send to the model, without creating a client or changing the tally."""
+        self.load(update_index=False)
+        # comments the processed index doesn't have yet are added in memory only; nothing is flushed
+        for comment, comment_complaints in self.comments_to_complaints.items():
+            self.processed_index.add(comment, comment_complaints)
+        lines = []
+        for platform, folder in self.platforms:
+            comments = self.load_comments(platform, folder)
+            reposts = []
+            batches = self.pending_batches(comments, reposts, self.find_near_duplicates(comments))
+            tokens = sum(self.count_tokens(comment) for batch in batches for comment in batch)
+            lines.append(f"{platform}: {len(comments)} comments, {sum(map(len, batches))} to send in "
+                         f"{len(batches)} requests ({tokens} comment tokens), {len(reposts)} reposts "
+                         f"counted without the model")
+        return "\n".join(lines)
+
+    def stats(self, top=20):
+        """Return a summary of the tally so far, read from the checkpoint and journal without loading anything else."""
+        if self.queue_path:
+            return self.queue_stats(top)
+        replayed = self.load(update_index=False)
+        lines = [f"{len(self.comments_to_complaints)} comments voted on ({replayed} since the last checkpoint), "
+                 f"{len(self.complaints)} complaints, {sum(self.complaints.values())} votes"]
+        ranked = sorted(self.complaints.items(), key=lambda item: -item[1])[:top]
+        lines += [f"{votes:>10}  {complaint}" for complaint, votes in ranked]
+        return "\n".join(lines)
+
+    def queue_stats(self, top=20):
+        self.complaints = self.queue.tally()
+        lines = [f"Work queue: {self.queue.summary()}, {len(self.complaints)} complaints, "
+                 f"{sum(self.complaints.values())} votes"]
+        ranked = sorted(self.complaints.items(), key=lambda item: -item[1])[:top]
+        lines += [f"{votes:>10}  {complaint}" for complaint, votes in ranked]
+        for text, attempts, error in self.queue.quarantined(top):
+            lines.append(f"Quarantined after {attempts} attempts: {comment_ref(text)}: {error}")
+        return "\n".join(lines)
+
+    def close(self):
+        """Close whatever this run opened."""
+        opened = self.__dict__
+        if "queue" in opened:
+            self.queue.close()
+        if "journal" in opened:
+            self.journal.close()
+        if opened.get("store") is not None:
+            self.store.close()
+        if opened.get("complaint_index") is not None:
+            self.complaint_index.flush()
+        if opened.get("response_cache") is not None:
+            logger.info(self.response_cache.summary())
+            self.response_cache.close()
+        if "endpoints" in opened:
+            logger.info(self.endpoints.summary())
+        if "limiter" in opened:
+            logger.info(self.limiter.summary())
+
+
+def parse_endpoint(value):
+    """Parse URL or URL,CONCURRENCY into a (base_url, concurrency) pair."""
+    url, _, concurrency = value.partition(",")
+    return url, int(concurrency or 1)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Tally the complaints in comments, weighted by their likes")
+    parser.add_argument("--endpoint", dest="llm_endpoints", action="append", type=parse_endpoint,
+                        metavar="URL[,CONCURRENCY]", help="LM Studio / llama.cpp server, repeat for several "
+                        f"(default: {llm_endpoints[0][0]},{llm_endpoints[0][1]})")
+    parser.add_argument("--model", default=MODEL)
+    parser.add_argument("--sequential", dest="use_async", action="store_false", default=use_async,
+                        help="send one request at a time")
+    parser.add_argument("--max-concurrent-requests", type=int, default=max_concurrent_requests,
+                        help="requests in flight at once, or where the adaptive limit starts "
+                        "(default: the endpoints' total concurrency)")
+    parser.add_argument("--fixed-concurrency", dest="adaptive_concurrency", action="store_false",
+                        default=adaptive_concurrency, help="keep the limit at --max-concurrent-requests")
+    parser.add_argument("--max-adaptive-requests", type=int, default=max_adaptive_requests)
+    parser.add_argument("--request-token-unit", type=int, default=request_token_unit,
+                        help="comment tokens that count as one request in flight")
+    parser.add_argument("--batch", dest="batch_mode", action="store_true", default=batch_mode,
+                        help="pack several short comments into one request")
+    parser.add_argument("--max-batch-comments", type=int, default=max_batch_comments)
+    parser.add_argument("--max-batch-tokens", type=int, default=max_batch_tokens)
+    parser.add_argument("--max-comment-tokens", type=int, default=max_comment_tokens)
+    parser.add_argument("--chunk-overlap-tokens", type=int, default=chunk_overlap_tokens)
+    parser.add_argument("--retrieval", dest="use_retrieval", action="store_true", default=use_retrieval,
+                        help="show the model only the complaints most similar to each comment")
+    parser.add_argument("--retrieval-k", type=int, default=retrieval_k)
+    parser.add_argument("--embedding-model", default=embedding_model)
+    parser.add_argument("--journal-fsync-every", type=int, default=journal_fsync_every)
+    parser.add_argument("--compact-every", type=int, default=compact_every)
+    parser.add_argument("--cluster-near-duplicates", action="store_true", default=cluster_near_duplicates)
+    parser.add_argument("--near-duplicate-threshold", type=float, default=near_duplicate_threshold)
+    parser.add_argument("--structured", dest="structured_output", action="store_true", default=structured_output,
+                        help="ask for a JSON answer through response_format instead of a tool call")
+    parser.add_argument("--max-repairs", type=int, default=max_repairs,
+                        help="times to ask again about a comment whose answer is missing or invalid")
+    parser.add_argument("--cache", dest="response_cache_path", default=response_cache_path,
+                        help="response cache database")
+    parser.add_argument("--no-cache", dest="response_cache_path", action="store_const", const="",
+                        help="don't cache responses")
+    parser.add_argument("--cache-max-mb", dest="response_cache_max_mb", type=int, default=response_cache_max_mb)
+    parser.add_argument("--aliases", dest="aliases_path", default=aliases_path)
+    parser.add_argument("--db", dest="results_db", default=results_db, help="also record votes in this results store")
+    parser.add_argument("--queue", dest="queue_path", default=queue_path, metavar="DB",
+                        help="work through this SQLite work queue, alongside any other workers using it")
+    parser.add_argument("--lease-seconds", type=float, default=lease_seconds)
+    parser.add_argument("--max-attempts", type=int, default=max_attempts)
+    parser.add_argument("--backoff-seconds", type=float, default=backoff_seconds)
+    parser.add_argument("--tiktok-folder", default=tiktok_folder)
+    parser.add_argument("--instagram-folder", default=instagram_folder)
+    parser.add_argument("--records", dest="records_dir", default=records_dir, metavar="DIR",
+                        help="read the parsers' JSONL records instead of the comment folders")
+    parser.add_argument("--records-prefix", default=records_prefix)
+    parser.add_argument("--metrics", dest="metrics_path", default=metrics_path)
+    parser.add_argument("--metrics-every", dest="metrics_report_every", type=float, default=metrics_report_every)
+    parser.add_argument("--profile", dest="profile_mode", choices=["cprofile", "tracemalloc"], default=profile_mode)
+    parser.add_argument("--log-file", default="comment_like_voter_llm.log")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--dry-run", action="store_true", help="show what would be sent to the model and exit")
+    mode.add_argument("--stats", action="store_true", help="show the tally so far and exit")
+    args = parser.parse_args()
+
+    # Setup logging
+    logging.basicConfig(
+        filename=args.log_file,
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s'
+    )
+    options = {key: value for key, value in vars(args).items()
+               if key not in ("log_file", "dry_run", "stats") and value is not None}
+    voter = LikeVoter(**options)
+    if args.stats:
+        print(voter.stats())
+    elif args.dry_run:
+        print(voter.dry_run())
+    else:
+        voter.run()
+
 
-logger.info("Processing complete. Complaints tally saved to like_weighted_complaints.json.") 
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,138 +1,783 @@
-from openai import OpenAI
+"""
+Complaint Normalizer
+Reads the comments from each platform and asks the local model to map them to
+a growing list of normalized complaints, tallying one vote per comment.
+ComplaintNormalizer can be imported without side effects: the tokenizer, the
+OpenAI client, the stores and complaints.json are only loaded when something
+needs them, so --stats and --dry-run don't wait on tiktoken or the client.
+"""
+
 import os
+import re
 import json
-import tiktoken
+import time
+from functools import cached_property
+from comment_batching import pack_batches, format_batch, group_by_comment_id
+from comment_chunking import TokenCounter
+from results_store import ResultsStore, COMPLAINTS_TALLY
+from comment_digest import comment_digest, comment_ref
+from llm_cache import ResponseCache, cache_key
+from comment_records import iter_records, record_text
+from pipeline_metrics import Metrics, Profiler
+from prompt_builder import ComplaintCatalog, PromptBuilder
+from structured_output import (INSTRUCTIONS as STRUCTURED_INSTRUCTIONS, BATCH_INSTRUCTIONS as STRUCTURED_BATCH_INSTRUCTIONS,
+                               InvalidOutput, parse_answer, parse_batch_answer, repair_messages, response_format)
+
+## defaults for the command line options below, ComplaintNormalizer takes the same names as keyword arguments
+
+MODEL = "qwq-32b-mlx"
+
+## comments longer than max_comment_tokens are split on comment and sentence boundaries into chunks that overlap by chunk_overlap_tokens
+max_comment_tokens = 4096
+chunk_overlap_tokens = 200
+
+## LM Studio / llama.cpp servers as (base_url, concurrency) pairs, each request goes to the least busy one
+llm_endpoints = [("http://127.0.0.1:1234/v1", 1)]
+
+## batch mode packs several short comments into one request so the complaints list is sent once per batch
+batch_mode = False
+max_batch_comments = 10
+max_batch_tokens = 3000
 
-encoding = tiktoken.encoding_for_model("gpt-4o") # model doesn't matter we're just counting tokens
+## retrieval shows the model only the retrieval_k existing complaints closest to the comment instead of the whole list
+## (needs an embedding model loaded in LM Studio)
+use_retrieval = False
+retrieval_k = 30
+embedding_model = "text-embedding-nomic-embed-text-v1.5"
 
-def count_tokens(text):
-    return len(encoding.encode(text))
+## near-duplicate clustering sends one comment per cluster of copy-pasted or near-identical comments to the model
+## and counts its complaints again for the rest of the cluster
+cluster_near_duplicates = False
+near_duplicate_threshold = 0.8
 
-client = OpenAI(base_url="http://127.0.0.1:1234/v1", api_key="lm-studio")
+## structured output asks for a JSON answer with the ids of the listed complaints and any new ones through the request's
+## response_format (structured_output.py), instead of free text split on "."; an invalid reply is sent back with the
+## validator's error up to max_repairs times, and comments a batch reply leaves out are asked about one at a time
+structured_output = False
+max_repairs = 1
 
-## read in the complaints.json file
-with open("complaints.json", "r") as f:
-    complaints = json.load(f)
+## responses are cached on disk by model, prompt template, comment and candidate complaints so re-runs don't ask the model again
+## (bump PROMPT_TEMPLATE_VERSION when the prompt wording changes, set response_cache_path = None to disable)
+PROMPT_TEMPLATE_VERSION = "2"
+response_cache_path = "llm_response_cache.db"
+response_cache_max_mb = 512
 
+## stream single-comment responses, dropping the <think> section as it arrives; if the model reasons for more than
+## max_reasoning_tokens the stream is closed and the comment is asked again with an instruction not to think
+## (batch requests use tool calls and aren't streamed)
+stream_responses = True
+max_reasoning_tokens = 2048
+NO_THINKING_INSTRUCTION = "\n\nDo not think it through or write a <think> section. Reply straight away with only the complaints."
 
+## also record comments and votes in this SQLite results store (None to skip)
+results_db = None  # e.g. "comment_reader.db"
+
+## timers and counters for each stage are printed every metrics_report_every seconds and written to metrics_path at the end
+## (Prometheus text if it ends in .prom, JSON otherwise); set profile_mode to "cprofile" or "tracemalloc" to profile the run
+metrics_report_every = 60
+metrics_path = "reader_metrics.json"
+profile_mode = None
+
+## complaints merged by complaint_merge.py are tallied under the complaint they were merged into
+aliases_path = "complaint_aliases.json"
 
 ## there are many files of comments in /Users/annhoward/src/comment_reader/comments/tiktok and /Users/annhoward/src/comment_reader/comments/instagram
 
 tiktok_folder = "/Users/annhoward/src/comment_reader/comments/tiktok"
 instagram_folder = "/Users/annhoward/src/comment_reader/comments/instagram"
 
-tiktok_comments = []
-instagram_comments = []
-
-for file in os.listdir(tiktok_folder):
-    with open(os.path.join(tiktok_folder, file), "r") as f:
-        tiktok_comments.append(f.read())
-
-for file in os.listdir(instagram_folder):
-    with open(os.path.join(instagram_folder, file), "r") as f:
-        instagram_comments.append(f.read())
-        
-platforms = ["tiktok", "instagram"]
-
-for comments in [tiktok_comments, instagram_comments]:
-    platform = platforms.pop(0)
-    platform_comments_to_complaints = {}
-    print(f"Processing {platform} {len(comments)} comments")
-    
-
-
-    comments_to_complaints = {}
-
-    for comment in comments:
-        if comment in comments_to_complaints:
-            complaints_returned = comments_to_complaints[comment]
-            for complaint in complaints_returned:
-                complaints[complaint] = complaints.get(complaint, 0) + 1
-            continue
-        print(f"Processing comment {count_tokens(comment)} tokens")
-        if count_tokens(comment) > 4096: # chunk it into 4096 token chunks
-            chunks = [comment[i:i+4096] for i in range(0, len(comment), 4096)]
+## set records_dir to read the parsers' JSONL records (comment_records.py) instead of opening every comment file
+records_dir = None  # e.g. "parsed_comments"
+## set records_prefix to read only the shards one incremental_ingest.py run wrote, e.g. "ingest-20240101-120000"
+records_prefix = ""
+
+
+## in batch mode the model reports each complaint with a tool call tagged with the comment's id
+batch_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "record_complaint",
+            "description": "Records a normalized complaint made in one of the comments",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "comment_id": {
+                        "type": "integer",
+                        "description": "The id of the comment the complaint comes from"
+                    },
+                    "complaint": {
+                        "type": "string",
+                        "description": "The normalized complaint, exactly as it appears in the list if it's already there"
+                    }
+                },
+                "required": ["comment_id", "complaint"]
+            }
+        }
+    }
+]
+
+
+## the prompt is laid out for the server's prompt cache (prompt_builder.py): the instructions and the complaint catalog
+## make up a system message that only grows at the end, and the user message is just the comment
+INSTRUCTIONS = """
+It's your role to normalize the complaints in my comments. You'll review each comment thread one at a time and come up with a normalized version of the complaint. The comment you're reviewing is in my message.
+
+You need to normalize the complaint to one or more of the complaints in the list, OR, if the complaint is not in the list, you need to add a new complaint to the list.
+
+The end goal is to have a vote tally of all the complaints in the list, where slight variations, different ways of saying the same thing, and other variations are all counted as the same complaint. If it's meaningfully different, add another complaint to the list.
+
+Each sentence you return will be considered a separate complaint, so each complaint should only be a single sentence. A script will parse the output and split on the . character.
+
+Eventually, a video will be made for each complaint by me, a content creator, to whom these comments are addressed, in order according to the vote tally (so please only return new complaints if they are not in the list, not if they're only slightly different).
+
+Either return one or more of the normalized complaints EXACTLY as it appears in the list (without its [id]), or add a new complaint to the list by returning a new sentence that is a complaint.
+These will be added as keys to a dictionary data structure in python that will be used to tally the complaints.
+Do not return any other text than the normalized complaints, such as "The AI art issue maps directly to an existing entry" or "The Memphis environmental justice example fits under "Data centers are harming ecosystems"" as this will cause the script to log these as separate complaints due to the extra text.
+"""
+
+BATCH_INSTRUCTIONS = """
+It's your role to normalize the complaints in my comments. You'll review several comment threads at once and come up with a normalized version of the complaints in each one. The comments are in my message, each wrapped in a <comment id="..."> tag.
+
+For each comment, normalize its complaint to one or more of the complaints in the list, OR, if the complaint is not in the list, add a new complaint to the list.
+
+The end goal is to have a vote tally of all the complaints in the list, where slight variations, different ways of saying the same thing, and other variations are all counted as the same complaint. If it's meaningfully different, add another complaint to the list.
+
+Eventually, a video will be made for each complaint by me, a content creator, to whom these comments are addressed, in order according to the vote tally (so please only return new complaints if they are not in the list, not if they're only slightly different).
+
+Call the record_complaint tool once for every complaint in every comment, passing the comment's id as comment_id. Use complaints EXACTLY as they appear in the list (without their [id]), or a new single-sentence complaint. Don't call the tool for a comment with no complaint.
+"""
+
+CATALOG_HEADING = "Here are the complaints you've seen so far, as [id] complaint:"
+
+## a list id the model copied along with a complaint, e.g. "- [3] "
+LISTED_ID = re.compile(r'^\s*-?\s*\[\d+\]\s*')
+
+
+def parse_complaints(complaint):
+    ## strip out the <think> and </think> tags and all content in between them
+    think_start = complaint.find("<think>")
+    think_end = complaint.find("</think>")
+    if think_start != -1 and think_end != -1:
+        complaint = complaint[think_end+len("</think>"):]
+    complaint = complaint.strip()
+    ## now split on the . character
+    complaints_returned = complaint.split(".")
+    ## some complaints aren't given with . at the end, so we'll see 2 spaces, we should split on 2 spaces as well, but not all elements will have 2 spaces
+    double_spaced_complaints = [complaint_returned.split("  ") for complaint_returned in complaints_returned if "  " in complaint_returned]
+    complaints_returned = [complaint_returned for complaint_returned in complaints_returned if "  " not in complaint_returned]
+    complaints_returned = complaints_returned + [item for sublist in double_spaced_complaints for item in sublist]
+    return complaints_returned
+
+
+def parse_batch_complaints(response, batch):
+    """Return the list of complaints the model recorded for each comment in the batch."""
+    calls = []
+    for tool_call in response.choices[0].message.tool_calls or []:
+        if tool_call.function.name == "record_complaint":
+            calls.append(json.loads(tool_call.function.arguments))
+    grouped = group_by_comment_id(calls, len(batch))
+    return [[args["complaint"] for args in grouped[comment_id]] for comment_id in range(1, len(batch) + 1)]
+
+
+class ReasoningBudgetExceeded(Exception):
+    pass
+
+
+class ComplaintNormalizer:
+    """Normalizes the complaints in each platform's comments and keeps the one-vote-per-comment tally.
+
+    Constructing one only stores its settings; the tokenizer, the endpoint pool (and with it the
+    OpenAI client), the stores and the caches are created the first time they're used.
+    """
+
+    def __init__(self, llm_endpoints=llm_endpoints, model=MODEL, batch_mode=batch_mode,
+                 max_batch_comments=max_batch_comments, max_batch_tokens=max_batch_tokens,
+                 max_comment_tokens=max_comment_tokens, chunk_overlap_tokens=chunk_overlap_tokens,
+                 use_retrieval=use_retrieval, retrieval_k=retrieval_k, embedding_model=embedding_model,
+                 cluster_near_duplicates=cluster_near_duplicates, near_duplicate_threshold=near_duplicate_threshold,
+                 response_cache_path=response_cache_path, response_cache_max_mb=response_cache_max_mb,
+                 stream_responses=stream_responses, max_reasoning_tokens=max_reasoning_tokens,
+                 structured_output=structured_output, max_repairs=max_repairs,
+                 results_db=results_db, aliases_path=aliases_path, tiktok_folder=tiktok_folder,
+                 instagram_folder=instagram_folder, records_dir=records_dir, records_prefix=records_prefix,
+                 metrics_report_every=metrics_report_every, metrics_path=metrics_path, profile_mode=profile_mode):
+        self.llm_endpoints = llm_endpoints
+        self.model = model
+        self.batch_mode = batch_mode
+        self.max_batch_comments = max_batch_comments
+        self.max_batch_tokens = max_batch_tokens
+        self.max_comment_tokens = max_comment_tokens
+        self.chunk_overlap_tokens = chunk_overlap_tokens
+        self.use_retrieval = use_retrieval
+        self.retrieval_k = retrieval_k
+        self.embedding_model = embedding_model
+        self.cluster_near_duplicates = cluster_near_duplicates
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.response_cache_path = response_cache_path
+        self.response_cache_max_mb = response_cache_max_mb
+        self.stream_responses = stream_responses
+        self.max_reasoning_tokens = max_reasoning_tokens
+        self.structured_output = structured_output
+        self.max_repairs = max_repairs
+        self.results_db = results_db
+        self.aliases_path = aliases_path
+        self.platforms = [("tiktok", tiktok_folder), ("instagram", instagram_folder)]
+        self.records_dir = records_dir
+        self.records_prefix = records_prefix
+        self.metrics_path = metrics_path
+        self.metrics = Metrics(metrics_report_every)
+        self.profiler = Profiler(profile_mode, "reader_profile")
+
+        ## complaints found in each comment this run, by digest, so reposts across both platforms are counted without the model
+        self.seen_complaints = {}
+        self.comments_to_complaints = {}
+        self.platform_comments_to_complaints = {}
+        self.near_duplicates = {}
+
+    @cached_property
+    def count_tokens(self):
+        ## remembers each comment's token count so it's only encoded once
+        import tiktoken
+        return TokenCounter(tiktoken.encoding_for_model("gpt-4o")) # model doesn't matter we're just counting tokens
+
+    @cached_property
+    def endpoints(self):
+        from endpoint_pool import EndpointPool
+        return EndpointPool(self.llm_endpoints)
+
+    @cached_property
+    def complaints(self):
+        ## read in the complaints.json file
+        with open("complaints.json", "r") as f:
+            return json.load(f)
+
+    @cached_property
+    def catalog(self):
+        ## the complaints in the order they were first tallied, which is the order complaints.json keeps
+        return ComplaintCatalog(self.complaints)
+
+    @cached_property
+    def prompts(self):
+        return PromptBuilder(STRUCTURED_INSTRUCTIONS if self.structured_output else INSTRUCTIONS,
+                             self.catalog, CATALOG_HEADING)
+
+    @cached_property
+    def batch_prompts(self):
+        return PromptBuilder(STRUCTURED_BATCH_INSTRUCTIONS if self.structured_output else BATCH_INSTRUCTIONS,
+                             self.catalog, CATALOG_HEADING)
+
+    @cached_property
+    def aliases(self):
+        from complaint_merge import ComplaintAliases
+        return ComplaintAliases(self.aliases_path)
+
+    @cached_property
+    def store(self):
+        return ResultsStore(self.results_db) if self.results_db else None
+
+    @cached_property
+    def response_cache(self):
+        if not self.response_cache_path:
+            return None
+        return ResponseCache(self.response_cache_path, self.response_cache_max_mb * 1024 * 1024)
+
+    @cached_property
+    def complaint_index(self):
+        ## embedding index of the complaints, saved next to complaints.json
+        if not self.use_retrieval:
+            return None
+        from complaint_index import ComplaintIndex, openai_embedder
+        index = ComplaintIndex(openai_embedder(self.endpoints, self.embedding_model), "complaint_index.npz",
+                               model=self.embedding_model)
+        index.add(self.complaints.keys())
+        return index
+
+    def candidate_complaints(self, batch):
+        ## with use_retrieval just the closest matches to each comment in the batch, otherwise None for the whole catalog
+        if self.complaint_index is None:
+            return None
+        candidates = {}
+        for matches in self.complaint_index.search(batch, self.retrieval_k):
+            candidates.update(dict.fromkeys(matches))
+        return list(candidates)
+
+    def tally_complaints(self, comment, complaints_returned, platform):
+        self.metrics.count("comments")
+        new_complaints = []
+        tallied = []
+        for complaint_returned in complaints_returned:
+            complaint_returned = complaint_returned.strip()
+            complaint_returned = complaint_returned.replace("\n", "")
+            complaint_returned = LISTED_ID.sub("", complaint_returned)
+            complaint_returned = self.aliases.resolve(complaint_returned)
+            if complaint_returned not in self.complaints:
+                new_complaints.append(complaint_returned)
+                self.catalog.add(complaint_returned)
+            self.complaints[complaint_returned] = self.complaints.get(complaint_returned, 0) + 1
+            tallied.append(complaint_returned)
+        if self.complaint_index is not None:
+            self.complaint_index.add(new_complaints)
+        if self.store is not None:
+            self.store.record_votes(comment, platform, [(complaint, 1) for complaint in tallied], COMPLAINTS_TALLY)
+        digest = comment_digest(comment)
+        self.seen_complaints[digest] = self.seen_complaints.get(digest, []) + tallied
+        self.comments_to_complaints[comment] = self.comments_to_complaints.get(comment, []) + complaints_returned
+        self.platform_comments_to_complaints[comment] = self.platform_comments_to_complaints.get(comment, []) + complaints_returned
+
+    def tally_repeat(self, comment, platform, digest=None):
+        ## a comment we've already seen (or a repost of it, on either platform) counts again without asking the model
+        complaints_seen = self.seen_complaints[digest or comment_digest(comment)]
+        for complaint in complaints_seen:
+            self.complaints[complaint] = self.complaints.get(complaint, 0) + 1
+        self.comments_to_complaints.setdefault(comment, complaints_seen)
+        if self.store is not None:
+            self.store.record_votes(comment, platform, [(complaint, 1) for complaint in complaints_seen], COMPLAINTS_TALLY)
+
+    def save_progress(self, platform):
+        with self.metrics.timer("disk_write"):
+            if self.store is not None:
+                self.store.commit()
+            if self.complaint_index is not None:
+                self.complaint_index.flush()
+            ## write the tallies to a file for each comment
+            with open(f"current_vote_tally.json", "w") as f:
+                json.dump(self.complaints, f)
+
+            with open(f"current_comments_to_complaints_{platform}.json", "w") as f:
+                json.dump(self.comments_to_complaints, f)
+
+            with open(f"current_comments_to_complaints.json", "w") as f:
+                json.dump(self.comments_to_complaints, f)
+
+            with open(f"current_comments_to_complaints_{platform}.json", "w") as f:
+                json.dump(self.comments_to_complaints, f)
+
+            with open(f"complaints.json", "w") as f:
+                json.dump(self.complaints, f)
+
+    def stream_answer(self, request):
+        ## stream the response, skipping the <think> section instead of waiting for the whole thing and stripping it afterwards
+        started = time.monotonic()
+        first_useful_token = None
+        reasoning_tokens = 0
+        state = "start"  # until we know whether the reply opens with <think>, then "think" or "answer"
+        pending = ""
+        answer = []
+        usage = None
+        stream = self.endpoints.create(**request, stream=True, stream_options={"include_usage": True})
+        try:
+            for chunk in stream:
+                ## the usage comes in a last chunk without choices
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                ## some servers send the reasoning separately from the content
+                reasoning = getattr(delta, "reasoning_content", None)
+                if reasoning:
+                    reasoning_tokens += self.count_tokens(reasoning)
+                pending += delta.content or ""
+                if state == "start":
+                    stripped = pending.lstrip()
+                    if stripped.startswith("<think>"):
+                        state = "think"
+                        pending = stripped[len("<think>"):]
+                    elif stripped and not "<think>".startswith(stripped):
+                        state = "answer"
+                if state == "think":
+                    end = pending.find("</think>")
+                    if end == -1:
+                        ## count everything but a tail that could be the start of </think>
+                        keep = len("</think>") - 1
+                        if len(pending) > keep:
+                            reasoning_tokens += self.count_tokens(pending[:-keep])
+                            pending = pending[-keep:]
+                    else:
+                        reasoning_tokens += self.count_tokens(pending[:end])
+                        pending = pending[end + len("</think>"):]
+                        state = "answer"
+                if reasoning_tokens > self.max_reasoning_tokens:
+                    raise ReasoningBudgetExceeded(f"Model reasoned for more than {self.max_reasoning_tokens} tokens")
+                if state == "answer" and pending:
+                    if first_useful_token is None and pending.strip():
+                        first_useful_token = time.monotonic() - started
+                    answer.append(pending)
+                    pending = ""
+        finally:
+            stream.close()
+        if state == "start":
+            answer.append(pending)
+        self.metrics.count("streamed_reasoning_tokens", reasoning_tokens)
+        if first_useful_token is None:
+            print(f"{reasoning_tokens} reasoning tokens, no answer after {time.monotonic() - started:.2f}s")
         else:
-            chunks = [comment]
-            
-            
+            self.metrics.observe("first_useful_token", first_useful_token)
+            print(f"{reasoning_tokens} reasoning tokens, first useful token after {first_useful_token:.2f}s")
+        ## shaped like a normal response so it can be parsed and cached the same way
+        from openai.types.chat import ChatCompletion
+        return ChatCompletion.model_validate({
+            "id": "stream",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "".join(answer)}
+            }],
+            "usage": usage.model_dump() if usage is not None else None
+        })
+
+    def stream_completion(self, request):
+        try:
+            return self.stream_answer(request)
+        except ReasoningBudgetExceeded as e:
+            print(f"{e}, asking again without thinking")
+            self.metrics.count("reasoning_budget_exceeded")
+            messages = request["messages"][:-1] + [dict(request["messages"][-1], content=request["messages"][-1]["content"] + NO_THINKING_INSTRUCTION)]
+            return self.stream_answer(dict(request, messages=messages))
+
+    def create_completion(self, texts, candidates, request, validate=None):
+        ## reuse the cached response for the same model, prompt version, comments and candidate complaints
+        ## (a JSON answer is only cached if validate accepts its content); each reply is tallied before the
+        ## next prompt is built, so the catalog shown here is the same on every run over the same comments
+        shown = self.catalog.complaints if candidates is None else candidates
+        answer_format = "tools" if "tools" in request else "json" if "response_format" in request else ""
+        key = cache_key(request["model"], PROMPT_TEMPLATE_VERSION, [comment_digest(text) for text in texts], shown,
+                        extra=answer_format)
+        if self.response_cache is not None:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                print("Using cached response")
+                self.metrics.count("cache_hits")
+                from openai.types.chat import ChatCompletion
+                return ChatCompletion.model_validate(cached)
+        with self.metrics.timer("model"):
+            if self.stream_responses and not answer_format:
+                response = self.stream_completion(request)
+            else:
+                response = self.endpoints.create(**request)
+        self.metrics.count("requests")
+        self.metrics.record_usage(response.usage)
+        self.metrics.count("tool_calls", len(response.choices[0].message.tool_calls or []))
+        message = response.choices[0].message
+        if self.response_cache is not None and (message.content or message.tool_calls) and self.valid(message, validate):
+            self.response_cache.put(key, response.model_dump())
+        return response
+
+    def valid(self, message, validate):
+        if validate is None:
+            return True
+        try:
+            validate(message.content)
+        except InvalidOutput:
+            return False
+        return True
+
+    def answer_complaints(self, answer):
+        ## the listed complaints by id, then the new ones, as tally_complaints takes them
+        return [self.catalog[complaint_id] for complaint_id in answer["complaint_ids"]] + answer["new_complaints"]
+
+    def structured_batch_answer(self, batch, candidates, messages):
+        ## the valid JSON answers for a batch by comment id; only a reply that answers every comment is cached
+        def validate(content):
+            if len(parse_batch_answer(content, len(self.catalog), len(batch))) < len(batch):
+                raise InvalidOutput("some comments are missing")
+
+        request = dict(model=self.model, messages=messages,
+                       response_format=response_format(len(self.catalog), len(batch)))
+        response = self.create_completion(batch, candidates, request, validate)
+        try:
+            answers = parse_batch_answer(response.choices[0].message.content, len(self.catalog), len(batch))
+        except InvalidOutput as e:
+            answers = {}
+            print(f"Invalid reply ({e})")
+        if len(answers) < len(batch):
+            print(f"{len(batch) - len(answers)} of {len(batch)} comments not answered, asking about them one at a time")
+        return answers
+
+    def structured_answer(self, chunk, candidates, messages):
+        ## a JSON answer for one chunk; an invalid reply goes back to the model with the validator's error, up to max_repairs times
+        request = dict(model=self.model, messages=messages, response_format=response_format(len(self.catalog)))
+        response = self.create_completion([chunk], candidates, request,
+                                          lambda content: parse_answer(content, len(self.catalog)))
+        for attempt in range(self.max_repairs + 1):
+            content = response.choices[0].message.content or ""
+            try:
+                answer = parse_answer(content, len(self.catalog))
+            except InvalidOutput as e:
+                if attempt == self.max_repairs:
+                    raise
+                print(f"Invalid reply ({e}), asking again")
+                self.metrics.count("repairs")
+                with self.metrics.timer("model"):
+                    response = self.endpoints.create(**dict(request, messages=repair_messages(messages, content, str(e))))
+                self.metrics.count("requests")
+                self.metrics.record_usage(response.usage)
+                continue
+            if attempt:
+                self.metrics.count("repaired")
+            print(content)
+            return self.answer_complaints(answer)
+
+    def chunks(self, comment):
+        with self.metrics.timer("tokenize"):
+            return self.count_tokens.chunks(comment, self.max_comment_tokens, self.chunk_overlap_tokens)
+
+    def process_comment(self, comment, platform):
+        chunks = self.chunks(comment)
+        print(f"Processing {comment_ref(comment)}, {self.count_tokens(comment)} tokens in {len(chunks)} chunk(s)")
+
         for chunk in chunks:
                 try:
-                    
-                    complaints_list = list(complaints.keys())
-
-                    prompt = f"""
-                    It's your role to normalize the complaints in my comments. You'll review each comment thread one at a time and come up with a normalized version of the complaint.
-
-                    Here are the complaints you've seen so far:
-                    {"\n- ".join(complaints_list)}.
-
-                    Here is the comment you're reviewing:
-                    {comment}
-
-                    You need to normalize the complaint to one or more of the complaints in the list, OR, if the complaint is not in the list, you need to add a new complaint to the list.
-
-                    The end goal is to have a vote tally of all the complaints in the list, where slight variations, different ways of saying the same thing, and other variations are all counted as the same complaint. If it's meaningfully different, add another complaint to the list.
-                    
-                    Each sentence you return will be considered a separate complaint, so each complaint should only be a single sentence. A script will parse the output and split on the . character.
-                    
-                    Eventually, a video will be made for each complaint by me, a content creator, to whom these comments are addressed, in order according to the vote tally (so please only return new complaints if they are not in the list, not if they're only slightly different).
-
-                    Either return one or more of the normalized complaints EXACTLY as it appears in the list, or add a new complaint to the list by returning a new sentence that is a complaint. 
-                    These will be added as keys to a dictionary data structure in python that will be used to tally the complaints.
-                    Do not return any other text than the normalized complaints, such as "The AI art issue maps directly to an existing entry" or "The Memphis environmental justice example fits under "Data centers are harming ecosystems"" as this will cause the script to log these as separate complaints due to the extra text.
-                    """
-                    print(prompt)
-
-                    response = client.chat.completions.create(
-                        model="qwq-32b-mlx",
-                        messages=[{"role": "user", "content": prompt}]   
-                    )
-                    complaint = response.choices[0].message.content
-                    ## strip out the <think> and </think> tags and all content in between them
-                    think_start = complaint.find("<think>")
-                    think_end = complaint.find("</think>")
-                    if think_start != -1 and think_end != -1:
-                        complaint = complaint[think_end+len("</think>"):]
-                    complaint = complaint.strip()
-                    ## now split on the . character
-                    complaints_returned = complaint.split(".")
-                    ## some complaints aren't given with . at the end, so we'll see 2 spaces, we should split on 2 spaces as well, but not all elements will have 2 spaces
-                    double_spaced_complaints = [complaint_returned.split("  ") for complaint_returned in complaints_returned if "  " in complaint_returned]
-                    complaints_returned = [complaint_returned for complaint_returned in complaints_returned if "  " not in complaint_returned]
-                    complaints_returned = complaints_returned + [item for sublist in double_spaced_complaints for item in sublist]
-                    
-                    for complaint_returned in complaints_returned:
-                        complaint_returned = complaint_returned.strip()
-                        complaint_returned = complaint_returned.replace("\n", "")
-                        complaints[complaint_returned] = complaints.get(complaint_returned, 0) + 1
-                    comments_to_complaints[comment] = comments_to_complaints.get(comment, []) + complaints_returned 
-                    platform_comments_to_complaints[comment] = platform_comments_to_complaints.get(comment, []) + complaints_returned 
-                    ## write the tallies to a file for each comment
-                    with open(f"current_vote_tally.json", "w") as f:
-                        json.dump(complaints, f)
-                    
-                    with open(f"current_comments_to_complaints_{platform}.json", "w") as f:
-                        json.dump(comments_to_complaints, f)
-                    
-                    with open(f"current_comments_to_complaints.json", "w") as f:
-                        json.dump(comments_to_complaints, f)
-                        
-                    with open(f"current_comments_to_complaints_{platform}.json", "w") as f:
-                        json.dump(comments_to_complaints, f)
-                        
-                    with open(f"complaints.json", "w") as f:
-                        json.dump(complaints, f)
-
-                        print(response.choices[0].message.content)
+                    with self.metrics.timer("prompt_build"):
+                        candidates = self.candidate_complaints([chunk])
+                        messages = self.prompts.messages(chunk, candidates)
+
+                    if self.structured_output:
+                        self.tally_complaints(comment, self.structured_answer(chunk, candidates, messages), platform)
+                        self.save_progress(platform)
+                        continue
+
+                    response = self.create_completion([chunk], candidates, dict(
+                        model=self.model,
+                        messages=messages
+                    ))
+                    self.tally_complaints(comment, parse_complaints(response.choices[0].message.content), platform)
+                    self.save_progress(platform)
+                    print(response.choices[0].message.content)
                 except Exception as e:
                     print(f"Error processing comment: {e}")
-                    print(f"Comment: {comment}")
+                    print(f"Failed {comment_ref(chunk)}")
+                    self.metrics.count("failed_comments")
+                    continue
+        self.metrics.maybe_report()
+
+    def dedup_digest(self, comment):
+        ## near-duplicates share their cluster representative's digest
+        return self.near_duplicates.get(comment) or comment_digest(comment)
+
+    def unprocessed_comments(self, comments, platform):
+        ## collect the comments we haven't seen yet, counting repeats so they can be tallied once the first copy is processed
+        unprocessed = []
+        repeats = {}
+        for comment in comments:
+            digest = self.dedup_digest(comment)
+            if digest in self.seen_complaints:
+                self.tally_repeat(comment, platform, digest)
+            elif digest in repeats:
+                repeats[digest].append(comment)
+            else:
+                repeats[digest] = []
+                unprocessed.append(comment)
+        return unprocessed, repeats
+
+    def process_batches(self, comments, platform):
+        unprocessed, repeats = self.unprocessed_comments(comments, platform)
+        for batch in pack_batches(unprocessed, self.count_tokens, self.max_batch_tokens, self.max_batch_comments):
+            if len(batch) == 1:
+                ## too long to share a request, or the last one left over
+                self.process_comment(batch[0], platform)
+            else:
+                try:
+                    print(f"Processing batch of {len(batch)} comments")
+                    with self.metrics.timer("prompt_build"):
+                        candidates = self.candidate_complaints(batch)
+                        messages = self.batch_prompts.messages(format_batch(batch), candidates)
+                    if self.structured_output:
+                        answers = self.structured_batch_answer(batch, candidates, messages)
+                        for comment_id, comment in enumerate(batch, 1):
+                            if comment_id in answers:
+                                self.tally_complaints(comment, self.answer_complaints(answers[comment_id]), platform)
+                        self.save_progress(platform)
+                        ## the comments the reply left out are asked about one at a time
+                        for comment_id, comment in enumerate(batch, 1):
+                            if comment_id not in answers:
+                                self.process_comment(comment, platform)
+                    else:
+                        response = self.create_completion(batch, candidates, dict(
+                            model=self.model,
+                            messages=messages,
+                            tools=batch_tools
+                        ))
+                        for comment, complaints_returned in zip(batch, parse_batch_complaints(response, batch)):
+                            self.tally_complaints(comment, complaints_returned, platform)
+                        self.save_progress(platform)
+                except Exception as e:
+                    print(f"Error processing batch: {e}")
+                    for comment in batch:
+                        print(f"Failed {comment_ref(comment)}")
+                    self.metrics.count("failed_comments", len(batch))
+                    continue
+                self.metrics.maybe_report()
+            for comment in batch:
+                digest = comment_digest(comment)
+                if digest in self.seen_complaints:
+                    for repeat in repeats[digest]:
+                        self.tally_repeat(repeat, platform, digest)
+
+    def read_comments(self, platform, folder):
+        if self.records_dir:
+            return [record_text(record) for record in iter_records(self.records_dir, platform, self.records_prefix)]
+        comments = []
+        for file in os.listdir(folder):
+            with open(os.path.join(folder, file), "r") as f:
+                comments.append(f.read())
+        return comments
+
+    def find_near_duplicates(self, comments):
+        if not self.cluster_near_duplicates:
+            return {}
+        from near_duplicates import representative_digests
+        near_duplicates = representative_digests(comments, self.near_duplicate_threshold)
+        print(f"Found {len(near_duplicates)} comments in near-duplicate clusters")
+        return near_duplicates
+
+    def run(self):
+        self.profiler.start()
+        with self.metrics.timer("read"):
+            platform_comments = [(platform, self.read_comments(platform, folder)) for platform, folder in self.platforms]
+
+        for platform, comments in platform_comments:
+            self.platform_comments_to_complaints = {}
+            print(f"Processing {platform} {len(comments)} comments")
+
+            self.comments_to_complaints = {}
+            self.near_duplicates = self.find_near_duplicates(comments)
+
+            if self.batch_mode:
+                self.process_batches(comments, platform)
+                continue
+
+            for comment in comments:
+                digest = self.dedup_digest(comment)
+                if digest in self.seen_complaints:
+                    self.tally_repeat(comment, platform, digest)
                     continue
+                self.process_comment(comment, platform)
+
+        ## write them to a file at the end
+        with open("complaints.json", "w") as f:
+            json.dump(self.complaints, f)
+
+        with open("comments_to_complaints.json", "w") as f:
+            json.dump(self.comments_to_complaints, f)
+
+        self.close()
+        print(f"Metrics: {self.metrics.summary()}")
+        self.metrics.dump(self.metrics_path)
+        profile_report = self.profiler.stop()
+        if profile_report:
+            print(profile_report)
+
+    def dry_run(self):
+        ## what a run would send to the model, without creating a client or touching the tally
+        lines = []
+        seen = set()
+        for platform, folder in self.platforms:
+            comments = self.read_comments(platform, folder)
+            self.near_duplicates = self.find_near_duplicates(comments)
+            unprocessed = []
+            for comment in comments:
+                digest = self.dedup_digest(comment)
+                if digest not in seen:
+                    seen.add(digest)
+                    unprocessed.append(comment)
+            if self.batch_mode:
+                batches = list(pack_batches(unprocessed, self.count_tokens, self.max_batch_tokens, self.max_batch_comments))
+            else:
+                batches = [[comment] for comment in unprocessed]
+            requests = sum(len(self.chunks(batch[0])) if len(batch) == 1 else 1 for batch in batches)
+            tokens = sum(self.count_tokens(comment) for comment in unprocessed)
+            lines.append(f"{platform}: {len(comments)} comments, {len(unprocessed)} to send in {requests} requests "
+                         f"({tokens} comment tokens), {len(comments) - len(unprocessed)} repeats counted without the model")
+        return "\n".join(lines)
+
+    def stats(self, top=20):
+        ## the tally in complaints.json, without loading anything else
+        lines = [f"{len(self.complaints)} complaints, {sum(self.complaints.values())} votes"]
+        ranked = sorted(self.complaints.items(), key=lambda item: -item[1])[:top]
+        lines += [f"{votes:>10}  {complaint}" for complaint, votes in ranked]
+        return "\n".join(lines)
+
+    def close(self):
+        opened = self.__dict__
+        if opened.get("store") is not None:
+            self.store.close()
+        if opened.get("complaint_index") is not None:
+            self.complaint_index.flush()
+        if opened.get("response_cache") is not None:
+            print(self.response_cache.summary())
+            self.response_cache.close()
+        if "endpoints" in opened:
+            print(self.endpoints.summary())
+
+
+def parse_endpoint(value):
+    ## URL or URL,CONCURRENCY
+    url, _, concurrency = value.partition(",")
+    return url, int(concurrency or 1)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Normalize the complaints in comments and tally them")
+    parser.add_argument("--endpoint", dest="llm_endpoints", action="append", type=parse_endpoint,
+                        metavar="URL[,CONCURRENCY]", help="LM Studio / llama.cpp server, repeat for several "
+                        f"(default: {llm_endpoints[0][0]},{llm_endpoints[0][1]})")
+    parser.add_argument("--model", default=MODEL)
+    parser.add_argument("--batch", dest="batch_mode", action="store_true", default=batch_mode,
+                        help="pack several short comments into one request")
+    parser.add_argument("--max-batch-comments", type=int, default=max_batch_comments)
+    parser.add_argument("--max-batch-tokens", type=int, default=max_batch_tokens)
+    parser.add_argument("--max-comment-tokens", type=int, default=max_comment_tokens)
+    parser.add_argument("--chunk-overlap-tokens", type=int, default=chunk_overlap_tokens)
+    parser.add_argument("--retrieval", dest="use_retrieval", action="store_true", default=use_retrieval,
+                        help="show the model only the complaints most similar to each comment")
+    parser.add_argument("--retrieval-k", type=int, default=retrieval_k)
+    parser.add_argument("--embedding-model", default=embedding_model)
+    parser.add_argument("--cluster-near-duplicates", action="store_true", default=cluster_near_duplicates)
+    parser.add_argument("--near-duplicate-threshold", type=float, default=near_duplicate_threshold)
+    parser.add_argument("--cache", dest="response_cache_path", default=response_cache_path,
+                        help="response cache database")
+    parser.add_argument("--no-cache", dest="response_cache_path", action="store_const", const="",
+                        help="don't cache responses")
+    parser.add_argument("--cache-max-mb", dest="response_cache_max_mb", type=int, default=response_cache_max_mb)
+    parser.add_argument("--no-stream", dest="stream_responses", action="store_false", default=stream_responses,
+                        help="wait for whole responses instead of streaming them")
+    parser.add_argument("--max-reasoning-tokens", type=int, default=max_reasoning_tokens)
+    parser.add_argument("--structured", dest="structured_output", action="store_true", default=structured_output,
+                        help="ask for a JSON answer through response_format instead of free text")
+    parser.add_argument("--max-repairs", type=int, default=max_repairs,
+                        help="times to send an invalid JSON answer back to the model")
+    parser.add_argument("--db", dest="results_db", default=results_db, help="also record votes in this results store")
+    parser.add_argument("--aliases", dest="aliases_path", default=aliases_path)
+    parser.add_argument("--tiktok-folder", default=tiktok_folder)
+    parser.add_argument("--instagram-folder", default=instagram_folder)
+    parser.add_argument("--records", dest="records_dir", default=records_dir, metavar="DIR",
+                        help="read the parsers' JSONL records instead of the comment folders")
+    parser.add_argument("--records-prefix", default=records_prefix)
+    parser.add_argument("--metrics", dest="metrics_path", default=metrics_path)
+    parser.add_argument("--metrics-every", dest="metrics_report_every", type=float, default=metrics_report_every)
+    parser.add_argument("--profile", dest="profile_mode", choices=["cprofile", "tracemalloc"], default=profile_mode)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--dry-run", action="store_true", help="show what would be sent to the model and exit")
+    mode.add_argument("--stats", action="store_true", help="show the tally in complaints.json and exit")
+    args = parser.parse_args()
+
+    options = {key: value for key, value in vars(args).items()
+               if key not in ("dry_run", "stats") and value is not None}
+    normalizer = ComplaintNormalizer(**options)
+    if args.stats:
+        print(normalizer.stats())
+    elif args.dry_run:
+        print(normalizer.dry_run())
+    else:
+        normalizer.run()
 
-## write them to a file at the end
-with open("complaints.json", "w") as f:
-    json.dump(complaints, f)
 
-with open("comments_to_complaints.json", "w") as f:
-    json.dump(comments_to_complaints, f)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Comment Records
+Parsed comments as typed records in sharded JSONL files, an alternative to
+writing one .txt file per comment. Each parser run writes the records from one
+export into <directory>/<platform>/<export name>-NNNNN.jsonl, replacing the
+shards from an earlier run over the same export, and the LLM scripts stream the
+records back shard by shard instead of listing and opening every comment file.
+Each line is a JSON array of the FIELDS values, so field names aren't repeated
+on every line.
+"""
+
+import glob
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from comment_digest import comment_digest
+
+# Record fields, in the order they're written
+FIELDS = ("username", "content", "likes", "timestamp", "is_reply", "comments", "platform", "digest")
+
+
+def make_record(username: str, content: str, likes: int, timestamp: str, is_reply: bool,
+                platform: str, comments: int = 1) -> Dict:
+    """A comment (or an Instagram thread of `comments` comments) as a record.
+
+    The digest is the same one comment_digest gives the comment's .txt file,
+    since both normalize just the content.
+    """
+    return {
+        "username": username,
+        "content": content,
+        "likes": int(likes),
+        "timestamp": timestamp,
+        "is_reply": bool(is_reply),
+        "comments": comments,
+        "platform": platform,
+        "digest": comment_digest(content),
+    }
+
+
+def export_name(input_file: str) -> str:
+    """Shard name for an export: its file name plus a hash of its path, so same-named exports don't collide."""
+    path = os.path.abspath(input_file)
+    return f"{Path(path).stem}-{hashlib.md5(path.encode()).hexdigest()[:8]}"
+
+
+def record_text(record: Dict) -> str:
+    """The text the LLM scripts see for a record, laid out like the comment files minus the raw text."""
+    return (f"Username: {record['username']}\n"
+            f"Timestamp: {record['timestamp']}\n"
+            f"Likes: {record['likes']}\n"
+            f"Content:\n{record['content']}\n")
+
+
+def read_lines(f, chunk_size: int = 1 << 20) -> Iterator[str]:
+    """Lines of an open file, the same as text.split('\n') but reading a chunk at a time."""
+    tail = ''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        yield from lines
+    yield tail
+
+
+class RecordWriter:
+    """Writes records for one export to <directory>/<platform>/<name>-NNNNN.jsonl shards."""
+
+    def __init__(self, directory: str, platform: str, name: str, shard_size: int = 50000):
+        self.directory = Path(directory) / platform
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.platform = platform
+        self.name = name
+        self.shard_size = shard_size
+        self.shard = 0
+        self.in_shard = 0
+        self.written = 0
+        self.file = None
+        # re-parsing an export replaces its records rather than adding a second copy
+        for old in self.directory.glob(f"{glob.escape(name)}-[0-9][0-9][0-9][0-9][0-9].jsonl"):
+            old.unlink()
+
+    def __enter__(self) -> "RecordWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def write(self, record: Dict) -> None:
+        if self.file is None or self.in_shard >= self.shard_size:
+            self._next_shard()
+        self.file.write(json.dumps([record[field] for field in FIELDS], ensure_ascii=False) + "\n")
+        self.in_shard += 1
+        self.written += 1
+
+    def _next_shard(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.shard += 1
+        self.file = open(self.directory / f"{self.name}-{self.shard:05d}.jsonl", "w", encoding="utf-8")
+        self.in_shard = 0
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def iter_records(directory: str, platform: Optional[str] = None, prefix: str = "") -> Iterator[Dict]:
+    """Stream the records for a platform (or all platforms), shard by shard in name order.
+
+    prefix limits the shards read, e.g. to the ones one incremental_ingest.py run wrote.
+    """
+    root = Path(directory)
+    pattern = f"{platform or '*'}/{glob.escape(prefix)}*.jsonl"
+    for shard in sorted(root.glob(pattern)):
+        with open(shard, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    values = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn final line from an interrupted parse
+                yield dict(zip(FIELDS, values))
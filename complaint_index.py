@@ -0,0 +1,138 @@
+"""
+Complaint Index
+A local vector index over complaint strings. Instead of pasting every complaint
+into the prompt, the LLM scripts look up the k existing complaints that are most
+similar to the comment being reviewed. Embeddings come from the local
+OpenAI-compatible server (LM Studio) or, if sentence-transformers is installed,
+a CPU model. The index grows in memory as new complaints are recorded and is
+saved next to complaints.json when the caller flushes it.
+"""
+
+import os
+from pathlib import Path
+from typing import Callable, Iterable, List
+
+import numpy as np
+
+Embedder = Callable[[List[str]], List[List[float]]]
+
+
+def openai_embedder(client, model: str = "text-embedding-nomic-embed-text-v1.5") -> Embedder:
+    """Embed texts with the embeddings endpoint of an OpenAI-compatible server."""
+    def embed(texts: List[str]) -> List[List[float]]:
+        response = client.embeddings.create(model=model, input=texts)
+        return [item.embedding for item in response.data]
+    return embed
+
+
+def local_embedder(model_name: str = "all-MiniLM-L6-v2") -> Embedder:
+    """Embed texts on the CPU with sentence-transformers."""
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        raise ImportError("Local embeddings need sentence-transformers: pip install sentence-transformers")
+    model = SentenceTransformer(model_name, device="cpu")
+
+    def embed(texts: List[str]) -> List[List[float]]:
+        return model.encode(texts)
+    return embed
+
+
+class ComplaintIndex:
+    def __init__(self, embed: Embedder, path: str = "complaint_index.npz", model: str = "",
+                 batch_size: int = 64, max_query_chars: int = 2000):
+        self.embed = embed
+        self.path = Path(path)
+        self.model = model
+        self.batch_size = batch_size
+        self.max_query_chars = max_query_chars
+        self.complaints: List[str] = []
+        self.positions = {}
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        # set by add() and remove(); flush() only rewrites the file when there is something new
+        self.dirty = False
+        if self.path.exists():
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.complaints)
+
+    def __contains__(self, complaint: str) -> bool:
+        return complaint in self.positions
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts in batches and return unit-length float32 rows."""
+        rows = []
+        for i in range(0, len(texts), self.batch_size):
+            rows.extend(self.embed(texts[i:i + self.batch_size]))
+        vectors = np.asarray(rows, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def load(self) -> None:
+        """Load the saved index, ignoring it if it was built with a different embedding model."""
+        with np.load(self.path) as data:
+            if str(data["model"]) != self.model:
+                print(f"Ignoring {self.path}: built with {data['model']}, not {self.model}")
+                return
+            self.complaints = [str(c) for c in data["complaints"]]
+            self.vectors = data["vectors"].astype(np.float32)
+        self.positions = {c: i for i, c in enumerate(self.complaints)}
+
+    def save(self) -> None:
+        """Write the index atomically so a crash can't leave a half-written file."""
+        tmp_path = self.path.with_name(self.path.name + ".tmp.npz")
+        np.savez(tmp_path, model=np.array(self.model), complaints=np.array(self.complaints, dtype=str),
+                 vectors=self.vectors)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def flush(self) -> None:
+        """Save the index if complaints were added or removed since it was last saved."""
+        if self.dirty:
+            self.save()
+
+    def add(self, complaints: Iterable[str]) -> int:
+        """Embed and add any complaints that aren't indexed yet. Returns how many were added."""
+        new = list(dict.fromkeys(c for c in complaints if c and c not in self.positions))
+        if not new:
+            return 0
+        vectors = self._embed(new)
+        self.vectors = vectors if len(self.complaints) == 0 else np.vstack([self.vectors, vectors])
+        for complaint in new:
+            self.positions[complaint] = len(self.complaints)
+            self.complaints.append(complaint)
+        self.dirty = True
+        return len(new)
+
+    def remove(self, complaints: Iterable[str]) -> int:
+        """Drop complaints from the index, e.g. ones merged into another. Returns how many were removed."""
+        removed = {c for c in complaints if c in self.positions}
+        if not removed:
+            return 0
+        keep = [i for i, c in enumerate(self.complaints) if c not in removed]
+        self.complaints = [self.complaints[i] for i in keep]
+        self.vectors = self.vectors[keep]
+        self.positions = {c: i for i, c in enumerate(self.complaints)}
+        self.dirty = True
+        return len(removed)
+
+    def search(self, texts: List[str], k: int) -> List[List[str]]:
+        """Return the k most similar complaints for each text, best match first."""
+        if not self.complaints or not texts:
+            return [[] for _ in texts]
+        queries = self._embed([text[:self.max_query_chars] for text in texts])
+        scores = queries @ self.vectors.T
+        k = min(k, len(self.complaints))
+        # argpartition finds the top k in O(n); only those k get sorted
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in zip(scores, top):
+            ranked = candidates[np.argsort(-row[candidates])]
+            results.append([self.complaints[i] for i in ranked])
+        return results
+
+    def top_k(self, text: str, k: int) -> List[str]:
+        """Return the k complaints most similar to text."""
+        return self.search([text], k)[0]
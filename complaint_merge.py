@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Complaint Merge
+An offline pass that collapses near-synonymous complaints. Complaint strings
+that normalize to the same text (case, punctuation, list markers) or whose
+embeddings are very similar are merged with union-find; pairs in a grey zone of
+similarity are grouped and the LLM is asked only about those groups, to say
+which of them are the same complaint and what to call it. Every merged-away
+complaint goes into an alias table (complaint_aliases.json) that maps it
+straight to its canonical complaint, the tallies and comment-to-complaint
+mappings are rewritten through it, and the LLM scripts resolve new votes
+through it so merged complaints don't come back.
+"""
+
+import json
+import re
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from like_counts import like_votes
+from near_duplicates import UnionFind
+from vote_journal import write_json_atomic
+
+LIST_MARKER = re.compile(r'^\s*(?:[-*•]+|\d+[.)])\s+')
+PUNCTUATION = re.compile(r'[^\w\s]+')
+WHITESPACE = re.compile(r'\s+')
+
+
+def unit_weight(comment: str) -> int:
+    """The normalizer's weight for a comment: one vote per complaint."""
+    return 1
+
+
+def normalize_complaint(complaint: str) -> str:
+    """Lowercase the complaint without list markers, punctuation or extra whitespace."""
+    complaint = LIST_MARKER.sub("", complaint)
+    complaint = PUNCTUATION.sub(" ", complaint.lower())
+    return WHITESPACE.sub(" ", complaint).strip()
+
+
+class ComplaintAliases:
+    """Maps merged-away complaints to their canonical complaint, always in one lookup."""
+
+    def __init__(self, path: str = "complaint_aliases.json"):
+        self.path = Path(path)
+        self.aliases: Dict[str, str] = {}
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.aliases = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.aliases)
+
+    def __contains__(self, complaint: str) -> bool:
+        return complaint in self.aliases
+
+    def resolve(self, complaint: str) -> str:
+        return self.aliases.get(complaint, complaint)
+
+    def update(self, aliases: Dict[str, str]) -> None:
+        """Add alias -> canonical pairs, re-pointing older aliases so chains stay one lookup long."""
+        self.aliases.update({alias: canonical for alias, canonical in aliases.items() if alias != canonical})
+        flattened = {}
+        for alias in self.aliases:
+            seen = {alias}
+            canonical = self.aliases[alias]
+            while canonical in self.aliases and canonical not in seen:
+                seen.add(canonical)
+                canonical = self.aliases[canonical]
+            if canonical != alias:
+                flattened[alias] = canonical
+        self.aliases = flattened
+
+    def save(self) -> None:
+        write_json_atomic(str(self.path), self.aliases, indent=2)
+
+    def rewrite_mapping(self, comments_to_complaints: Dict[str, List[str]]) -> Dict[str, List[str]]:
+        """Resolve every comment's complaints, dropping complaints that merged into one already listed."""
+        return {
+            comment: list(dict.fromkeys(self.resolve(complaint) for complaint in complaints))
+            for comment, complaints in comments_to_complaints.items()
+        }
+
+    def rewrite_tally(self, tally: Dict[str, int], comments_to_complaints: Optional[Dict[str, List[str]]] = None,
+                      weight: Callable[[str], int] = unit_weight) -> Dict[str, int]:
+        """Sum each canonical complaint's votes from its aliases, keeping the tally's order.
+
+        The aliases are dropped where they are and every canonical complaint
+        keeps its place (one that wasn't in the tally takes its first alias's),
+        as the LLM scripts number the catalog in this order.
+
+        A comment that named two complaints which are now one would count twice,
+        so the votes for every extra name are taken off again, weight(comment)
+        each, for the comments in comments_to_complaints.
+        """
+        merged: Dict[str, int] = {}
+        for complaint in tally:
+            canonical = self.resolve(complaint)
+            if canonical == complaint or canonical not in tally:
+                merged.setdefault(canonical, 0)
+        for complaint, votes in tally.items():
+            canonical = self.resolve(complaint)
+            merged[canonical] += votes
+        for comment, complaints in (comments_to_complaints or {}).items():
+            names: Dict[str, set] = {}
+            for complaint in complaints:
+                names.setdefault(self.resolve(complaint), set()).add(complaint)
+            for canonical, raw in names.items():
+                if len(raw) > 1 and canonical in merged:
+                    merged[canonical] -= weight(comment) * (len(raw) - 1)
+        return merged
+
+
+def similar_pairs(vectors: np.ndarray, threshold: float, block: int = 1024) -> Iterable[Tuple[int, int, float]]:
+    """Yield (i, j, similarity) for i < j with cosine similarity >= threshold, one block of rows at a time."""
+    for start in range(0, len(vectors), block):
+        scores = vectors[start:start + block] @ vectors.T
+        rows, cols = np.nonzero(scores >= threshold)
+        keep = cols > rows + start
+        for row, col in zip(rows[keep], cols[keep]):
+            yield int(row) + start, int(col), float(scores[row, col])
+
+
+def find_complaint_clusters(complaints: Sequence[str], vectors: Optional[np.ndarray] = None,
+                            merge_threshold: float = 0.92, ambiguous_threshold: float = 0.85,
+                            max_group: int = 20) -> Tuple[List[List[int]], List[List[List[int]]]]:
+    """Cluster complaint indices. Returns (clusters, ambiguous groups).
+
+    Complaints with the same normalized text, or with embeddings at least
+    merge_threshold similar, form the clusters. Clusters joined by a
+    similarity between ambiguous_threshold and merge_threshold are grouped,
+    strongest links first and up to max_group clusters per group, for the LLM
+    to decide. Without vectors only the normalized text is used.
+    """
+    union_find = UnionFind(len(complaints))
+    by_key: Dict[str, int] = {}
+    for i, complaint in enumerate(complaints):
+        key = normalize_complaint(complaint)
+        if key:
+            union_find.union(by_key.setdefault(key, i), i)
+    uncertain = []
+    if vectors is not None and len(complaints):
+        for i, j, score in similar_pairs(vectors, ambiguous_threshold):
+            if score >= merge_threshold:
+                union_find.union(i, j)
+            else:
+                uncertain.append((score, i, j))
+
+    clusters: Dict[int, List[int]] = {}
+    for i in range(len(complaints)):
+        clusters.setdefault(union_find.find(i), []).append(i)
+
+    # group the clusters the uncertain links join, without letting a chain of links grow a group past max_group
+    groups = UnionFind(len(complaints))
+    sizes = {root: 1 for root in clusters}
+    for _, i, j in sorted(uncertain, reverse=True):
+        root_i, root_j = groups.find(union_find.find(i)), groups.find(union_find.find(j))
+        if root_i != root_j and sizes[root_i] + sizes[root_j] <= max_group:
+            groups.union(root_i, root_j)
+            sizes[groups.find(root_i)] = sizes[root_i] + sizes[root_j]
+    ambiguous: Dict[int, List[List[int]]] = {}
+    for root, members in clusters.items():
+        ambiguous.setdefault(groups.find(root), []).append(members)
+    return list(clusters.values()), [group for group in ambiguous.values() if len(group) > 1]
+
+
+label_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "merge_complaints",
+            "description": "Records a set of complaints from the list that say the same thing, and the wording to keep",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "complaint_ids": {
+                        "type": "array",
+                        "items": {"type": "integer"},
+                        "description": "The ids of the complaints that are the same complaint"
+                    },
+                    "label": {
+                        "type": "string",
+                        "description": "One normalized sentence for the merged complaint"
+                    }
+                },
+                "required": ["complaint_ids", "label"]
+            }
+        }
+    }
+]
+
+
+def build_label_prompt(candidates: Sequence[str]) -> str:
+    complaints_list = "\n".join(f"[{i}] {complaint}" for i, complaint in enumerate(candidates))
+    return f"""
+            These complaints were collected from comments on videos about AI. Some of them may say the same thing in different words.
+
+            {complaints_list}
+
+            Call merge_complaints once for every set of two or more complaints that make the same complaint, with their ids and one normalized sentence for it.
+            Only merge complaints that are really the same; if a complaint is meaningfully different, leave it out. If none of them are the same, don't call the tool.
+            """
+
+
+def label_groups(groups: List[List[str]], create: Callable, model: str) -> List[Tuple[List[str], str]]:
+    """Ask the model which complaints in each group are the same; returns (complaints, label) merges."""
+    merges = []
+    for candidates in groups:
+        response = create(
+            model=model,
+            messages=[{"role": "user", "content": build_label_prompt(candidates)}],
+            tools=label_tools
+        )
+        for tool_call in response.choices[0].message.tool_calls or []:
+            if tool_call.function.name != "merge_complaints":
+                continue
+            try:
+                args = json.loads(tool_call.function.arguments)
+            except json.JSONDecodeError:
+                continue
+            members = []
+            for complaint_id in args.get("complaint_ids") or []:
+                try:
+                    complaint_id = int(complaint_id)
+                except (TypeError, ValueError):
+                    continue
+                if 0 <= complaint_id < len(candidates):
+                    members.append(candidates[complaint_id])
+            members = list(dict.fromkeys(members))
+            label = args.get("label")
+            if len(members) > 1:
+                merges.append((members, label.strip() if isinstance(label, str) and label.strip() else ""))
+    return merges
+
+
+def merge_aliases(complaints: Sequence[str], tally: Dict[str, int], vectors: Optional[np.ndarray] = None,
+                  create: Optional[Callable] = None, model: str = "qwq-32b-mlx",
+                  merge_threshold: float = 0.92, ambiguous_threshold: float = 0.85,
+                  max_group: int = 20) -> Dict[str, str]:
+    """Return alias -> canonical complaint for the complaints that should be merged.
+
+    A cluster's canonical complaint is its most-voted one. Ambiguous groups are
+    only merged if create (a chat.completions.create) is given; the model's
+    label becomes the canonical complaint of what it merges.
+    """
+    clusters, ambiguous = find_complaint_clusters(complaints, vectors, merge_threshold, ambiguous_threshold, max_group)
+
+    def most_voted(members: Iterable[str]) -> str:
+        return max(members, key=lambda complaint: tally.get(complaint, 0))
+
+    canonical = {}
+    for cluster in clusters:
+        members = [complaints[i] for i in cluster]
+        name = most_voted(members)
+        canonical.update({complaint: name for complaint in members})
+
+    if create is not None and ambiguous:
+        groups = [[canonical[complaints[cluster[0]]] for cluster in group] for group in ambiguous]
+        print(f"Asking the model about {len(groups)} ambiguous groups of complaints")
+        for members, label in label_groups(groups, create, model):
+            label = label or most_voted(members)
+            for complaint, name in list(canonical.items()):
+                if name in members:
+                    canonical[complaint] = label
+    return {alias: name for alias, name in canonical.items() if alias != name}
+
+
+def embed_complaints(complaints: Sequence[str], index) -> np.ndarray:
+    """Unit vectors for the complaints from a ComplaintIndex, embedding any it doesn't have yet."""
+    index.add(complaints)
+    return index.vectors[[index.positions[complaint] for complaint in complaints]]
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Merge near-synonymous complaints into canonical ones")
+    parser.add_argument("--voter", action="store_true",
+                        help="merge the like voter's vote_checkpoint.json instead of complaints.json")
+    parser.add_argument("--aliases", default="complaint_aliases.json", help="alias table to read and extend")
+    parser.add_argument("--merge-threshold", type=float, default=0.92,
+                        help="embedding similarity at which complaints are merged without asking")
+    parser.add_argument("--ambiguous-threshold", type=float, default=0.85,
+                        help="embedding similarity from which the model is asked whether complaints are the same")
+    parser.add_argument("--string-only", action="store_true", help="only merge complaints whose normalized text is equal")
+    parser.add_argument("--no-llm", action="store_true", help="don't ask the model about ambiguous groups")
+    parser.add_argument("--base-url", default="http://127.0.0.1:1234/v1", help="OpenAI-compatible server")
+    parser.add_argument("--model", default="qwq-32b-mlx")
+    parser.add_argument("--embedding-model", default="text-embedding-nomic-embed-text-v1.5")
+    parser.add_argument("--index", default="complaint_index.npz", help="embedding index shared with the LLM scripts")
+    parser.add_argument("--db", help="also merge the complaints in this results database")
+    parser.add_argument("--queue", default="work_queue.db",
+                        help="the like voter's work queue; its tally isn't merged, so nothing is while it exists")
+    parser.add_argument("--dry-run", action="store_true", help="print the merges without writing anything")
+    args = parser.parse_args()
+
+    if Path(args.queue).exists():
+        print(f"{args.queue} holds a work queue run's tally, which this doesn't rewrite; "
+              "merge before seeding the queue, or move the queue aside once its tally is exported")
+        return
+    if args.voter:
+        with open("vote_checkpoint.json", "r") as f:
+            checkpoint = json.load(f)
+        tally, comments_to_complaints = checkpoint["complaints"], checkpoint["comments_to_complaints"]
+        weight = like_votes
+        if Path("vote_journal.jsonl").exists() and Path("vote_journal.jsonl").stat().st_size:
+            print("vote_journal.jsonl has votes that aren't in the checkpoint yet; "
+                  "finish or resume the like voter run first")
+            return
+    else:
+        with open("complaints.json", "r") as f:
+            tally = json.load(f)
+        comments_to_complaints = {}
+        if Path("comments_to_complaints.json").exists():
+            with open("comments_to_complaints.json", "r") as f:
+                comments_to_complaints = json.load(f)
+        weight = unit_weight
+
+    aliases = ComplaintAliases(args.aliases)
+    # apply earlier merges first, so only complaints added since then are clustered again
+    tally = aliases.rewrite_tally(tally, comments_to_complaints, weight)
+    comments_to_complaints = aliases.rewrite_mapping(comments_to_complaints)
+    complaints = list(tally)
+
+    pool = None
+    if not (args.string_only and args.no_llm):
+        from endpoint_pool import EndpointPool
+        pool = EndpointPool([(args.base_url, 1)])
+    index = None
+    vectors = None
+    if not args.string_only:
+        from complaint_index import ComplaintIndex, openai_embedder
+        index = ComplaintIndex(openai_embedder(pool, args.embedding_model), args.index, model=args.embedding_model)
+        vectors = embed_complaints(complaints, index)
+        index.flush()
+    merges = merge_aliases(complaints, tally, vectors, None if args.no_llm else pool.create, args.model,
+                           args.merge_threshold, args.ambiguous_threshold)
+
+    for alias, canonical in merges.items():
+        print(f"{alias!r} -> {canonical!r}")
+    print(f"Merging {len(merges)} of {len(complaints)} complaints")
+    if args.dry_run:
+        return
+    aliases.update(merges)
+    tally = aliases.rewrite_tally(tally, comments_to_complaints, weight)
+    comments_to_complaints = aliases.rewrite_mapping(comments_to_complaints)
+    aliases.save()
+
+    if args.voter:
+        checkpoint["complaints"] = tally
+        checkpoint["comments_to_complaints"] = comments_to_complaints
+        write_json_atomic("vote_checkpoint.json", checkpoint)
+        write_json_atomic("like_weighted_complaints.json", tally, indent=2)
+        write_json_atomic("comments_to_complaints.json", comments_to_complaints, indent=2)
+    else:
+        write_json_atomic("complaints.json", tally)
+        if comments_to_complaints:
+            write_json_atomic("comments_to_complaints.json", comments_to_complaints)
+    if index is not None:
+        index.remove(list(aliases.aliases))
+        index.flush()
+    if args.db:
+        from results_store import ResultsStore
+        store = ResultsStore(args.db)
+        store.merge_complaints(aliases.aliases)
+        store.close()
+    print(f"{len(tally)} complaints left, {len(aliases)} aliases in {args.aliases}")
+
+
+if __name__ == "__main__":
+    main()
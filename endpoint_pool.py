@@ -0,0 +1,248 @@
+"""
+Endpoint Pool
+Spreads chat completion and embedding requests over several OpenAI-compatible
+servers (LM Studio, llama.cpp) so throughput grows with the number of hosts.
+Each endpoint has a concurrency weight; requests go to the healthy endpoint
+with the fewest in-flight requests for its weight. An endpoint that fails is
+marked unhealthy and the request is retried on another one, and unhealthy
+endpoints are health-checked before they are used again. Per-endpoint request
+counts and latencies are kept for the run summary. Async requests wait for an
+endpoint to have fewer in-flight requests than its weight, unless something in
+front of the pool (adaptive_concurrency.py) already decides how many are in
+flight and cap_in_flight is turned off.
+"""
+
+import asyncio
+import statistics
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, OpenAI
+
+
+class NoHealthyEndpoints(Exception):
+    pass
+
+
+class Endpoint:
+    def __init__(self, base_url: str, weight: int = 1, api_key: str = "lm-studio", timeout: float = 600.0):
+        self.base_url = base_url
+        self.weight = max(1, weight)
+        # the pool retries on another endpoint, so the clients don't retry themselves
+        self.client = OpenAI(base_url=base_url, api_key=api_key, timeout=timeout, max_retries=0)
+        self.async_client = AsyncOpenAI(base_url=base_url, api_key=api_key, timeout=timeout, max_retries=0)
+        self.in_flight = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.last_check = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=1000)
+
+    def load(self) -> float:
+        return self.in_flight / self.weight
+
+    def stats(self) -> Dict:
+        latencies = sorted(self.latencies)
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "mean_latency": statistics.fmean(latencies) if latencies else 0.0,
+            "p50_latency": latencies[len(latencies) // 2] if latencies else 0.0,
+            "p95_latency": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+        }
+
+
+def is_retryable(error: Exception) -> bool:
+    """Connection problems, timeouts and server errors are worth retrying elsewhere; bad requests aren't."""
+    if isinstance(error, APIConnectionError):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+class _Embeddings:
+    """Lets the pool stand in for a client in complaint_index.openai_embedder."""
+
+    def __init__(self, pool: "EndpointPool"):
+        self.pool = pool
+
+    def create(self, **request):
+        return self.pool.call(lambda client: client.embeddings.create(**request))
+
+
+class EndpointPool:
+    def __init__(self, endpoints: Sequence[Tuple[str, int]], api_key: str = "lm-studio",
+                 max_failures: int = 3, health_check_interval: float = 30.0, timeout: float = 600.0):
+        if not endpoints:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        self.endpoints = [Endpoint(url, weight, api_key, timeout) for url, weight in endpoints]
+        self.max_failures = max_failures
+        self.health_check_interval = health_check_interval
+        self.embeddings = _Embeddings(self)
+        self.cap_in_flight = True
+        # async requests waiting for an endpoint below its weight, woken one per finished request
+        self.slot_waiters = deque()
+
+    @property
+    def capacity(self) -> int:
+        """Total concurrency of the healthy endpoints (of all of them if none are healthy)."""
+        healthy = [e for e in self.endpoints if e.healthy] or self.endpoints
+        return sum(e.weight for e in healthy)
+
+    def _least_loaded(self, exclude=()) -> Optional[Endpoint]:
+        candidates = [e for e in self.endpoints if e.healthy and e not in exclude]
+        return min(candidates, key=Endpoint.load, default=None)
+
+    def _due_for_check(self, endpoint: Endpoint, exclude, force: bool) -> bool:
+        return (not endpoint.healthy and endpoint not in exclude
+                and (force or time.monotonic() - endpoint.last_check >= self.health_check_interval))
+
+    def _checked(self, endpoint: Endpoint, ok: bool) -> None:
+        endpoint.last_check = time.monotonic()
+        if ok:
+            endpoint.healthy = True
+            endpoint.consecutive_failures = 0
+
+    def check_health(self, exclude=(), force: bool = False) -> None:
+        """Probe unhealthy endpoints whose last check is older than health_check_interval (all of them with force)."""
+        for endpoint in self.endpoints:
+            if self._due_for_check(endpoint, exclude, force):
+                try:
+                    endpoint.client.with_options(timeout=5.0).models.list()
+                    ok = True
+                except Exception:
+                    ok = False
+                self._checked(endpoint, ok)
+
+    async def check_health_async(self, exclude=(), force: bool = False) -> None:
+        for endpoint in self.endpoints:
+            if self._due_for_check(endpoint, exclude, force):
+                try:
+                    await endpoint.async_client.with_options(timeout=5.0).models.list()
+                    ok = True
+                except Exception:
+                    ok = False
+                self._checked(endpoint, ok)
+
+    def _pick(self, tried, last_error: Optional[Exception] = None) -> Endpoint:
+        endpoint = self._least_loaded(tried)
+        if endpoint is None:
+            raise NoHealthyEndpoints(
+                f"No healthy endpoint left among {[e.base_url for e in self.endpoints]}") from last_error
+        return endpoint
+
+    def _attempts(self) -> range:
+        # enough to give every endpoint max_failures tries before giving up on the request
+        return range(len(self.endpoints) * self.max_failures)
+
+    def _started(self, endpoint: Endpoint) -> float:
+        endpoint.in_flight += 1
+        endpoint.requests += 1
+        return time.monotonic()
+
+    async def _wait_for_slot(self) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self.slot_waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                # woken just as we were cancelled; pass the free slot on
+                self._wake_slot_waiter()
+            raise
+
+    def _wake_slot_waiter(self) -> None:
+        while self.slot_waiters:
+            future = self.slot_waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+
+    def _finished(self, endpoint: Endpoint, started: float, error: Optional[Exception] = None) -> None:
+        endpoint.in_flight -= 1
+        self._wake_slot_waiter()
+        if error is None:
+            endpoint.latencies.append(time.monotonic() - started)
+            endpoint.consecutive_failures = 0
+            return
+        endpoint.errors += 1
+        if is_retryable(error):
+            endpoint.consecutive_failures += 1
+            # a refused connection or timeout means the server is down; server errors get a few chances
+            if isinstance(error, APIConnectionError) or endpoint.consecutive_failures >= self.max_failures:
+                endpoint.healthy = False
+                endpoint.last_check = time.monotonic()
+
+    def call(self, send: Callable[[OpenAI], object]):
+        """Run send(client) on the least loaded endpoint, moving to another one if it fails."""
+        tried = set()
+        last_error = None
+        for _ in self._attempts():
+            # probe everything right away rather than fail while untried endpoints might have recovered
+            self.check_health(tried, force=self._least_loaded(tried) is None)
+            endpoint = self._pick(tried, last_error)
+            started = self._started(endpoint)
+            try:
+                result = send(endpoint.client)
+            except Exception as e:
+                self._finished(endpoint, started, e)
+                if not is_retryable(e):
+                    raise
+                if not endpoint.healthy:
+                    tried.add(endpoint)
+                last_error = e
+                continue
+            self._finished(endpoint, started)
+            return result
+        raise last_error
+
+    async def call_async(self, send: Callable[[AsyncOpenAI], object], on_start: Optional[Callable[[], None]] = None):
+        """Like call(); on_start is called each time the request is sent to an endpoint."""
+        tried = set()
+        last_error = None
+        for _ in self._attempts():
+            await self.check_health_async(tried, force=self._least_loaded(tried) is None)
+            endpoint = self._pick(tried, last_error)
+            # wait for a free slot if every endpoint is at its weight
+            while self.cap_in_flight and endpoint.in_flight >= endpoint.weight:
+                await self._wait_for_slot()
+                endpoint = self._pick(tried, last_error)
+            if on_start is not None:
+                on_start()
+            started = self._started(endpoint)
+            try:
+                result = await send(endpoint.async_client)
+            except Exception as e:
+                self._finished(endpoint, started, e)
+                if not is_retryable(e):
+                    raise
+                if not endpoint.healthy:
+                    tried.add(endpoint)
+                last_error = e
+                continue
+            self._finished(endpoint, started)
+            return result
+        raise last_error
+
+    def create(self, **request):
+        """chat.completions.create on the least loaded endpoint."""
+        return self.call(lambda client: client.chat.completions.create(**request))
+
+    async def acreate(self, on_start: Optional[Callable[[], None]] = None, **request):
+        return await self.call_async(lambda client: client.chat.completions.create(**request), on_start)
+
+    def stats(self) -> List[Dict]:
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+    def summary(self) -> str:
+        return "\n".join(
+            f"{s['base_url']}: {s['requests']} requests, {s['errors']} errors, "
+            f"latency mean {s['mean_latency']:.2f}s p50 {s['p50_latency']:.2f}s p95 {s['p95_latency']:.2f}s"
+            f"{'' if s['healthy'] else ' (unhealthy)'}"
+            for s in self.stats()
+        )
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Incremental Ingest
+Re-ingests refreshed comment exports without re-emitting what was already
+parsed. A SQLite manifest remembers every export's size, modification time and
+SHA-256, and the username, digest and like count of every comment taken from
+them. Unchanged exports are skipped without parsing; changed ones are parsed,
+and only comments the manifest hasn't seen are written, as record shards named
+ingest-<run>. Comments whose like count changed are written to
+like_updates-<run>.jsonl instead, which the like voter applies to its tally
+without asking the model again.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from comment_records import RecordWriter
+from parse_comments import detect_platform, find_exports, parse_export
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+
+-- a comment is its author plus its normalized content, so reposts by other users stay separate
+CREATE TABLE IF NOT EXISTS comments (
+    username TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    likes INTEGER NOT NULL,
+    PRIMARY KEY (username, digest)
+);
+"""
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestManifest:
+    def __init__(self, path: str = "ingest_manifest.db"):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def changed(self, path: str) -> bool:
+        """Whether an export is new or differs from when it was last ingested.
+
+        Size and modification time are checked first; the file is only hashed
+        when they differ, and a touched but identical file is just re-stamped.
+        """
+        stat = os.stat(path)
+        row = self.conn.execute("SELECT size, mtime_ns, sha256 FROM sources WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return True
+        size, mtime_ns, sha256 = row
+        if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+            return False
+        if size == stat.st_size and sha256 == file_sha256(path):
+            self.conn.execute("UPDATE sources SET mtime_ns = ? WHERE path = ?", (stat.st_mtime_ns, path))
+            return False
+        return True
+
+    def mark_ingested(self, path: str) -> None:
+        stat = os.stat(path)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sources (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, file_sha256(path))
+        )
+
+    def likes(self, record: Dict) -> Optional[int]:
+        """Like count the comment was last ingested with, or None if it's new."""
+        row = self.conn.execute(
+            "SELECT likes FROM comments WHERE username = ? AND digest = ?", (record["username"], record["digest"])
+        ).fetchone()
+        return row[0] if row else None
+
+    def record(self, record: Dict) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO comments (username, digest, platform, likes) VALUES (?, ?, ?, ?)",
+            (record["username"], record["digest"], record["platform"], record["likes"])
+        )
+
+    def commit(self) -> None:
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+
+def ingest(paths: List[str], records_dir: str, manifest: IngestManifest, workers: Optional[int] = None,
+           run: Optional[str] = None) -> Dict[str, int]:
+    """Parse the changed exports and write their new comments and like changes; returns counts."""
+    run = run or time.strftime("%Y%m%d-%H%M%S")
+    started = time.perf_counter()
+    exports = []
+    for path in paths:
+        if not manifest.changed(path):
+            continue
+        platform = detect_platform(path)
+        if platform is None:
+            print(f"Skipping {path}: can't tell whether it's a TikTok or Instagram export")
+            continue
+        exports.append((path, platform))
+    counts = {"exports": len(paths), "changed": len(exports), "new": 0, "like_updates": 0, "unchanged": 0}
+
+    writers = {}
+    updates_path = Path(records_dir) / f"like_updates-{run}.jsonl"
+    updates = None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(parse_export, [path for path, _ in exports], [p for _, p in exports])
+        for (path, platform), (records, seconds, size) in zip(exports, results):
+            new = 0
+            for record in records:
+                old_likes = manifest.likes(record)
+                if old_likes is None:
+                    if platform not in writers:
+                        writers[platform] = RecordWriter(records_dir, platform, f"ingest-{run}")
+                    writers[platform].write(record)
+                    new += 1
+                elif old_likes != record["likes"]:
+                    if updates is None:
+                        updates_path.parent.mkdir(parents=True, exist_ok=True)
+                        updates = open(updates_path, "w", encoding="utf-8")
+                    updates.write(json.dumps({
+                        "run": run,
+                        "platform": platform,
+                        "username": record["username"],
+                        "digest": record["digest"],
+                        "old_likes": old_likes,
+                        "new_likes": record["likes"],
+                    }) + "\n")
+                    counts["like_updates"] += 1
+                else:
+                    counts["unchanged"] += 1
+                    continue
+                manifest.record(record)
+            # the source is only marked once its comments are written, so a crash re-ingests it
+            for writer in writers.values():
+                if writer.file is not None:
+                    writer.file.flush()
+            if updates is not None:
+                updates.flush()
+            manifest.mark_ingested(path)
+            manifest.commit()
+            counts["new"] += new
+            print(f"{path}: {len(records)} comments, {new} new in {seconds:.2f}s")
+    for writer in writers.values():
+        writer.close()
+    if updates is not None:
+        updates.close()
+    print(f"Ingested {counts['changed']} of {counts['exports']} exports in {time.perf_counter() - started:.2f}s: "
+          f"{counts['new']} new comments, {counts['like_updates']} like count changes, "
+          f"{counts['unchanged']} unchanged")
+    if counts["new"]:
+        print(f"New comments are in the ingest-{run} shards under {records_dir} "
+              f"(set records_prefix = \"ingest-{run}\" in the LLM scripts to read just these)")
+    return counts
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ingest only the new comments from refreshed exports")
+    parser.add_argument("inputs", nargs="+", help="export files, directories or glob patterns")
+    parser.add_argument("--records", default="parsed_comments", metavar="DIR", help="directory for the record shards")
+    parser.add_argument("--manifest", default="ingest_manifest.db", help="SQLite manifest of ingested exports and comments")
+    parser.add_argument("--workers", type=int, help="parser processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    paths = find_exports(args.inputs)
+    if not paths:
+        print("No export files found")
+        return
+    manifest = IngestManifest(args.manifest)
+    ingest(paths, args.records, manifest, args.workers)
+    manifest.close()
+
+
+if __name__ == "__main__":
+    main()
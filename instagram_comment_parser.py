@@ -8,19 +8,37 @@ A thread consists of consecutive comments from the same user.
 import re
 import os
 import hashlib
-from typing import List, Dict, Tuple
+from typing import Dict, Iterable, Iterator, List, Tuple
 from pathlib import Path
+from like_counts import instagram_likes
+from comment_records import RecordWriter, make_record, record_text, export_name, read_lines
+
+# Patterns used on every line, compiled once
+USERNAME_LINK = re.compile(r'\[([^\]]+)\](?:\([^)]*\))?')
+MARKDOWN_LINK = re.compile(r'\[[^\]]*\]\([^)]*\)')
+TIMESTAMP = re.compile(r'^\d+[hdm].*Reply$')
+
+
+def is_profile_picture_line(line: str) -> bool:
+    """A profile picture line, which starts a comment."""
+    return '[![' in line and 'profile picture' in line
+
 
 class InstagramCommentParser:
-    def __init__(self, output_dir: str = "/Users/annhoward/src/comment_reader/comments/instagram"):
+    def __init__(self, output_dir: str = "/Users/annhoward/src/comment_reader/comments/instagram", store=None,
+                 records_dir: str = None):
         self.output_dir = Path(output_dir)
-        self.output_dir.mkdir(parents=True, exist_ok=True)
+        # Optional ResultsStore that parsed threads are also added to
+        self.store = store
+        # With records_dir, threads are written as JSONL records (comment_records.py) instead of one file each
+        self.records_dir = records_dir
+        if records_dir is None:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
         
     def extract_username(self, text: str) -> str:
         """Extract username from profile picture line or username line."""
         # Pattern for username in markdown link format [username](url)
-        username_pattern = r'\[([^\]]+)\](?:\([^)]*\))?'
-        matches = re.findall(username_pattern, text)
+        matches = USERNAME_LINK.findall(text)
         if matches:
             # Get the last match which is usually the username
             username = matches[-1]
@@ -33,7 +51,7 @@ class InstagramCommentParser:
     def remove_markdown_links(self, text: str) -> str:
         """Remove all markdown-formatted links from the text."""
         # Pattern: [text](url)
-        return re.sub(r'\[[^\]]*\]\([^)]*\)', '', text)
+        return MARKDOWN_LINK.sub('', text)
     
     def parse_comment_block(self, lines: List[str]) -> Dict:
         """Parse a single comment block and extract relevant information."""
@@ -44,35 +62,28 @@ class InstagramCommentParser:
             'username': '',
             'content': '',
             'timestamp': '',
-            'likes': '',
+            'likes': 0,
             'is_reply': False,
             'raw_text': '\n'.join(lines)
         }
         
         # Check if this is a reply (indented or has "Hide replies" nearby)
-        first_line = lines[0] if lines else ""
         comment_data['is_reply'] = (
-            first_line.strip().startswith('- [![') or 
+            lines[0].strip().startswith('- [![') or 
             any('Hide replies' in line for line in lines[:5])
         )
         
         # Extract username from profile picture line or username line
-        for i, line in enumerate(lines[:3]):  # Check first 3 lines for username
-            if '[![' in line and 'profile picture' in line:
-                username = self.extract_username(line)
-                if username:
-                    comment_data['username'] = username
-                    break
-            elif line.strip().startswith('[') and '](' in line and not 'profile picture' in line:
+        for line in lines[:3]:  # Check first 3 lines for username
+            if is_profile_picture_line(line) or (
+                    line.strip().startswith('[') and '](' in line and not 'profile picture' in line):
                 username = self.extract_username(line)
                 if username:
                     comment_data['username'] = username
                     break
         
-        # Extract comment content (skip profile pic and username lines)
+        # Extract comment content (skip profile pic and username lines) in a single pass
         content_lines = []
-        skip_next = False
-        
         for line in lines:
             line = line.strip()
             if not line:
@@ -87,8 +98,9 @@ class InstagramCommentParser:
                 continue
                 
             # Skip timestamp/engagement lines
-            if re.match(r'^\d+[hdm].*Reply$', line) or 'likes' in line.lower():
+            if (line[0].isdigit() and TIMESTAMP.match(line)) or 'likes' in line.lower():
                 comment_data['timestamp'] = line
+                comment_data['likes'] = instagram_likes(line)
                 continue
                 
             # Skip navigation elements
@@ -96,58 +108,64 @@ class InstagramCommentParser:
                 continue
                 
             # Remove markdown links from the line
-            line = self.remove_markdown_links(line)
+            if '](' in line:
+                line = self.remove_markdown_links(line)
             # This is likely content
             content_lines.append(line)
         
         comment_data['content'] = '\n'.join(content_lines)
         return comment_data
     
-    def split_into_comment_blocks(self, text: str) -> List[List[str]]:
-        """Split the text into individual comment blocks."""
-        lines = text.split('\n')
-        comment_blocks = []
+    def iter_comment_blocks(self, lines: Iterable[str]) -> Iterator[List[str]]:
+        """Yield comment blocks as each one closes; lines before the first comment are skipped."""
         current_block = []
         
         for line in lines:
             # Start of a new comment (profile picture line)
-            if '[![' in line and 'profile picture' in line:
+            if is_profile_picture_line(line):
                 if current_block:
-                    comment_blocks.append(current_block)
+                    yield current_block
                 current_block = [line]
-            else:
-                if current_block:  # Only add to block if we've started one
-                    current_block.append(line)
+            elif current_block:  # Only add to block if we've started one
+                current_block.append(line)
         
         # Don't forget the last block
         if current_block:
-            comment_blocks.append(current_block)
-            
-        return comment_blocks
+            yield current_block
     
-    def group_into_threads(self, comments: List[Dict]) -> List[List[Dict]]:
-        """Group consecutive comments from the same user into threads."""
-        if not comments:
-            return []
-            
-        threads = []
-        current_thread = [comments[0]]
+    def split_into_comment_blocks(self, text: str) -> List[List[str]]:
+        """Split the text into individual comment blocks."""
+        return list(self.iter_comment_blocks(text.split('\n')))
+    
+    def iter_threads(self, comments: Iterable[Dict]) -> Iterator[List[Dict]]:
+        """Yield each thread of consecutive comments from the same user once the next one starts."""
+        current_thread = []
         
-        for comment in comments[1:]:
+        for comment in comments:
             # If same username and not a reply, continue the thread
-            if (comment['username'] == current_thread[-1]['username'] and 
+            if (current_thread and comment['username'] == current_thread[-1]['username'] and 
                 not comment['is_reply']):
                 current_thread.append(comment)
             else:
                 # Start a new thread
-                threads.append(current_thread)
+                if current_thread:
+                    yield current_thread
                 current_thread = [comment]
         
         # Don't forget the last thread
         if current_thread:
-            threads.append(current_thread)
-            
-        return threads
+            yield current_thread
+    
+    def group_into_threads(self, comments: List[Dict]) -> List[List[Dict]]:
+        """Group consecutive comments from the same user into threads."""
+        return list(self.iter_threads(comments))
+    
+    def iter_comments(self, f) -> Iterator[Dict]:
+        """Stream parsed comments with a username from an open export file."""
+        for block in self.iter_comment_blocks(read_lines(f)):
+            comment_data = self.parse_comment_block(block)
+            if comment_data and comment_data['username']:
+                yield comment_data
     
     def sanitize_filename(self, username: str, content_preview: str) -> str:
         """Create a safe filename from username and content preview."""
@@ -171,6 +189,10 @@ class InstagramCommentParser:
         
         return f"{filename}.txt"
     
+    def thread_likes(self, thread: List[Dict]) -> int:
+        """Like count for a thread: its most-liked comment's likes."""
+        return max((comment['likes'] for comment in thread), default=0)
+    
     def format_thread_content(self, thread: List[Dict]) -> str:
         """Format a thread for saving to file."""
         if not thread:
@@ -179,6 +201,7 @@ class InstagramCommentParser:
         username = thread[0]['username']
         header = f"=== THREAD: {username} ===\n"
         header += f"Comments: {len(thread)}\n"
+        header += f"Likes: {self.thread_likes(thread)}\n"
         header += "=" * 50 + "\n\n"
         
         content = header
@@ -188,6 +211,7 @@ class InstagramCommentParser:
             content += f"Username: {comment['username']}\n"
             content += f"Is Reply: {comment['is_reply']}\n"
             content += f"Timestamp: {comment['timestamp']}\n"
+            content += f"Likes: {comment['likes']}\n"
             content += f"Content:\n{comment['content']}\n"
             content += f"\nRaw Text:\n{comment['raw_text']}\n"
             content += "-" * 30 + "\n\n"
@@ -195,10 +219,9 @@ class InstagramCommentParser:
         return content
     
     def parse_file(self, input_file: str) -> None:
-        """Parse the input file and create thread files."""
+        """Parse the input file and create thread files, streaming one thread at a time."""
         try:
-            with open(input_file, 'r', encoding='utf-8') as f:
-                text = f.read()
+            f = open(input_file, 'r', encoding='utf-8')
         except FileNotFoundError:
             print(f"Error: File {input_file} not found")
             return
@@ -208,59 +231,90 @@ class InstagramCommentParser:
             
         print(f"Parsing file: {input_file}")
         
-        # Split into comment blocks
-        comment_blocks = self.split_into_comment_blocks(text)
-        print(f"Found {len(comment_blocks)} comment blocks")
-        
-        # Parse each block
-        comments = []
-        for block in comment_blocks:
-            comment_data = self.parse_comment_block(block)
-            if comment_data and comment_data['username']:
-                comments.append(comment_data)
-        
-        print(f"Successfully parsed {len(comments)} comments")
-        
-        # Group into threads
-        threads = self.group_into_threads(comments)
-        print(f"Organized into {len(threads)} threads")
+        if self.records_dir is not None:
+            with f:
+                self.write_records(input_file, f)
+            return
         
-        # Save each thread
+        # Save each thread as soon as the next one starts
+        thread_count = 0
         saved_count = 0
-        for thread in threads:
-            if not thread:
-                continue
+        with f:
+            for thread in self.iter_threads(self.iter_comments(f)):
+                thread_count += 1
                 
-            username = thread[0]['username']
-            content_preview = thread[0]['content'][:50] if thread[0]['content'] else "no_content"
-            
-            filename = self.sanitize_filename(username, content_preview)
-            filepath = self.output_dir / filename
-            
-            try:
-                thread_content = self.format_thread_content(thread)
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    f.write(thread_content)
-                saved_count += 1
-                print(f"Saved thread: {filename}")
-            except Exception as e:
-                print(f"Error saving thread {filename}: {e}")
+                username = thread[0]['username']
+                content_preview = thread[0]['content'][:50] if thread[0]['content'] else "no_content"
+                
+                filename = self.sanitize_filename(username, content_preview)
+                filepath = self.output_dir / filename
+                
+                try:
+                    thread_content = self.format_thread_content(thread)
+                    with open(filepath, 'w', encoding='utf-8') as out:
+                        out.write(thread_content)
+                    saved_count += 1
+                    print(f"Saved thread: {filename}")
+                except Exception as e:
+                    print(f"Error saving thread {filename}: {e}")
+                    continue
+                
+                if self.store is not None:
+                    self.store.add_comment(thread_content, 'instagram', self.thread_likes(thread))
+        
+        if self.store is not None:
+            self.store.commit()
         
+        print(f"Organized into {thread_count} threads")
         print(f"\nCompleted! Saved {saved_count} thread files to {self.output_dir}")
+    
+    def thread_record(self, thread: List[Dict]) -> Dict:
+        """A thread as one record; its content is the comments under the same --- Comment i --- separators as the thread files."""
+        first = thread[0]
+        return make_record(
+            first['username'],
+            '\n'.join(f"--- Comment {i} ---\nUsername: {comment['username']}\n{comment['content']}"
+                      for i, comment in enumerate(thread, 1)),
+            self.thread_likes(thread),
+            first['timestamp'],
+            first['is_reply'],
+            'instagram',
+            comments=len(thread)
+        )
+    
+    def write_records(self, input_file: str, f) -> None:
+        """Write the threads in an open export as records instead of files."""
+        with RecordWriter(self.records_dir, 'instagram', export_name(input_file)) as writer:
+            for thread in self.iter_threads(self.iter_comments(f)):
+                record = self.thread_record(thread)
+                writer.write(record)
+                if self.store is not None:
+                    self.store.add_comment(record_text(record), 'instagram', record['likes'])
+        
+        if self.store is not None:
+            self.store.commit()
+        
+        print(f"\nCompleted! Wrote {writer.written} thread records to {writer.directory}")
 
 
 def main():
     """Main function to run the parser."""
-    import sys
+    import argparse
     
-    if len(sys.argv) != 2:
-        print("Usage: python instagram_comment_parser.py <input_file>")
-        print("Example: python instagram_comment_parser.py paste.txt")
-        return
+    parser = argparse.ArgumentParser(description="Split an Instagram comment export into thread files or records")
+    parser.add_argument("input_file", help="e.g. paste.txt")
+    parser.add_argument("results_db", nargs="?", help="also add the threads to this results database")
+    parser.add_argument("--records", metavar="DIR", help="write JSONL records under DIR instead of one file per thread")
+    args = parser.parse_args()
     
-    input_file = sys.argv[1]
-    parser = InstagramCommentParser()
-    parser.parse_file(input_file)
+    store = None
+    if args.results_db:
+        from results_store import ResultsStore
+        store = ResultsStore(args.results_db)
+    comment_parser = InstagramCommentParser(store=store, records_dir=args.records)
+    comment_parser.parse_file(args.input_file)
+    if store is not None:
+        store.close()
 
 
 if __name__ == "__main__":
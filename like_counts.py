@@ -0,0 +1,60 @@
+"""
+Like Counts
+Parses the like counts TikTok and Instagram show ("15", "1,234", "1.2K",
+"15 likes") into integers, so the parsers can store them as structured fields
+and the like voter can weight votes itself instead of asking the model.
+"""
+
+import re
+from typing import Optional
+
+LIKE_COUNT = re.compile(r'^(\d+(?:[.,]\d+)*)\s*([KkMm])?$')
+# "Reply" can be run together with the count in pasted exports ("2d 15 likesReply")
+INSTAGRAM_LIKES = re.compile(r'(\d+(?:[.,]\d+)*\s*[KkMm]?)\s+likes?(?=\s|Reply|$)', re.IGNORECASE)
+LIKES_HEADER = re.compile(r'^Likes: *(.*)$', re.MULTILINE)
+TIMESTAMP_HEADER = re.compile(r'^Timestamp: *(.*)$', re.MULTILINE)
+MULTIPLIERS = {'k': 1_000, 'm': 1_000_000}
+
+
+def parse_like_count(text: str) -> Optional[int]:
+    """Parse a like count such as '15', '1,234' or '1.2K'; None if text isn't one."""
+    match = LIKE_COUNT.match(text.strip())
+    if not match:
+        return None
+    number, suffix = match.groups()
+    if suffix:
+        return int(round(float(number.replace(',', '.')) * MULTIPLIERS[suffix.lower()]))
+    # without a suffix, separators are thousands separators
+    return int(number.replace(',', '').replace('.', ''))
+
+
+def instagram_likes(line: str) -> int:
+    """Like count from an Instagram timestamp line like '2d 15 likes Reply', 0 if it has none."""
+    match = INSTAGRAM_LIKES.search(line)
+    if not match:
+        return 0
+    return parse_like_count(match.group(1)) or 0
+
+
+def comment_likes(text: str) -> int:
+    """Like count of a parsed comment or thread file.
+
+    Uses the first Likes: header; files written before the header existed fall
+    back to the most-liked Instagram timestamp line. 0 if neither is found.
+    """
+    header = LIKES_HEADER.search(text)
+    if header:
+        likes = parse_like_count(header.group(1))
+        if likes is not None:
+            return likes
+    return max((instagram_likes(line) for line in TIMESTAMP_HEADER.findall(text)), default=0)
+
+
+def likes_to_votes(likes: int) -> int:
+    """Votes each complaint in a comment with this many likes gets: its like count, or 1 if nobody liked it."""
+    return max(likes, 1)
+
+
+def like_votes(comment: str) -> int:
+    """The like voter's votes for each complaint in a parsed comment or thread file."""
+    return likes_to_votes(comment_likes(comment))
@@ -0,0 +1,112 @@
+"""
+LLM Response Cache
+A disk-backed cache of chat completion responses, so re-running the pipeline or
+restarting after a crash doesn't send unchanged comments to the model again.
+Keys combine the model name, a prompt template version, the digests of the
+comments in the request and the candidate complaints it showed; bump the
+template version whenever a prompt's wording changes. Entries live in SQLite
+and the least recently used ones are evicted once the cache grows past its size
+limit.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Dict, Iterable, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+def cache_key(model: str, template_version: str, comment_digests: Iterable[str],
+              candidates: Iterable[str] = (), extra: str = "") -> str:
+    """Key for a request; extra covers anything else that changes the prompt, such as the tools."""
+    parts = {
+        "model": model,
+        "template": template_version,
+        "comments": list(comment_digests),
+        "candidates": list(candidates),
+        "extra": extra,
+    }
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path: str = "llm_response_cache.db", max_bytes: int = 512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[Dict]:
+        row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Dict) -> None:
+        encoded = json.dumps(value)
+        size = len(encoded)
+        old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if old:
+            self.total_bytes -= old[0]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, encoded, size, time.time())
+        )
+        self.total_bytes += size
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+        self.conn.commit()
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until the cache is back under 90% of max_bytes."""
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_used")
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self) -> Dict:
+        entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": self.total_bytes,
+        }
+
+    def summary(self) -> str:
+        stats = self.stats()
+        return (f"Response cache: {stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hit_rate']:.0%} hit rate), {stats['entries']} entries, "
+                f"{stats['bytes'] / 1024 / 1024:.1f} MB, {stats['evictions']} evicted")
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
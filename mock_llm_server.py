@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+Mock LLM Server
+A local stand-in for LM Studio, for benchmarking the pipeline without a model.
+Serves the OpenAI-compatible /v1/chat/completions (plain and streamed, with tool
+calls), /v1/embeddings and /v1/models endpoints. Answers are made up from the
+request but shaped like a reasoning model's: an optional <think> section,
+complaint sentences for plain prompts, and tool calls or a response_format JSON
+answer filled in from their schema. Latency follows the prompt and answer length at
+configurable token rates, a fixed number of slots serve requests at a time, and
+errors, hangs and malformed JSON answers can be injected at a given rate. Like llama.cpp, every slot
+keeps its last prompt cached and a request only pays for the tokens after the
+longest prefix it shares with one, reported as usage cached_tokens. GET /stats
+returns request and token counts.
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# Complaints the mock picks from, a few per comment, chosen by a hash of the comment
+COMPLAINTS = [
+    "AI art is theft from artists",
+    "Data centers use too much water",
+    "AI is taking people's jobs",
+    "AI companies train on data without consent",
+    "AI slop is flooding social media",
+    "Data centers raise electricity prices",
+    "AI output is low quality",
+    "AI makes misinformation easier",
+    "Generative AI devalues creative work",
+    "Tech companies ignore environmental harm",
+    "AI is being forced into every product",
+    "AI models hallucinate facts",
+]
+THINK_WORDS = "so the comment says this and that which means the complaint is about the list maybe".split()
+LIST_ID = re.compile(r'^\s*(?:- )?\[(\d+)\] ', re.MULTILINE)
+COMMENT_ID = re.compile(r'<comment id="(\d+)">')
+
+
+def count_tokens(text: str) -> int:
+    """Rough token count: about four characters per token."""
+    return max(1, len(text) // 4)
+
+
+class MockConfig:
+    def __init__(self, latency: float = 0.05, prompt_tokens_per_second: float = 2000.0,
+                 tokens_per_second: float = 50.0, think_tokens: int = 0, answer_tokens: int = 30,
+                 error_rate: float = 0.0, hang_rate: float = 0.0, hang_seconds: float = 30.0,
+                 slots: int = 4, embedding_dimensions: int = 64, seed: int = 0, prefix_cache: bool = True,
+                 invalid_rate: float = 0.0):
+        self.latency = latency
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.tokens_per_second = tokens_per_second
+        self.think_tokens = think_tokens
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.slots = slots
+        self.embedding_dimensions = embedding_dimensions
+        self.seed = seed
+        self.prefix_cache = prefix_cache
+        # fraction of JSON answers cut short, like a server without grammar support running out of tokens
+        self.invalid_rate = invalid_rate
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+
+    def add(self, **counts: int) -> None:
+        with self.lock:
+            for name, value in counts.items():
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    def snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counts)
+
+
+def message_text(messages: List[Dict]) -> str:
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            parts.extend(part.get("text", "") for part in content if isinstance(part, dict))
+    return "\n".join(parts)
+
+
+def render_prompt(request: Dict) -> str:
+    """The prompt roughly as a chat template lays it out: the tools, then each message after its role."""
+    tools = json.dumps(request.get("tools") or [], sort_keys=True)
+    return tools + "".join(f"<|{message.get('role')}|>\n{message_text([message])}<|end|>\n"
+                           for message in request.get("messages", []))
+
+
+def shared_prefix_length(a: str, b: str) -> int:
+    # binary search on slice comparisons, which run in C, rather than a character loop
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def pick_complaints(text: str, rng: random.Random) -> List[str]:
+    start = int(hashlib.md5(text.encode("utf-8")).hexdigest(), 16)
+    return [COMPLAINTS[(start + i * 5) % len(COMPLAINTS)] for i in range(rng.randint(1, 3))]
+
+
+def fill_schema(schema: Dict, name: str, prompt: str, list_ids: List[int], comment_id: Optional[int],
+                rng: random.Random):
+    """A value for a JSON schema property, using the prompt's list ids and comment ids where they fit."""
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: fill_schema(value, key, prompt, list_ids, comment_id, rng)
+                for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        items = schema.get("items", {})
+        if "comment_id" in items.get("properties", {}):
+            # one entry per comment in a batch
+            return [fill_schema(items, name, prompt, list_ids, int(i), rng) for i in COMMENT_ID.findall(prompt)]
+        if items.get("type") == "integer":
+            return rng.sample(list_ids, min(len(list_ids), rng.randint(0, 2)))
+        if items.get("type") == "string":
+            # mostly existing complaints, sometimes a new one, like a model extending the list
+            return [] if list_ids and rng.random() < 0.7 else pick_complaints(prompt, rng)[:1]
+        return [fill_schema(items, name, prompt, list_ids, comment_id, rng)]
+    if kind == "integer":
+        if name == "comment_id" and comment_id is not None:
+            return comment_id
+        return rng.choice(list_ids) if list_ids else 0
+    if kind == "number":
+        return rng.random()
+    if kind == "boolean":
+        return rng.random() < 0.5
+    return pick_complaints(prompt + name, rng)[0]
+
+
+def tool_calls_for(request: Dict, prompt: str, rng: random.Random) -> List[Dict]:
+    """One call of the first tool, or one per <comment id> for tools that take a comment_id."""
+    function = request["tools"][0]["function"]
+    parameters = function.get("parameters", {})
+    list_ids = [int(i) for i in LIST_ID.findall(prompt)]
+    comment_ids = [int(i) for i in COMMENT_ID.findall(prompt)]
+    targets = comment_ids if comment_ids and "comment_id" in parameters.get("properties", {}) else [None]
+    calls = []
+    for comment_id in targets:
+        arguments = fill_schema(parameters, function["name"], prompt, list_ids, comment_id, rng)
+        calls.append({
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+            "type": "function",
+            "function": {"name": function["name"], "arguments": json.dumps(arguments)},
+        })
+    return calls
+
+
+class MockLLM:
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.stats = MockStats()
+        self.slots = threading.BoundedSemaphore(config.slots)
+        self.rng = random.Random(config.seed)
+        self.rng_lock = threading.Lock()
+        # the last prompt each slot processed, least recently used first
+        self.slot_prompts: List[str] = []
+        self.cache_lock = threading.Lock()
+
+    def request_rng(self) -> random.Random:
+        with self.rng_lock:
+            return random.Random(self.rng.random())
+
+    def cached_fraction(self, request: Dict) -> float:
+        """How much of the prompt a slot already has cached; that slot then holds this prompt instead."""
+        if not self.config.prefix_cache:
+            return 0.0
+        prompt = render_prompt(request)
+        with self.cache_lock:
+            shared = [shared_prefix_length(cached, prompt) for cached in self.slot_prompts]
+            best = max(range(len(shared)), key=shared.__getitem__, default=None)
+            if best is not None and shared[best]:
+                self.slot_prompts.pop(best)
+                hit = shared[best]
+            else:
+                hit = 0
+            self.slot_prompts.append(prompt)
+            if len(self.slot_prompts) > self.config.slots:
+                self.slot_prompts.pop(0)
+        return hit / len(prompt)
+
+    def answer(self, request: Dict, rng: random.Random) -> Dict:
+        """The assistant message and token counts for a chat request."""
+        prompt = message_text(request.get("messages", []))
+        think = ""
+        if self.config.think_tokens:
+            words = [rng.choice(THINK_WORDS) for _ in range(self.config.think_tokens)]
+            think = "<think>\n" + " ".join(words) + "\n</think>\n\n"
+        message = {"role": "assistant", "content": think}
+        response_format = request.get("response_format") or {}
+        if request.get("tools"):
+            message["tool_calls"] = tool_calls_for(request, prompt, rng)
+            answer_text = json.dumps(message["tool_calls"])
+        elif response_format.get("type") == "json_schema":
+            # a grammar-constrained answer has no <think> section
+            schema = response_format["json_schema"]["schema"]
+            list_ids = [int(i) for i in LIST_ID.findall(prompt)]
+            answer_text = json.dumps(fill_schema(schema, response_format["json_schema"].get("name", ""), prompt,
+                                                 list_ids, None, rng))
+            if rng.random() < self.config.invalid_rate:
+                answer_text = answer_text[:len(answer_text) // 2]
+            message["content"] = answer_text
+        else:
+            answer_text = ". ".join(pick_complaints(prompt, rng)) + "."
+            message["content"] += answer_text
+        completion_tokens = self.config.think_tokens + max(count_tokens(answer_text), self.config.answer_tokens)
+        prompt_tokens = count_tokens(prompt)
+        # like llama.cpp, at least the last prompt token is always processed again
+        cached_tokens = min(int(prompt_tokens * self.cached_fraction(request)), prompt_tokens - 1)
+        return {
+            "message": message,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": completion_tokens,
+        }
+
+    def prompt_time(self, answer: Dict) -> float:
+        """Time to process the prompt tokens that weren't cached."""
+        return (answer["prompt_tokens"] - answer["cached_tokens"]) / self.config.prompt_tokens_per_second
+
+    def generation_time(self, answer: Dict) -> float:
+        return self.config.latency + self.prompt_time(answer) + answer["completion_tokens"] / self.config.tokens_per_second
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    server_version = "MockLLM/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def llm(self) -> MockLLM:
+        return self.server.llm
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body: Dict) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self) -> Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/models":
+            self.send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+        elif self.path.rstrip("/") == "/stats":
+            self.send_json(200, self.llm.stats.snapshot())
+        else:
+            self.send_json(404, {"error": {"message": f"No route {self.path}"}})
+
+    def do_POST(self):
+        try:
+            request = self.read_json()
+        except json.JSONDecodeError:
+            self.send_json(400, {"error": {"message": "Request body isn't JSON"}})
+            return
+        if self.path.rstrip("/") == "/v1/chat/completions":
+            self.chat_completion(request)
+        elif self.path.rstrip("/") == "/v1/embeddings":
+            self.embeddings(request)
+        else:
+            self.send_json(404, {"error": {"message": f"No route {self.path}"}})
+
+    def embeddings(self, request: Dict) -> None:
+        texts = request.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        dimensions = self.llm.config.embedding_dimensions
+        data = []
+        for i, text in enumerate(texts):
+            # a bag of hashed words, so texts sharing words come out similar
+            vector = [0.0] * dimensions
+            for word in re.findall(r"\w+", text.lower()):
+                vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % dimensions] += 1.0
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        tokens = sum(count_tokens(text) for text in texts)
+        self.llm.stats.add(embedding_requests=1, embedding_inputs=len(texts), embedding_tokens=tokens)
+        self.send_json(200, {"object": "list", "data": data, "model": request.get("model", "mock"),
+                             "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    def chat_completion(self, request: Dict) -> None:
+        config = self.llm.config
+        rng = self.llm.request_rng()
+        with self.llm.slots:
+            roll = rng.random()
+            if roll < config.error_rate:
+                self.llm.stats.add(requests=1, errors=1)
+                time.sleep(config.latency)
+                self.send_json(500, {"error": {"message": "Injected server error"}})
+                return
+            if roll < config.error_rate + config.hang_rate:
+                self.llm.stats.add(requests=1, hangs=1)
+                time.sleep(config.hang_seconds)
+            answer = self.llm.answer(request, rng)
+            self.llm.stats.add(requests=1, prompt_tokens=answer["prompt_tokens"],
+                               cached_prompt_tokens=answer["cached_tokens"],
+                               completion_tokens=answer["completion_tokens"],
+                               tool_calls=len(answer["message"].get("tool_calls", [])))
+            if request.get("stream"):
+                self.stream(request, answer)
+                return
+            time.sleep(self.llm.generation_time(answer))
+            self.send_json(200, completion_body(request, answer))
+
+    def stream(self, request: Dict, answer: Dict) -> None:
+        """Send the answer as server-sent events, a few words at a time at the configured token rate."""
+        config = self.llm.config
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        time.sleep(config.latency + self.llm.prompt_time(answer))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        words = re.findall(r"\S+\s*", answer["message"]["content"])
+        pieces = [words[i:i + 4] for i in range(0, len(words), 4)]
+        delay = 4 / config.tokens_per_second
+        try:
+            for piece in pieces:
+                time.sleep(delay)
+                self.send_event(chunk_body(request, completion_id, {"content": "".join(piece)}))
+            for i, tool_call in enumerate(answer["message"].get("tool_calls", [])):
+                self.send_event(chunk_body(request, completion_id, {"tool_calls": [dict(tool_call, index=i)]}))
+            final = chunk_body(request, completion_id, {}, finish_reason="tool_calls" if answer["message"].get("tool_calls") else "stop")
+            final["usage"] = usage(answer)
+            self.send_event(final)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading, e.g. because the reasoning ran over its budget
+            self.llm.stats.add(cancelled=1)
+
+    def send_event(self, body: Dict) -> None:
+        self.wfile.write(b"data: " + json.dumps(body).encode("utf-8") + b"\n\n")
+        self.wfile.flush()
+
+
+def usage(answer: Dict) -> Dict:
+    return {
+        "prompt_tokens": answer["prompt_tokens"],
+        "completion_tokens": answer["completion_tokens"],
+        "total_tokens": answer["prompt_tokens"] + answer["completion_tokens"],
+        "prompt_tokens_details": {"cached_tokens": answer["cached_tokens"]},
+    }
+
+
+def completion_body(request: Dict, answer: Dict) -> Dict:
+    message = dict(answer["message"])
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "mock"),
+        "choices": [{
+            "index": 0,
+            "message": message,
+            "finish_reason": "tool_calls" if message.get("tool_calls") else "stop",
+        }],
+        "usage": usage(answer),
+    }
+
+
+def chunk_body(request: Dict, completion_id: str, delta: Dict, finish_reason: Optional[str] = None) -> Dict:
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": request.get("model", "mock"),
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def make_server(config: MockConfig, host: str = "127.0.0.1", port: int = 1234) -> ThreadingHTTPServer:
+    """Create the server; port 0 picks a free port (see server.server_address)."""
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.llm = MockLLM(config)
+    return server
+
+
+def start_server(config: MockConfig, host: str = "127.0.0.1", port: int = 1234) -> ThreadingHTTPServer:
+    """Start the server on a background thread and return it; call server.shutdown() to stop it."""
+    server = make_server(config, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI-compatible chat completions API for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234, help="default: LM Studio's port, so the scripts work unchanged")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every request")
+    parser.add_argument("--prompt-tps", type=float, default=2000.0, help="prompt tokens processed per second")
+    parser.add_argument("--tps", type=float, default=50.0, help="answer tokens generated per second")
+    parser.add_argument("--think-tokens", type=int, default=0, help="length of a <think> section before each answer")
+    parser.add_argument("--answer-tokens", type=int, default=30, help="minimum answer length in tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="fraction of requests delayed by --hang-seconds")
+    parser.add_argument("--hang-seconds", type=float, default=30.0)
+    parser.add_argument("--invalid-rate", type=float, default=0.0, help="fraction of JSON answers cut short")
+    parser.add_argument("--slots", type=int, default=4, help="requests served at the same time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-prefix-cache", dest="prefix_cache", action="store_false",
+                        help="process every prompt in full, as if the server had no prompt cache")
+    args = parser.parse_args()
+
+    config = MockConfig(args.latency, args.prompt_tps, args.tps, args.think_tokens, args.answer_tokens,
+                        args.error_rate, args.hang_rate, args.hang_seconds, args.slots, seed=args.seed,
+                        prefix_cache=args.prefix_cache, invalid_rate=args.invalid_rate)
+    server = make_server(config, args.host, args.port)
+    print(f"Mock LLM server on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Near-Duplicate Clustering
+Groups copy-pasted and near-identical comments ("this ^", quoted replies, small
+edits of the same text) with MinHash signatures and locality-sensitive hashing,
+so the LLM scripts can send one representative per cluster to the model and
+count its complaints for the rest of the cluster.
+"""
+
+import zlib
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from comment_digest import comment_digest, normalize_comment
+
+# Mersenne prime larger than any hash we feed in, small enough that a * x + b fits in 64 bits
+PRIME = (1 << 31) - 1
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, shingle_size: int = 5, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.a = rng.integers(1, PRIME, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, size=(num_perm, 1), dtype=np.uint64)
+
+    def shingles(self, text: str) -> set:
+        """Character n-grams of the normalized comment; short comments are one shingle."""
+        text = normalize_comment(text)
+        if len(text) <= self.shingle_size:
+            return {text}
+        return {text[i:i + self.shingle_size] for i in range(len(text) - self.shingle_size + 1)}
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in self.shingles(text)), dtype=np.uint64)
+        hashes %= PRIME
+        return ((self.a * hashes + self.b) % PRIME).min(axis=1)
+
+
+class UnionFind:
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i: int, j: int) -> None:
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i != root_j:
+            # the earlier comment stays the root so it becomes the representative
+            self.parent[max(root_i, root_j)] = min(root_i, root_j)
+
+
+def find_clusters(texts: Sequence[str], threshold: float = 0.8, num_perm: int = 64,
+                  bands: int = 16) -> List[List[int]]:
+    """Return clusters of near-duplicate texts as lists of indices, in input order.
+
+    Signatures are split into bands; texts sharing any band are candidates and
+    are merged if their estimated Jaccard similarity reaches threshold. Each
+    candidate is only compared with the first text in its bucket, which keeps
+    huge buckets of identical comments linear.
+    """
+    if not texts:
+        return []
+    hasher = MinHasher(num_perm=num_perm)
+    signatures = np.stack([hasher.signature(text) for text in texts])
+    rows = num_perm // bands
+    union_find = UnionFind(len(texts))
+    for band in range(bands):
+        buckets: Dict[bytes, int] = {}
+        band_values = signatures[:, band * rows:(band + 1) * rows]
+        for i, values in enumerate(band_values):
+            first = buckets.setdefault(values.tobytes(), i)
+            if first != i and union_find.find(first) != union_find.find(i):
+                if np.mean(signatures[first] == signatures[i]) >= threshold:
+                    union_find.union(first, i)
+    clusters: Dict[int, List[int]] = {}
+    for i in range(len(texts)):
+        clusters.setdefault(union_find.find(i), []).append(i)
+    return list(clusters.values())
+
+
+def representative_digests(comments: Sequence[str], threshold: float = 0.8) -> Dict[str, str]:
+    """Map each comment in a near-duplicate cluster to the digest of the cluster's first comment.
+
+    Comments that aren't near-duplicates of anything are left out.
+    """
+    representatives = {}
+    for cluster in find_clusters(comments, threshold):
+        if len(cluster) < 2:
+            continue
+        digest = comment_digest(comments[cluster[0]])
+        for i in cluster:
+            representatives[comments[i]] = digest
+    return representatives
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Batch Comment Parser
+Parses many TikTok and Instagram exports at once. Takes files, directories and
+glob patterns, detects each export's platform, parses the files in a process
+pool and merges the records into one set of JSONL shards (and optionally a
+results database). Exports of the same video overlap, so a comment whose
+digest already came from an earlier file is dropped; files are merged in sorted
+path order so the output is the same however the pool schedules them.
+"""
+
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from comment_records import RecordWriter, record_text
+from pipeline_metrics import Metrics
+from instagram_comment_parser import InstagramCommentParser
+from parse_into_comments_tiktok import TikTokCommentParser
+
+EXPORT_EXTENSIONS = (".md", ".txt", ".markdown")
+SNIFF_BYTES = 64 * 1024
+
+
+def find_exports(patterns: List[str]) -> List[str]:
+    """Expand files, directories (searched recursively) and globs into a sorted list of export files."""
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                paths.update(os.path.join(root, name) for name in files if name.lower().endswith(EXPORT_EXTENSIONS))
+        else:
+            paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(paths)
+
+
+def detect_platform(path: str) -> Optional[str]:
+    """Guess an export's platform from its first SNIFF_BYTES, falling back to its file name."""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        head = f.read(SNIFF_BYTES)
+    if "tiktok.com/@" in head:
+        return "tiktok"
+    if "profile picture" in head:
+        return "instagram"
+    name = os.path.basename(path).lower()
+    for platform in ("tiktok", "instagram"):
+        if platform in name:
+            return platform
+    return None
+
+
+def parse_export(path: str, platform: str) -> Tuple[List[Dict], float, int]:
+    """Parse one export into records; runs in a worker process. Returns (records, seconds, bytes)."""
+    started = time.perf_counter()
+    with open(path, "r", encoding="utf-8") as f:
+        # an empty records_dir keeps the parsers from creating their comment folders
+        if platform == "tiktok":
+            parser = TikTokCommentParser(records_dir="")
+            records = [parser.comment_record(comment) for comment in parser.iter_comments(f)]
+        else:
+            parser = InstagramCommentParser(records_dir="")
+            records = [parser.thread_record(thread) for thread in parser.iter_threads(parser.iter_comments(f))]
+    return records, time.perf_counter() - started, os.path.getsize(path)
+
+
+def parse_exports(paths: List[str], records_dir: str, platform: Optional[str] = None, workers: Optional[int] = None,
+                  store=None, name: str = "batch", metrics: Optional[Metrics] = None) -> Dict[str, int]:
+    """Parse exports in parallel and merge their records; returns record counts per platform."""
+    metrics = metrics or Metrics()
+    exports = []
+    for path in paths:
+        export_platform = platform or detect_platform(path)
+        if export_platform is None:
+            print(f"Skipping {path}: can't tell whether it's a TikTok or Instagram export")
+            continue
+        exports.append((path, export_platform))
+
+    writers = {}
+    seen = set()
+    counts = {}
+    total_records = 0
+    total_bytes = 0
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map yields results in submission order, which keeps the merge deterministic
+        results = pool.map(parse_export, [path for path, _ in exports], [p for _, p in exports])
+        for (path, export_platform), (records, seconds, size) in zip(exports, results):
+            if export_platform not in writers:
+                writers[export_platform] = RecordWriter(records_dir, export_platform, name)
+            writer = writers[export_platform]
+            # duplicates within one export are separate comments; across exports they're the same comment again
+            file_digests = set()
+            kept = 0
+            metrics.observe("parse", seconds)
+            with metrics.timer("disk_write"):
+                for record in records:
+                    if record["digest"] in seen:
+                        continue
+                    file_digests.add(record["digest"])
+                    writer.write(record)
+                    kept += 1
+                    if store is not None:
+                        store.add_comment(record_text(record), export_platform, record["likes"])
+            seen |= file_digests
+            metrics.count("parsed_records", len(records))
+            metrics.count("parsed_bytes", size)
+            counts[export_platform] = counts.get(export_platform, 0) + kept
+            total_records += len(records)
+            total_bytes += size
+            print(f"{path}: {export_platform}, {len(records)} records ({kept} new) in {seconds:.2f}s, "
+                  f"{len(records) / seconds if seconds else 0:.0f} records/s, {size / 1024 / 1024 / seconds if seconds else 0:.1f} MB/s")
+    for writer in writers.values():
+        writer.close()
+    if store is not None:
+        store.commit()
+    elapsed = time.perf_counter() - started
+    print(f"Parsed {len(exports)} exports, {total_records} records ({sum(counts.values())} after dedup) "
+          f"in {elapsed:.2f}s: {total_records / elapsed if elapsed else 0:.0f} records/s, "
+          f"{total_bytes / 1024 / 1024 / elapsed if elapsed else 0:.1f} MB/s")
+    return counts
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Parse many TikTok and Instagram exports into JSONL records")
+    parser.add_argument("inputs", nargs="+", help="export files, directories or glob patterns")
+    parser.add_argument("--records", default="parsed_comments", metavar="DIR", help="directory for the record shards")
+    parser.add_argument("--platform", choices=["tiktok", "instagram"], help="skip detection and treat every export as this platform")
+    parser.add_argument("--workers", type=int, help="parser processes (default: one per CPU)")
+    parser.add_argument("--db", help="also add the records to this results database")
+    parser.add_argument("--metrics", metavar="PATH", help="write parse metrics here (.prom for Prometheus text, else JSON)")
+    args = parser.parse_args()
+
+    paths = find_exports(args.inputs)
+    if not paths:
+        print("No export files found")
+        return
+    store = None
+    if args.db:
+        from results_store import ResultsStore
+        store = ResultsStore(args.db)
+    metrics = Metrics()
+    parse_exports(paths, args.records, args.platform, args.workers, store, metrics=metrics)
+    if store is not None:
+        store.close()
+    if args.metrics:
+        metrics.dump(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,77 +7,121 @@ Parses TikTok comments from a markdown file and splits them into individual comm
 import re
 import os
 import hashlib
-from typing import List, Dict
+from typing import Dict, Iterable, Iterator, List
 from pathlib import Path
+from like_counts import parse_like_count
+from comment_records import RecordWriter, make_record, record_text, export_name, read_lines
+
+USERNAME_LINK = re.compile(r'\[([^\]]+)\]\(https://www.tiktok.com/@[^)]+\)')
+TIMESTAMP = re.compile(r'^[0-9]+[hdm] agoReply$')
+
+
+def is_username_line(line: str) -> bool:
+    """A [username](https://www.tiktok.com/@...) line, which starts a comment."""
+    return 'tiktok.com/@' in line and '](' in line and line.strip().startswith('[')
+
+
+def extract_username(text: str) -> str:
+    """Extract username from markdown link line."""
+    match = USERNAME_LINK.match(text.strip())
+    if match:
+        return match.group(1).strip()
+    return ""
+
 
 class TikTokCommentParser:
-    def __init__(self, output_dir: str = "comments/tiktok"):
+    def __init__(self, output_dir: str = "comments/tiktok", store=None, records_dir: str = None):
         self.output_dir = Path(output_dir)
-        self.output_dir.mkdir(parents=True, exist_ok=True)
+        # Optional ResultsStore that parsed comments are also added to
+        self.store = store
+        # With records_dir, comments are written as JSONL records (comment_records.py) instead of one file each
+        self.records_dir = records_dir
+        if records_dir is None:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
 
     def extract_username(self, text: str) -> str:
         """Extract username from markdown link line."""
-        username_pattern = r'\[([^\]]+)\]\(https://www.tiktok.com/@[^)]+\)'
-        match = re.match(username_pattern, text.strip())
-        if match:
-            return match.group(1).strip()
-        return ""
+        return extract_username(text)
 
     def parse_comment_block(self, lines: List[str]) -> Dict:
-        """Parse a single comment block and extract relevant information."""
+        """Parse a single comment block in one pass over its lines."""
         if not lines:
             return None
-        comment_data = {
-            'username': '',
-            'content': '',
-            'timestamp': '',
-            'likes': '',
-            'raw_text': '\n'.join(lines)
-        }
-        # Username is usually the first [username](url) line
-        for line in lines:
-            if line.strip().startswith('[') and '](' in line and 'tiktok.com/@' in line:
-                comment_data['username'] = self.extract_username(line)
-                break
-        # Timestamp and likes are usually near the end
-        for line in reversed(lines):
-            if re.match(r'^[0-9]+[hdm] agoReply$', line.strip()) or re.match(r'^[0-9]+d agoReply$', line.strip()):
-                comment_data['timestamp'] = line.strip()
-            elif line.strip().isdigit():
-                comment_data['likes'] = line.strip()
-            if comment_data['timestamp'] and comment_data['likes']:
-                break
-        # Content is between username and timestamp/likes
+        username = ''
+        likes = 0
+        found_likes = False
         content_lines = []
         in_content = False
+        content_done = False
+        # The timestamp is the first one after the last likes line, else the last one before it
+        last_timestamp = ''
+        timestamp_after_likes = ''
+        timestamp_before_likes = ''
         for line in lines:
+            stripped = line.strip()
+            is_timestamp = False
+            count = None
+            # Timestamps and like counts both start with a digit, which skips the patterns for most lines
+            if stripped[:1].isdigit():
+                is_timestamp = TIMESTAMP.match(stripped) is not None
+                if is_timestamp:
+                    last_timestamp = stripped
+                    if not timestamp_after_likes:
+                        timestamp_after_likes = stripped
+                else:
+                    count = parse_like_count(stripped)
+                    if count is not None:
+                        likes = count
+                        found_likes = True
+                        timestamp_before_likes = last_timestamp
+                        timestamp_after_likes = ''
+            # Content is between the username and the first timestamp or likes line
             if in_content:
-                # Stop at timestamp or likes
-                if re.match(r'^[0-9]+[hdm] agoReply$', line.strip()) or line.strip().isdigit():
-                    break
-                content_lines.append(line.strip())
-            elif line.strip().startswith('[') and '](' in line and 'tiktok.com/@' in line:
+                if content_done:
+                    continue
+                if is_timestamp or count is not None:
+                    content_done = True
+                elif stripped:
+                    content_lines.append(stripped)
+            elif is_username_line(line):
+                username = extract_username(line)
                 in_content = True
-        comment_data['content'] = '\n'.join([l for l in content_lines if l])
-        return comment_data
+        if found_likes and not timestamp_after_likes:
+            timestamp = timestamp_before_likes
+        else:
+            timestamp = timestamp_after_likes
+        return {
+            'username': username,
+            'content': '\n'.join(content_lines),
+            'timestamp': timestamp,
+            'likes': likes,
+            'raw_text': '\n'.join(lines)
+        }
 
-    def split_into_comment_blocks(self, text: str) -> List[List[str]]:
-        """Split the text into individual comment blocks."""
-        lines = text.split('\n')
-        comment_blocks = []
+    def iter_comment_blocks(self, lines: Iterable[str]) -> Iterator[List[str]]:
+        """Yield comment blocks as each one closes; lines before the first comment are skipped."""
         current_block = []
         for line in lines:
             # Start of a new comment: [username](url)
-            if line.strip().startswith('[') and '](' in line and 'tiktok.com/@' in line:
+            if is_username_line(line):
                 if current_block:
-                    comment_blocks.append(current_block)
+                    yield current_block
                 current_block = [line]
-            else:
-                if current_block:
-                    current_block.append(line)
+            elif current_block:
+                current_block.append(line)
         if current_block:
-            comment_blocks.append(current_block)
-        return comment_blocks
+            yield current_block
+
+    def split_into_comment_blocks(self, text: str) -> List[List[str]]:
+        """Split the text into individual comment blocks."""
+        return list(self.iter_comment_blocks(text.split('\n')))
+
+    def iter_comments(self, f) -> Iterator[Dict]:
+        """Stream parsed comments with a username from an open export file, one block at a time."""
+        for block in self.iter_comment_blocks(read_lines(f)):
+            comment_data = self.parse_comment_block(block)
+            if comment_data['username']:
+                yield comment_data
 
     def sanitize_filename(self, username: str, content_preview: str) -> str:
         """Create a safe filename from username and content preview."""
@@ -104,8 +148,7 @@ class TikTokCommentParser:
 
     def parse_file(self, input_file: str) -> None:
         try:
-            with open(input_file, 'r', encoding='utf-8') as f:
-                text = f.read()
+            f = open(input_file, 'r', encoding='utf-8')
         except FileNotFoundError:
             print(f"Error: File {input_file} not found")
             return
@@ -113,34 +156,66 @@ class TikTokCommentParser:
             print(f"Error reading file: {e}")
             return
         print(f"Parsing file: {input_file}")
-        comment_blocks = self.split_into_comment_blocks(text)
-        print(f"Found {len(comment_blocks)} comment blocks")
+        if self.records_dir is not None:
+            with f:
+                self.write_records(input_file, f)
+            return
+        parsed_count = 0
         saved_count = 0
-        for block in comment_blocks:
-            comment_data = self.parse_comment_block(block)
-            if comment_data and comment_data['username']:
+        with f:
+            for comment_data in self.iter_comments(f):
+                parsed_count += 1
                 content_preview = comment_data['content'][:50] if comment_data['content'] else "no_content"
                 filename = self.sanitize_filename(comment_data['username'], content_preview)
                 filepath = self.output_dir / filename
                 try:
                     comment_content = self.format_comment_content(comment_data)
-                    with open(filepath, 'w', encoding='utf-8') as f:
-                        f.write(comment_content)
+                    with open(filepath, 'w', encoding='utf-8') as out:
+                        out.write(comment_content)
                     saved_count += 1
                     print(f"Saved comment: {filename}")
                 except Exception as e:
                     print(f"Error saving comment {filename}: {e}")
+                    continue
+                if self.store is not None:
+                    self.store.add_comment(comment_content, 'tiktok', comment_data['likes'])
+        if self.store is not None:
+            self.store.commit()
+        print(f"Parsed {parsed_count} comments")
         print(f"\nCompleted! Saved {saved_count} comment files to {self.output_dir}")
 
+    def comment_record(self, comment_data: Dict) -> Dict:
+        """A parsed comment as a record."""
+        return make_record(comment_data['username'], comment_data['content'], comment_data['likes'],
+                           comment_data['timestamp'], False, 'tiktok')
+
+    def write_records(self, input_file: str, f) -> None:
+        """Write the comments in an open export as records instead of files."""
+        with RecordWriter(self.records_dir, 'tiktok', export_name(input_file)) as writer:
+            for comment_data in self.iter_comments(f):
+                record = self.comment_record(comment_data)
+                writer.write(record)
+                if self.store is not None:
+                    self.store.add_comment(record_text(record), 'tiktok', record['likes'])
+        if self.store is not None:
+            self.store.commit()
+        print(f"\nCompleted! Wrote {writer.written} comment records to {writer.directory}")
+
 def main():
-    import sys
-    if len(sys.argv) != 2:
-        print("Usage: python parse_into_comments_tiktok.py <input_file>")
-        print("Example: python parse_into_comments_tiktok.py 'why don't you like AI - Tiktok.md'")
-        return
-    input_file = sys.argv[1]
-    parser = TikTokCommentParser()
-    parser.parse_file(input_file)
+    import argparse
+    parser = argparse.ArgumentParser(description="Split a TikTok comment export into comment files or records")
+    parser.add_argument("input_file", help="e.g. 'why don't you like AI - Tiktok.md'")
+    parser.add_argument("results_db", nargs="?", help="also add the comments to this results database")
+    parser.add_argument("--records", metavar="DIR", help="write JSONL records under DIR instead of one file per comment")
+    args = parser.parse_args()
+    store = None
+    if args.results_db:
+        from results_store import ResultsStore
+        store = ResultsStore(args.results_db)
+    comment_parser = TikTokCommentParser(store=store, records_dir=args.records)
+    comment_parser.parse_file(args.input_file)
+    if store is not None:
+        store.close()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
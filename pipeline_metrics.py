@@ -0,0 +1,167 @@
+"""
+Pipeline Metrics
+Counters and timers for the stages of a run (parsing, tokenizing, prompt
+building, model latency, tool calls, disk writes) and the token usage the
+server reports, so it's clear where a run's wall time goes. A one-line summary
+can be logged every few seconds, and the metrics dumped as JSON or in the
+Prometheus text format at the end. An optional cProfile or tracemalloc
+profile can be taken of the whole run.
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+
+class Timer:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "total_seconds": self.total,
+            "mean_seconds": self.total / self.count if self.count else 0.0,
+            "max_seconds": self.max,
+        }
+
+
+class Metrics:
+    def __init__(self, report_every: float = 60.0):
+        self.started = time.perf_counter()
+        self.counters: Dict[str, int] = {}
+        self.timers: Dict[str, Timer] = {}
+        self.report_every = report_every
+        self.last_report = self.started
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        if name not in self.timers:
+            self.timers[name] = Timer()
+        self.timers[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Time the block under name; works around awaits too, measuring wall time."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def record_usage(self, usage) -> None:
+        """Add a response's token usage (response.usage), if the server sent one."""
+        if usage is None:
+            return
+        self.count("prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+        self.count("completion_tokens", getattr(usage, "completion_tokens", 0) or 0)
+        details = getattr(usage, "completion_tokens_details", None)
+        reasoning = getattr(details, "reasoning_tokens", None) if details is not None else None
+        if reasoning:
+            self.count("reasoning_tokens", reasoning)
+        cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+        if cached:
+            self.count("cached_prompt_tokens", cached)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def to_dict(self) -> Dict:
+        return {
+            "elapsed_seconds": self.elapsed(),
+            "counters": dict(self.counters),
+            "timers": {name: timer.to_dict() for name, timer in self.timers.items()},
+        }
+
+    def summary(self) -> str:
+        """One line: counters, then each timer's total time and share of the elapsed time."""
+        elapsed = self.elapsed()
+        parts = [f"{elapsed:.1f}s elapsed"]
+        parts += [f"{name}={value}" for name, value in sorted(self.counters.items())]
+        parts += [
+            f"{name} {timer.total:.2f}s/{timer.count} ({100 * timer.total / elapsed if elapsed else 0:.0f}%)"
+            for name, timer in sorted(self.timers.items(), key=lambda item: -item[1].total)
+        ]
+        return ", ".join(parts)
+
+    def maybe_report(self, log: Callable[[str], None] = print) -> None:
+        """Log the summary if report_every seconds have passed since the last one."""
+        now = time.perf_counter()
+        if self.report_every and now - self.last_report >= self.report_every:
+            self.last_report = now
+            log(f"Metrics: {self.summary()}")
+
+    def to_prometheus(self, prefix: str = "comment_reader") -> str:
+        lines = [f"# TYPE {prefix}_elapsed_seconds gauge", f"{prefix}_elapsed_seconds {self.elapsed():.6f}"]
+        for name, value in sorted(self.counters.items()):
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+        if self.timers:
+            lines.append(f"# TYPE {prefix}_stage_seconds summary")
+            for name, timer in sorted(self.timers.items()):
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {timer.total:.6f}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {timer.count}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str) -> None:
+        """Write the metrics to path: Prometheus text for .prom files, JSON otherwise."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+
+
+class Profiler:
+    """A cProfile or tracemalloc profile of everything between start() and stop()."""
+
+    def __init__(self, mode: Optional[str], path: str = "profile"):
+        if mode not in (None, "cprofile", "tracemalloc"):
+            raise ValueError(f"Unknown profiler {mode!r}, use 'cprofile' or 'tracemalloc'")
+        self.mode = mode
+        self.path = path
+        self.profile = None
+
+    def start(self) -> "Profiler":
+        if self.mode == "cprofile":
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.mode == "tracemalloc":
+            import tracemalloc
+            tracemalloc.start(10)
+        return self
+
+    def stop(self, top: int = 20) -> str:
+        """Stop profiling, save the raw profile next to path and return a top-N report."""
+        if self.mode == "cprofile":
+            import io
+            import pstats
+            self.profile.disable()
+            self.profile.dump_stats(f"{self.path}.prof")
+            out = io.StringIO()
+            pstats.Stats(self.profile, stream=out).sort_stats("cumulative").print_stats(top)
+            return f"cProfile saved to {self.path}.prof\n{out.getvalue()}"
+        if self.mode == "tracemalloc":
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            snapshot.dump(f"{self.path}.tracemalloc")
+            lines = [f"tracemalloc: {current / 1e6:.1f} MB allocated, {peak / 1e6:.1f} MB peak, "
+                     f"saved to {self.path}.tracemalloc"]
+            lines += [str(stat) for stat in snapshot.statistics("lineno")[:top]]
+            return "\n".join(lines)
+        return ""
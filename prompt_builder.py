@@ -0,0 +1,100 @@
+"""
+Prompt Builder
+Lays out the LLM prompts so a local server's prompt cache can reuse most of
+each one. llama.cpp and LM Studio keep the last prompt of every slot in their
+KV cache and only process the tokens after the longest prefix a new prompt
+shares with it, so whatever stays the same between requests goes first: a fixed
+system message, then the complaint catalog, whose complaints keep their ids and
+are only ever appended, and last a user message holding just the comment. With
+retrieval the candidate complaints change with every comment, so they go in
+the user message and the system message stays the same for every request.
+"""
+
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+
+class ComplaintCatalog:
+    """Complaints numbered in the order they were added, so an id never changes once it's shown to the model."""
+
+    def __init__(self, complaints: Iterable[str] = ()):
+        self.complaints: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self._rendered = ""
+        self._rendered_count = 0
+        self.extend(complaints)
+
+    def __len__(self) -> int:
+        return len(self.complaints)
+
+    def __contains__(self, complaint: str) -> bool:
+        return complaint in self.ids
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.complaints)
+
+    def __getitem__(self, complaint_id: int) -> str:
+        return self.complaints[complaint_id]
+
+    def add(self, complaint: str) -> int:
+        """Append a complaint if it's new and return its id."""
+        if complaint not in self.ids:
+            self.ids[complaint] = len(self.complaints)
+            self.complaints.append(complaint)
+        return self.ids[complaint]
+
+    def extend(self, complaints: Iterable[str]) -> None:
+        for complaint in complaints:
+            self.add(complaint)
+
+    def line(self, complaint: str) -> str:
+        return f"- [{self.ids[complaint]}] {complaint}"
+
+    def render(self, complaints: Optional[Sequence[str]] = None) -> str:
+        """The catalog as prompt lines, or just the given complaints with their catalog ids.
+
+        The full rendering is kept and only extended as complaints are added,
+        so its text for the first n complaints never changes.
+        """
+        if complaints is not None:
+            return "\n".join(self.line(complaint) for complaint in complaints)
+        if self._rendered_count < len(self.complaints):
+            new = "\n".join(self.line(complaint) for complaint in self.complaints[self._rendered_count:])
+            self._rendered = f"{self._rendered}\n{new}" if self._rendered else new
+            self._rendered_count = len(self.complaints)
+        return self._rendered
+
+
+class PromptBuilder:
+    """Chat messages as [system: instructions + catalog, user: comment], the stable part first."""
+
+    def __init__(self, instructions: str, catalog: ComplaintCatalog,
+                 catalog_heading: str = "Complaints so far, as [id] complaint:"):
+        self.instructions = instructions.strip()
+        self.catalog = catalog
+        self.catalog_heading = catalog_heading
+        self._system = None
+        self._system_count = -1
+
+    def catalog_text(self, complaints: Optional[Sequence[str]] = None) -> str:
+        listed = self.catalog.render(complaints)
+        return f"{self.catalog_heading}\n{listed or '(none yet)'}"
+
+    def system_prompt(self) -> str:
+        """The instructions followed by the whole catalog, rebuilt only when complaints have been added."""
+        if self._system_count != len(self.catalog):
+            self._system = f"{self.instructions}\n\n{self.catalog_text()}"
+            self._system_count = len(self.catalog)
+        return self._system
+
+    def messages(self, user_content: str, candidates: Optional[Sequence[str]] = None) -> List[Dict]:
+        """The messages for one request.
+
+        Without candidates the model sees the whole catalog in the system
+        message. With candidates (retrieval) only those are listed, at the top
+        of the user message, and the system message is just the instructions.
+        """
+        if candidates is None:
+            return [{"role": "system", "content": self.system_prompt()},
+                    {"role": "user", "content": user_content}]
+        return [{"role": "system", "content": self.instructions},
+                {"role": "user", "content": f"{self.catalog_text(candidates)}\n\n{user_content}"}]
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Prompt Cache Benchmark
+Shows how much of each prompt a server's prefix cache can reuse with the old
+layout, where the comment came before the complaint list in one user message,
+and with the layout from prompt_builder.py. Both layouts send the same
+synthetic comments, one at a time and streamed, to the mock server
+(mock_llm_server.py), which keeps each slot's last prompt cached like
+llama.cpp, while the complaint catalog grows by one complaint every few
+comments. The report gives the share of prompt tokens served from the cache
+and the time to first token for each layout.
+"""
+
+import json
+import statistics
+import time
+from typing import Dict, List
+
+from comment_like_voter_llm import CATALOG_HEADING, INSTRUCTIONS, tools
+from prompt_builder import ComplaintCatalog, PromptBuilder
+from synthetic_exports import CommentMaker
+
+
+def inline_messages(comment: str, catalog: ComplaintCatalog) -> List[Dict]:
+    """The layout before prompt_builder.py: the comment first, then the instructions and the list, as one message."""
+    return [{"role": "user", "content": f'Here is a comment: "{comment}"\n\n{INSTRUCTIONS.strip()}\n\n'
+                                        f'{CATALOG_HEADING}\n{catalog.render()}'}]
+
+
+def run_layout(layout: str, comments: List[str], complaints: List[str], settings: Dict) -> Dict:
+    from openai import OpenAI
+
+    from mock_llm_server import MockConfig, start_server
+
+    config = MockConfig(latency=settings["latency"], prompt_tokens_per_second=settings["prompt_tps"],
+                        tokens_per_second=settings["tps"], slots=settings["slots"], seed=settings["seed"])
+    server = start_server(config, port=0)
+    client = OpenAI(base_url=f"http://127.0.0.1:{server.server_address[1]}/v1", api_key="lm-studio")
+    catalog = ComplaintCatalog(complaints[:settings["catalog"]])
+    prompts = PromptBuilder(INSTRUCTIONS, catalog, CATALOG_HEADING)
+    added = settings["catalog"]
+    first_token = []
+    prompt_tokens = cached_tokens = 0
+    started = time.perf_counter()
+    try:
+        for i, comment in enumerate(comments):
+            if i and i % settings["new_every"] == 0 and added < len(complaints):
+                # the model found a new complaint, which goes at the end of the catalog
+                catalog.add(complaints[added])
+                added += 1
+            messages = prompts.messages(comment) if layout == "prefix" else inline_messages(comment, catalog)
+            sent = time.perf_counter()
+            stream = client.chat.completions.create(model="mock", messages=messages, tools=tools, stream=True,
+                                                    stream_options={"include_usage": True})
+            for chunk in stream:
+                if chunk.choices and len(first_token) <= i:
+                    first_token.append(time.perf_counter() - sent)
+                if chunk.usage is not None:
+                    prompt_tokens += chunk.usage.prompt_tokens
+                    details = chunk.usage.prompt_tokens_details
+                    cached_tokens += (details.cached_tokens or 0) if details is not None else 0
+    finally:
+        server.shutdown()
+        server.server_close()
+    first_token.sort()
+    return {
+        "requests": len(comments),
+        "seconds": time.perf_counter() - started,
+        "prompt_tokens": prompt_tokens,
+        "cached_share": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+        "first_token_mean": statistics.mean(first_token) if first_token else 0.0,
+        "first_token_p95": first_token[int(0.95 * (len(first_token) - 1))] if first_token else 0.0,
+    }
+
+
+def format_report(results: Dict) -> str:
+    lines = [f"{'layout':<8}{'requests':>10}{'wall s':>9}{'prompt tok':>12}{'cached':>8}{'TTFT mean':>11}{'TTFT p95':>10}"]
+    for layout, result in results.items():
+        lines.append(f"{layout:<8}{result['requests']:>10}{result['seconds']:>9.2f}{result['prompt_tokens']:>12}"
+                     f"{100 * result['cached_share']:>7.0f}%{result['first_token_mean']:>10.3f}s"
+                     f"{result['first_token_p95']:>9.3f}s")
+    if "inline" in results and "prefix" in results and results["prefix"]["first_token_mean"]:
+        lines.append(f"Time to first token is {results['inline']['first_token_mean'] / results['prefix']['first_token_mean']:.1f}x "
+                     f"shorter with the prefix layout")
+    return "\n".join(lines)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare prefix cache hits for the old and new prompt layouts")
+    parser.add_argument("--comments", type=int, default=50, help="comments sent with each layout")
+    parser.add_argument("--catalog", type=int, default=200, help="complaints in the catalog at the start")
+    parser.add_argument("--new-every", type=int, default=10, help="add a complaint to the catalog every N comments")
+    parser.add_argument("--layouts", default="inline,prefix", help="comma-separated layouts to run")
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--prompt-tps", type=float, default=10000.0, help="mock prompt tokens per second")
+    parser.add_argument("--tps", type=float, default=500.0, help="mock answer tokens per second")
+    parser.add_argument("--slots", type=int, default=1, help="mock server slots, each with its own cached prompt")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also save the results as JSON")
+    args = parser.parse_args()
+
+    maker = CommentMaker(args.seed)
+    comments = [" ".join(maker.lines()) for _ in range(args.comments)]
+    complaints = [f"{maker.sentence()} ({i})" for i in range(args.catalog + args.comments // args.new_every + 1)]
+    settings = vars(args)
+    results = {}
+    for layout in args.layouts.split(","):
+        print(f"Running {layout}...")
+        results[layout] = run_layout(layout, comments, complaints, settings)
+    print(format_report(results))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Results Store
+A single SQLite database for parsed comments, normalized complaints and the
+votes the LLM scripts record for them. Comments are keyed by a content hash and
+indexed by platform, votes are written in batched transactions, and tallies are
+computed with SQL aggregation instead of rewriting JSON dicts on every change.
+The existing JSON files can be imported into and exported from the store.
+"""
+
+import json
+import sqlite3
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from vote_journal import comment_id
+
+# Tally names: the normalizer counts one vote per complaint, the like voter weights by likes
+COMPLAINTS_TALLY = "complaints"
+LIKE_WEIGHTED_TALLY = "like_weighted"
+
+SCHEMA = """
+-- digest is the exact-text id from vote_journal.comment_id, not comment_digest's content
+-- digest, so reposts of the same text by other users are separate comments here
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL UNIQUE,
+    platform TEXT NOT NULL,
+    text TEXT NOT NULL,
+    likes INTEGER
+);
+CREATE INDEX IF NOT EXISTS comments_platform ON comments (platform);
+
+CREATE TABLE IF NOT EXISTS complaints (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL UNIQUE
+);
+
+-- comment_id is NULL for votes imported from a tally file and for like count corrections
+CREATE TABLE IF NOT EXISTS votes (
+    comment_id INTEGER REFERENCES comments (id),
+    complaint_id INTEGER NOT NULL REFERENCES complaints (id),
+    tally TEXT NOT NULL,
+    votes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS votes_tally ON votes (tally, complaint_id);
+CREATE INDEX IF NOT EXISTS votes_comment ON votes (comment_id);
+
+CREATE TABLE IF NOT EXISTS processed (
+    comment_id INTEGER NOT NULL REFERENCES comments (id),
+    tally TEXT NOT NULL,
+    PRIMARY KEY (comment_id, tally)
+);
+"""
+
+
+class ResultsStore:
+    def __init__(self, path: str = "comment_reader.db", commit_every: int = 100):
+        self.path = path
+        self.commit_every = commit_every
+        self.pending_writes = 0
+        self.in_transaction = False
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self._complaint_ids = {}
+
+    def close(self) -> None:
+        self.commit()
+        self.conn.close()
+
+    def commit(self) -> None:
+        self.conn.commit()
+        self.pending_writes = 0
+
+    def _wrote(self) -> None:
+        """Count a write and commit once commit_every of them have built up."""
+        self.pending_writes += 1
+        if not self.in_transaction and self.pending_writes >= self.commit_every:
+            self.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Group writes into one transaction, rolling them back if anything fails."""
+        self.in_transaction = True
+        try:
+            yield self
+        except Exception:
+            self.conn.rollback()
+            self.pending_writes = 0
+            self._complaint_ids.clear()
+            raise
+        finally:
+            self.in_transaction = False
+        self.commit()
+
+    def add_comment(self, text: str, platform: str, likes: Optional[int] = None) -> int:
+        """Add a comment if it isn't stored yet and return its row id."""
+        text_id = comment_id(text)
+        row = self.conn.execute("SELECT id FROM comments WHERE digest = ?", (text_id,)).fetchone()
+        if row:
+            if likes is not None:
+                self.conn.execute("UPDATE comments SET likes = ? WHERE id = ?", (likes, row[0]))
+                self._wrote()
+            return row[0]
+        cursor = self.conn.execute(
+            "INSERT INTO comments (digest, platform, text, likes) VALUES (?, ?, ?, ?)",
+            (text_id, platform, text, likes)
+        )
+        self._wrote()
+        return cursor.lastrowid
+
+    def complaint_id(self, complaint: str) -> int:
+        if complaint not in self._complaint_ids:
+            self.conn.execute("INSERT OR IGNORE INTO complaints (text) VALUES (?)", (complaint,))
+            row = self.conn.execute("SELECT id FROM complaints WHERE text = ?", (complaint,)).fetchone()
+            self._complaint_ids[complaint] = row[0]
+        return self._complaint_ids[complaint]
+
+    def is_processed(self, text: str, tally: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM processed JOIN comments ON comments.id = processed.comment_id "
+            "WHERE comments.digest = ? AND processed.tally = ?",
+            (comment_id(text), tally)
+        ).fetchone()
+        return row is not None
+
+    def record_votes(self, text: str, platform: str, votes: Iterable[Tuple[str, int]], tally: str) -> None:
+        """Add a comment's (complaint, votes) pairs to a tally and mark the comment processed."""
+        row_id = self.add_comment(text, platform)
+        self.conn.executemany(
+            "INSERT INTO votes (comment_id, complaint_id, tally, votes) VALUES (?, ?, ?, ?)",
+            [(row_id, self.complaint_id(complaint), tally, count) for complaint, count in votes]
+        )
+        self.conn.execute("INSERT OR IGNORE INTO processed (comment_id, tally) VALUES (?, ?)", (row_id, tally))
+        self._wrote()
+
+    def adjust_votes(self, votes: Iterable[Tuple[str, int]], tally: str) -> None:
+        """Add (complaint, votes) corrections to a tally, e.g. for a comment whose like count changed."""
+        self.conn.executemany(
+            "INSERT INTO votes (comment_id, complaint_id, tally, votes) VALUES (NULL, ?, ?, ?)",
+            [(self.complaint_id(complaint), tally, count) for complaint, count in votes]
+        )
+        self._wrote()
+
+    def merge_complaints(self, aliases: Dict[str, str]) -> None:
+        """Move the votes of each alias complaint to its canonical complaint and delete the alias.
+
+        A comment that already has a vote for the canonical complaint in the same
+        tally keeps just that one, as it would have if the model had named it once.
+        """
+        with self.transaction():
+            for alias, canonical in aliases.items():
+                row = self.conn.execute("SELECT id FROM complaints WHERE text = ?", (alias,)).fetchone()
+                if row is None:
+                    continue
+                alias_id, canonical_id = row[0], self.complaint_id(canonical)
+                self.conn.execute(
+                    "DELETE FROM votes WHERE complaint_id = ? AND comment_id IS NOT NULL AND EXISTS ("
+                    "SELECT 1 FROM votes AS kept WHERE kept.comment_id = votes.comment_id "
+                    "AND kept.tally = votes.tally AND kept.complaint_id = ?)",
+                    (alias_id, canonical_id)
+                )
+                self.conn.execute("UPDATE votes SET complaint_id = ? WHERE complaint_id = ?", (canonical_id, alias_id))
+                self.conn.execute("DELETE FROM complaints WHERE id = ?", (alias_id,))
+                self._complaint_ids.pop(alias, None)
+
+    def tally(self, tally: str, platform: Optional[str] = None) -> Dict[str, int]:
+        """Return complaint -> total votes, highest first. Imported votes have no platform."""
+        query = (
+            "SELECT complaints.text, SUM(votes.votes) AS total FROM votes "
+            "JOIN complaints ON complaints.id = votes.complaint_id "
+            "LEFT JOIN comments ON comments.id = votes.comment_id "
+            "WHERE votes.tally = ?"
+        )
+        params = [tally]
+        if platform:
+            query += " AND comments.platform = ?"
+            params.append(platform)
+        query += " GROUP BY votes.complaint_id ORDER BY total DESC, complaints.id"
+        return {text: total for text, total in self.conn.execute(query, params)}
+
+    def comments_to_complaints(self, tally: str, platform: Optional[str] = None) -> Dict[str, List[str]]:
+        """Return comment text -> complaints for every processed comment, in the order they were added."""
+        query = (
+            "SELECT comments.text, complaints.text FROM processed "
+            "JOIN comments ON comments.id = processed.comment_id "
+            "LEFT JOIN votes ON votes.comment_id = comments.id AND votes.tally = processed.tally "
+            "LEFT JOIN complaints ON complaints.id = votes.complaint_id "
+            "WHERE processed.tally = ?"
+        )
+        params = [tally]
+        if platform:
+            query += " AND comments.platform = ?"
+            params.append(platform)
+        query += " ORDER BY comments.id, votes.rowid"
+        mapping = {}
+        for comment, complaint in self.conn.execute(query, params):
+            complaints = mapping.setdefault(comment, [])
+            if complaint is not None:
+                complaints.append(complaint)
+        return mapping
+
+    def import_json(self, tally_path: str, comments_path: Optional[str], tally: str, platform: str) -> None:
+        """Import a complaint tally file and, optionally, a comments_to_complaints file.
+
+        Each mapped complaint counts one vote for its comment. Whatever the tally
+        file has on top of that is stored as votes without a comment, so the
+        store's tally matches the file exactly.
+        """
+        with self.transaction():
+            mapped = {}
+            if comments_path:
+                with open(comments_path, "r") as f:
+                    for text, complaints in json.load(f).items():
+                        self.record_votes(text, platform, [(c, 1) for c in complaints], tally)
+                        for complaint in complaints:
+                            mapped[complaint] = mapped.get(complaint, 0) + 1
+            with open(tally_path, "r") as f:
+                totals = json.load(f)
+            self.conn.executemany(
+                "INSERT INTO votes (comment_id, complaint_id, tally, votes) VALUES (NULL, ?, ?, ?)",
+                [(self.complaint_id(complaint), tally, total - mapped.get(complaint, 0))
+                 for complaint, total in totals.items() if total != mapped.get(complaint, 0)]
+            )
+
+    def export_json(self, tally_path: str, comments_path: Optional[str], tally: str,
+                    platform: Optional[str] = None) -> None:
+        """Write a tally, and optionally the comments_to_complaints mapping, in the existing JSON formats."""
+        with open(tally_path, "w") as f:
+            json.dump(self.tally(tally, platform), f, indent=2)
+        if comments_path:
+            with open(comments_path, "w") as f:
+                json.dump(self.comments_to_complaints(tally, platform), f, indent=2)
+
+
+def main():
+    """Import, export or print tallies from the command line."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the comment_reader results database")
+    parser.add_argument("--db", default="comment_reader.db", help="SQLite database path")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    tally_parser = subparsers.add_parser("tally", help="Print the top complaints in a tally")
+    tally_parser.add_argument("--tally", default=LIKE_WEIGHTED_TALLY, choices=[COMPLAINTS_TALLY, LIKE_WEIGHTED_TALLY])
+    tally_parser.add_argument("--platform")
+    tally_parser.add_argument("--top", type=int, default=20)
+
+    for command in ("import", "export"):
+        sub = subparsers.add_parser(command, help=f"{command.capitalize()} the JSON tally files")
+        sub.add_argument("tally_file", help="e.g. like_weighted_complaints.json")
+        sub.add_argument("comments_file", nargs="?", help="e.g. comments_to_complaints.json")
+        sub.add_argument("--tally", default=LIKE_WEIGHTED_TALLY, choices=[COMPLAINTS_TALLY, LIKE_WEIGHTED_TALLY])
+        sub.add_argument("--platform", required=command == "import")
+
+    args = parser.parse_args()
+    store = ResultsStore(args.db)
+    if args.command == "tally":
+        for i, (complaint, total) in enumerate(store.tally(args.tally, args.platform).items()):
+            if i >= args.top:
+                break
+            print(f"{total:>8}  {complaint}")
+    elif args.command == "import":
+        store.import_json(args.tally_file, args.comments_file, args.tally, args.platform)
+        print(f"Imported {args.tally_file} into {args.db}")
+    else:
+        store.export_json(args.tally_file, args.comments_file, args.tally, args.platform)
+        print(f"Exported {args.tally} tally to {args.tally_file}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Structured Output
+JSON schemas for the model's answer about one comment or a batch of comments,
+sent as the request's response_format so LM Studio and llama.cpp hold the model
+to them with a grammar, and a validator for the replies. An answer gives the
+ids of the listed complaints a comment makes and any new complaints, as whole
+strings, so nothing has to be split out of free text; the votes still come from
+the scripts (one per comment, or the comment's likes). A reply that fails
+validation is sent back to the model with the error, and a comment a batch
+reply left out is asked about on its own, so only that comment costs another
+request.
+"""
+
+import json
+import re
+from typing import Dict, List
+
+# Instructions for the structured mode, used by both LLM scripts in place of their own
+INSTRUCTIONS = """
+You normalize the complaints made in comments so they can be tallied. The user's message is a comment.
+
+1. Normalize the complaint(s) in the comment. Use the existing complaints list if possible. If not, add a new complaint.
+2. Reply with a JSON object: "complaint_ids" holds the ids of the listed complaints the comment makes, and "new_complaints" holds any complaints it makes that aren't in the list, each a single sentence.
+3. If the comment doesn't make any complaint, reply with empty lists.
+
+The end goal is to have a vote tally of all the complaints in the list, where slight variations, different ways of saying the same thing, and other variations are all counted as the same complaint. If it's meaningfully different, add another complaint to the list.
+The user will be using this vote tally to make a video about the complaints, so please make sure the complaints are as normalized as possible.
+"""
+
+BATCH_INSTRUCTIONS = """
+You normalize the complaints made in comments so they can be tallied. The user's message holds several comments, each wrapped in a <comment id="..."> tag.
+
+1. Normalize the complaint(s) in each comment. Use the existing complaints list if possible. If not, add a new complaint.
+2. Reply with a JSON object whose "comments" list has one entry for every comment: its "comment_id", the "complaint_ids" of the listed complaints it makes, and any "new_complaints" it makes that aren't in the list, each a single sentence.
+3. Give a comment that doesn't make any complaint empty lists.
+
+The end goal is to have a vote tally of all the complaints in the list, where slight variations, different ways of saying the same thing, and other variations are all counted as the same complaint. If it's meaningfully different, add another complaint to the list.
+The user will be using this vote tally to make a video about the complaints, so please make sure the complaints are as normalized as possible.
+"""
+
+REPAIR_PROMPT = "That reply isn't valid: {error}. Reply again with only the JSON object, following the schema."
+
+THINK_SECTION = re.compile(r'^\s*<think>.*?</think>', re.DOTALL)
+CODE_FENCE = re.compile(r'^```(?:json)?\s*(.*?)\s*```$', re.DOTALL)
+WHITESPACE = re.compile(r'\s+')
+
+
+class InvalidOutput(ValueError):
+    pass
+
+
+def answer_properties(catalog_size: int) -> Dict:
+    # the grammar keeps ids inside the list; with an empty list there are none to give
+    complaint_id = {"type": "integer", "minimum": 0}
+    complaint_ids = {"type": "array", "items": complaint_id}
+    if catalog_size:
+        complaint_id["maximum"] = catalog_size - 1
+    else:
+        complaint_ids["maxItems"] = 0
+    return {
+        "complaint_ids": complaint_ids,
+        "new_complaints": {"type": "array", "items": {"type": "string", "minLength": 1}},
+    }
+
+
+def answer_schema(catalog_size: int) -> Dict:
+    """Schema for the answer about one comment, with ids limited to the catalog's."""
+    return {
+        "type": "object",
+        "properties": answer_properties(catalog_size),
+        "required": ["complaint_ids", "new_complaints"],
+        "additionalProperties": False,
+    }
+
+
+def batch_schema(catalog_size: int, batch_size: int) -> Dict:
+    """Schema for the answers about a batch of comments, one entry per comment id."""
+    entry = {
+        "type": "object",
+        "properties": {
+            "comment_id": {"type": "integer", "minimum": 1, "maximum": batch_size},
+            **answer_properties(catalog_size),
+        },
+        "required": ["comment_id", "complaint_ids", "new_complaints"],
+        "additionalProperties": False,
+    }
+    return {
+        "type": "object",
+        "properties": {"comments": {"type": "array", "items": entry, "minItems": batch_size, "maxItems": batch_size}},
+        "required": ["comments"],
+        "additionalProperties": False,
+    }
+
+
+def response_format(catalog_size: int, batch_size: int = 1) -> Dict:
+    """The response_format for a request about batch_size comments."""
+    if batch_size == 1:
+        name, schema = "complaints", answer_schema(catalog_size)
+    else:
+        name, schema = "batch_complaints", batch_schema(catalog_size, batch_size)
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+def load_object(content: str) -> Dict:
+    """The JSON object in a reply, after any <think> section or code fence around it."""
+    content = THINK_SECTION.sub("", content or "").strip()
+    fenced = CODE_FENCE.match(content)
+    if fenced:
+        content = fenced.group(1)
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError as e:
+        raise InvalidOutput(f"it isn't JSON ({e.msg} at character {e.pos})") from None
+    if not isinstance(data, dict):
+        raise InvalidOutput("it isn't a JSON object")
+    return data
+
+
+def check_answer(data: Dict, catalog_size: int) -> Dict:
+    """The answer with its types and ids checked, duplicates dropped and new complaints' whitespace tidied."""
+    complaint_ids = data.get("complaint_ids")
+    if not isinstance(complaint_ids, list) or any(type(i) is not int for i in complaint_ids):
+        raise InvalidOutput("complaint_ids must be a list of integers")
+    unknown = [i for i in complaint_ids if not 0 <= i < catalog_size]
+    if unknown:
+        raise InvalidOutput(f"complaint ids {unknown} aren't in the list")
+    new_complaints = data.get("new_complaints")
+    if not isinstance(new_complaints, list) or any(not isinstance(c, str) for c in new_complaints):
+        raise InvalidOutput("new_complaints must be a list of strings")
+    new_complaints = [WHITESPACE.sub(" ", complaint).strip() for complaint in new_complaints]
+    return {
+        "complaint_ids": list(dict.fromkeys(complaint_ids)),
+        "new_complaints": list(dict.fromkeys(complaint for complaint in new_complaints if complaint)),
+    }
+
+
+def parse_answer(content: str, catalog_size: int) -> Dict:
+    """Validate the reply about one comment. Raises InvalidOutput with a reason the model can act on."""
+    return check_answer(load_object(content), catalog_size)
+
+
+def parse_batch_answer(content: str, catalog_size: int, batch_size: int) -> Dict[int, Dict]:
+    """Validate the reply about a batch, returning the valid answers by comment id (1-based).
+
+    Comments that are missing or whose entry doesn't validate are left out, to
+    be asked about on their own. Raises InvalidOutput if the reply as a whole
+    isn't usable.
+    """
+    entries = load_object(content).get("comments")
+    if not isinstance(entries, list):
+        raise InvalidOutput("comments must be a list")
+    answers = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        comment_id = entry.get("comment_id")
+        if type(comment_id) is not int or not 1 <= comment_id <= batch_size or comment_id in answers:
+            continue
+        try:
+            answers[comment_id] = check_answer(entry, catalog_size)
+        except InvalidOutput:
+            continue
+    return answers
+
+
+def repair_messages(messages: List[Dict], content: str, error: str) -> List[Dict]:
+    """The messages to ask again about the same comment, with the invalid reply and what was wrong with it."""
+    return messages + [{"role": "assistant", "content": content},
+                       {"role": "user", "content": REPAIR_PROMPT.format(error=error)}]
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Synthetic Exports
+Writes made-up TikTok and Instagram comment exports in the markdown layout the
+parsers read, for benchmarking at 10k to 1M comments. Comments are built from
+complaint phrases so the LLM scripts have something to normalize; a share of
+them are reposts of earlier comments, replies, or long enough to be chunked,
+and like counts use the exports' formats ("350", "29.9K", "1,234", "12 likes").
+The same seed always gives the same export.
+"""
+
+import random
+from typing import List
+
+OPENERS = ["Honestly", "I mean", "Not gonna lie", "Look", "Ugh", "Okay but", "The thing is", "Imagine thinking"]
+COMPLAINT_PHRASES = [
+    "AI art is just theft from real artists",
+    "these data centers are draining the water supply",
+    "AI is taking jobs from people who need them",
+    "they trained it on our work without asking",
+    "my feed is nothing but AI slop now",
+    "electricity bills went up because of data centers",
+    "the output looks cheap and soulless",
+    "it makes misinformation so much easier to spread",
+    "creative work is being devalued",
+    "nobody is talking about the environmental cost",
+    "they keep forcing AI into every app",
+    "it confidently makes things up",
+]
+FILLER = ["and that's the problem", "for real", "which is wild", "and nobody cares", "lol", "period",
+          "every single time", "and it's getting worse", "like come on", "and we all know it"]
+
+
+class CommentMaker:
+    def __init__(self, seed: int = 1, repost_rate: float = 0.05, long_rate: float = 0.002):
+        self.rng = random.Random(seed)
+        self.repost_rate = repost_rate
+        self.long_rate = long_rate
+        self.recent: List[List[str]] = []
+
+    def sentence(self) -> str:
+        rng = self.rng
+        parts = [rng.choice(COMPLAINT_PHRASES)]
+        if rng.random() < 0.4:
+            parts.insert(0, rng.choice(OPENERS) + ",")
+        if rng.random() < 0.5:
+            parts.append(rng.choice(FILLER))
+        return " ".join(parts).capitalize() + rng.choice([".", "!", "?", ""])
+
+    def lines(self) -> List[str]:
+        """The content lines of one comment: a repost, a long comment or a few sentences."""
+        rng = self.rng
+        if self.recent and rng.random() < self.repost_rate:
+            return rng.choice(self.recent)
+        if rng.random() < self.long_rate:
+            count = rng.randint(200, 600)
+            lines = [" ".join(self.sentence() for _ in range(rng.randint(3, 8))) for _ in range(count // 5)]
+        else:
+            lines = [self.sentence() for _ in range(rng.randint(1, 3))]
+        self.recent.append(lines)
+        if len(self.recent) > 1000:
+            self.recent.pop(0)
+        return lines
+
+    def username(self, users: int) -> str:
+        return f"user{self.rng.randint(0, users)}"
+
+    def age(self, units: str = "hdm") -> str:
+        return f"{self.rng.randint(1, 30)}{self.rng.choice(units)}"
+
+
+def write_tiktok_export(path: str, comments: int, seed: int = 1, repost_rate: float = 0.05,
+                        long_rate: float = 0.002) -> None:
+    maker = CommentMaker(seed, repost_rate, long_rate)
+    rng = maker.rng
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("# Comments\n\nExported comments\n")
+        for _ in range(comments):
+            username = maker.username(max(1, comments // 3))
+            f.write(f"[{username}](https://www.tiktok.com/@{username})\n\n")
+            f.write("\n".join(maker.lines()) + "\n\n")
+            f.write(f"{maker.age()} agoReply\n")
+            likes = rng.random()
+            if likes < 0.6:
+                f.write(f"{rng.randint(0, 999)}\n")
+            elif likes < 0.8:
+                f.write(f"{rng.randint(1, 99)}.{rng.randint(0, 9)}K\n")
+            elif likes < 0.9:
+                f.write(f"{rng.randint(1, 9)},{rng.randint(100, 999)}\n")
+            f.write("\n")
+
+
+def write_instagram_export(path: str, comments: int, seed: int = 2, repost_rate: float = 0.05,
+                           long_rate: float = 0.002, reply_rate: float = 0.3, thread_rate: float = 0.1) -> None:
+    maker = CommentMaker(seed, repost_rate, long_rate)
+    rng = maker.rng
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("Comments\n")
+        username = None
+        for i in range(comments):
+            # people often post several comments in a row, which the parser groups into a thread
+            if username is None or rng.random() > thread_rate:
+                username = maker.username(max(1, comments // 3))
+            reply = i > 0 and rng.random() < reply_rate
+            f.write(("- " if reply else "") + f"[![{username}'s profile picture](https://cdn.example/{username}.jpg)]"
+                    f"(https://www.instagram.com/{username}/)\n")
+            f.write(f"[{username}](https://www.instagram.com/{username}/)\n")
+            lines = maker.lines()
+            if rng.random() < 0.1:
+                lines = lines[:-1] + [lines[-1] + " [@someone](https://www.instagram.com/someone/)"]
+            f.write("\n".join(lines) + "\n")
+            likes = f"{rng.randint(1, 5000)} likes " if rng.random() < 0.6 else ""
+            f.write(f"{maker.age('hdmw')} {likes}Reply\n")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write synthetic TikTok and Instagram exports for benchmarks")
+    parser.add_argument("--comments", type=int, default=10000, help="comments per export")
+    parser.add_argument("--tiktok", default="synthetic_tiktok.md", help="TikTok export path")
+    parser.add_argument("--instagram", default="synthetic_instagram.md", help="Instagram export path")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repost-rate", type=float, default=0.05, help="fraction of comments that repeat an earlier one")
+    parser.add_argument("--long-rate", type=float, default=0.002, help="fraction of comments long enough to be chunked")
+    args = parser.parse_args()
+
+    write_tiktok_export(args.tiktok, args.comments, args.seed, args.repost_rate, args.long_rate)
+    write_instagram_export(args.instagram, args.comments, args.seed + 1, args.repost_rate, args.long_rate)
+    print(f"Wrote {args.comments} comments each to {args.tiktok} and {args.instagram}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Vote Journal
+An append-only JSONL log of the votes recorded for each comment. Appending one
+line per comment replaces rewriting the full tally and comments_to_complaints
+files after every vote; the journal is fsynced in batches and periodically
+compacted back into the snapshot files. On startup the journal is replayed on
+top of the last snapshot, so a crash loses at most the last unsynced batch.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+def comment_id(comment: str) -> str:
+    """Stable id for a comment's text."""
+    return hashlib.sha1(comment.encode("utf-8")).hexdigest()
+
+
+def write_json_atomic(path: str, data, indent: Optional[int] = None) -> None:
+    """Write JSON to a temp file, fsync it, and rename it over path."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class VoteJournal:
+    def __init__(self, path: str = "vote_journal.jsonl", fsync_every: int = 50):
+        self.path = Path(path)
+        self.fsync_every = fsync_every
+        self.unsynced = 0
+        self.events_since_compaction = 0
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        return self._file
+
+    def append(self, comment: str, votes: List[Tuple[str, int]]) -> None:
+        """Log the (complaint, votes) pairs recorded for a comment."""
+        event = {"comment_id": comment_id(comment), "comment": comment, "votes": [list(v) for v in votes]}
+        self._open().write(json.dumps(event) + "\n")
+        self.unsynced += 1
+        self.events_since_compaction += 1
+        if self.unsynced >= self.fsync_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """Flush buffered events and fsync them to disk."""
+        if self._file is not None and self.unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self.unsynced = 0
+
+    def replay(self) -> Iterator[Dict]:
+        """Yield the logged events in order, skipping a torn final line from a crash."""
+        if not self.path.exists():
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Skipping unreadable line {line_number} of {self.path}")
+
+    def truncate(self) -> None:
+        """Empty the journal once its events are safely in a snapshot."""
+        self.close()
+        with open(self.path, "w"):
+            pass
+        self.events_since_compaction = 0
+
+    def close(self) -> None:
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Vote Report
+Complaint rankings per platform and per export (video), like-weighted or by the
+number of comments, with confidence intervals for the top complaints. Votes are
+loaded once into NumPy columns (a row per comment with its platform and export,
+a row per vote with its comment, complaint and votes), from the JSON files, the
+results store, the work queue or the like voter's checkpoint, and every report
+is a vectorized group-by over those columns. A comment's platform and export
+come from the record shards it was parsed into. The columns can be saved as an
+.npz file so later reports skip loading the sources again.
+"""
+
+import csv
+import glob
+import hashlib
+import json
+import sqlite3
+from array import array
+from pathlib import Path
+from statistics import NormalDist
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from comment_digest import comment_digest
+from comment_records import FIELDS, record_text
+from like_counts import like_votes
+
+UNKNOWN = "unknown"
+GROUPINGS = ("all", "platform", "export")
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def shard_rows(shard: Path) -> List[List]:
+    """A record shard's rows, decoded in one go; line by line only if it has a torn final line."""
+    with open(shard, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    try:
+        return json.loads(f"[{','.join(lines)}]")
+    except json.JSONDecodeError:
+        rows = []
+        for line in lines:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # torn final line from an interrupted parse
+        return rows
+
+
+class RecordSources:
+    """The (platform, export) of every parsed record, from the shard it was written to.
+
+    A shard is named <export name>-NNNNN.jsonl, so single-export parser runs
+    give the export; parse_comments.py and incremental_ingest.py runs are named
+    after the run. Comments are looked up by their exact text as the LLM
+    scripts saw it, which is cheap, and otherwise by content digest. The first
+    shard to hold a comment wins, as in the LLM scripts.
+    """
+
+    def __init__(self, directory: str, prefix: str = ""):
+        self.by_text = {}
+        self.by_digest = {}
+        for shard in sorted(Path(directory).glob(f"*/{glob.escape(prefix)}*.jsonl")):
+            export = shard.stem.rsplit("-", 1)[0]
+            for values in shard_rows(shard):
+                record = dict(zip(FIELDS, values))
+                source = (record["platform"], export)
+                self.by_text.setdefault(text_key(record_text(record)), source)
+                self.by_digest.setdefault(record["digest"], source)
+
+    def get(self, text: str) -> Optional[Tuple[str, str]]:
+        source = self.by_text.get(text_key(text))
+        if source is None:
+            source = self.by_digest.get(comment_digest(text))
+        return source
+
+
+class Labels:
+    """Interns strings as consecutive integer codes."""
+
+    def __init__(self, names: Iterable[str] = ()):
+        self.codes = {}
+        self.names = []
+        for name in names:
+            self.code(name)
+
+    def code(self, name: str) -> int:
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+
+class VoteEvents:
+    """Votes as columns.
+
+    comment_platform and comment_export hold codes into platforms and exports
+    for every comment, including comments without complaints. event_comment,
+    event_complaint and event_votes hold one row per vote; event_comment is -1
+    for votes that belong to no comment (imported totals and like count
+    corrections in a results store), which count towards the overall ranking
+    only.
+    """
+
+    def __init__(self, complaints: List[str], platforms: List[str], exports: List[str],
+                 comment_platform: np.ndarray, comment_export: np.ndarray,
+                 event_comment: np.ndarray, event_complaint: np.ndarray, event_votes: np.ndarray):
+        self.complaints = complaints
+        self.platforms = platforms
+        self.exports = exports
+        self.comment_platform = comment_platform
+        self.comment_export = comment_export
+        self.event_comment = event_comment
+        self.event_complaint = event_complaint
+        self.event_votes = event_votes
+
+    def __len__(self) -> int:
+        return len(self.event_complaint)
+
+    @property
+    def comments(self) -> int:
+        return len(self.comment_platform)
+
+    def save(self, path: str) -> None:
+        np.savez(path, complaints=np.array(self.complaints, dtype=str), platforms=np.array(self.platforms, dtype=str),
+                 exports=np.array(self.exports, dtype=str), comment_platform=self.comment_platform,
+                 comment_export=self.comment_export, event_comment=self.event_comment,
+                 event_complaint=self.event_complaint, event_votes=self.event_votes)
+
+    @classmethod
+    def load(cls, path: str) -> "VoteEvents":
+        with np.load(path) as data:
+            return cls(data["complaints"].tolist(), data["platforms"].tolist(), data["exports"].tolist(),
+                       data["comment_platform"], data["comment_export"], data["event_comment"],
+                       data["event_complaint"], data["event_votes"])
+
+    def only_platform(self, platform: str) -> "VoteEvents":
+        """The votes of one platform's comments; votes without a comment are dropped."""
+        code = self.platforms.index(platform) if platform in self.platforms else -1
+        keep_comments = self.comment_platform == code
+        # new index of every kept comment, -1 for the others
+        renumbered = np.cumsum(keep_comments) - 1
+        keep_events = self.event_comment >= 0
+        keep_events[keep_events] = keep_comments[self.event_comment[keep_events]]
+        return VoteEvents(self.complaints, self.platforms, self.exports,
+                          self.comment_platform[keep_comments], self.comment_export[keep_comments],
+                          renumbered[self.event_comment[keep_events]], self.event_complaint[keep_events],
+                          self.event_votes[keep_events])
+
+
+class EventsBuilder:
+    """Collects comments and votes from any of the sources and packs them into VoteEvents."""
+
+    def __init__(self, sources: Optional[RecordSources] = None, platform: str = UNKNOWN):
+        self.sources = sources
+        self.platform = platform
+        self.complaints = Labels()
+        self.platforms = Labels()
+        self.exports = Labels()
+        self.comment_platform = array("i")
+        self.comment_export = array("i")
+        self.event_comment = array("q")
+        self.event_complaint = array("i")
+        self.event_votes = array("q")
+
+    def add_comment(self, text: str, platform: Optional[str] = None) -> int:
+        """Add a comment and return its index; its platform and export come from the records when known."""
+        export = UNKNOWN
+        source = self.sources.get(text) if self.sources is not None else None
+        if source is not None:
+            platform, export = source
+        self.comment_platform.append(self.platforms.code(platform or self.platform))
+        self.comment_export.append(self.exports.code(export))
+        return len(self.comment_platform) - 1
+
+    def add_votes(self, comment: int, votes: Iterable[Tuple[str, int]]) -> None:
+        codes = self.complaints.codes
+        for complaint, count in votes:
+            code = codes.get(complaint)
+            self.event_comment.append(comment)
+            self.event_complaint.append(self.complaints.code(complaint) if code is None else code)
+            self.event_votes.append(count)
+
+    def add_mapping(self, comments_to_complaints: Dict[str, List[str]], weight=like_votes,
+                    platform: Optional[str] = None) -> None:
+        """Add a comments_to_complaints mapping, each complaint getting weight(comment) votes."""
+        for text, complaints in comments_to_complaints.items():
+            votes = weight(text)
+            self.add_votes(self.add_comment(text, platform), ((complaint, votes) for complaint in complaints))
+
+    def add_store(self, path: str, tally: str) -> None:
+        """Add a tally from a results store, with the votes as the store recorded them."""
+        conn = sqlite3.connect(path)
+        try:
+            complaint_codes = {complaint_id: self.complaints.code(text)
+                               for complaint_id, text in conn.execute("SELECT id, text FROM complaints ORDER BY id")}
+            comment_indexes = {}
+            columns = "comments.id, comments.platform" + (", comments.text" if self.sources is not None else "")
+            for row in conn.execute(f"SELECT {columns} FROM processed JOIN comments ON comments.id = processed.comment_id "
+                                    "WHERE processed.tally = ? ORDER BY comments.id", (tally,)):
+                comment_indexes[row[0]] = self.add_comment(row[2] if len(row) > 2 else "", row[1])
+            for comment_id, complaint_id, votes in conn.execute(
+                    "SELECT comment_id, complaint_id, votes FROM votes WHERE tally = ? ORDER BY rowid", (tally,)):
+                comment = -1 if comment_id is None else comment_indexes.get(comment_id, -1)
+                self.event_comment.append(comment)
+                self.event_complaint.append(complaint_codes[complaint_id])
+                self.event_votes.append(votes)
+        finally:
+            conn.close()
+
+    def add_queue(self, path: str) -> None:
+        """Add the comments a work queue has finished, weighted by their likes as the voters weighted them."""
+        conn = sqlite3.connect(path)
+        try:
+            for text, platform, complaints in conn.execute(
+                    "SELECT text, platform, complaints FROM items WHERE state = 'done' ORDER BY seq"):
+                votes = like_votes(text)
+                self.add_votes(self.add_comment(text, platform),
+                               ((complaint, votes) for complaint in json.loads(complaints or "[]")))
+        finally:
+            conn.close()
+
+    def add_checkpoint(self, checkpoint_path: str = "vote_checkpoint.json",
+                       journal_path: str = "vote_journal.jsonl") -> None:
+        """Add the like voter's checkpoint plus the votes journaled since, as a resumed run would see them."""
+        from vote_journal import VoteJournal
+
+        with open(checkpoint_path, "r") as f:
+            comments_to_complaints = json.load(f)["comments_to_complaints"]
+        for event in VoteJournal(journal_path).replay():
+            comments_to_complaints[event["comment"]] = [complaint for complaint, _ in event["votes"]]
+        self.add_mapping(comments_to_complaints)
+
+    def build(self) -> VoteEvents:
+        return VoteEvents(
+            self.complaints.names, self.platforms.names, self.exports.names,
+            np.frombuffer(self.comment_platform, dtype=np.int32), np.frombuffer(self.comment_export, dtype=np.int32),
+            np.frombuffer(self.event_comment, dtype=np.int64), np.frombuffer(self.event_complaint, dtype=np.int32),
+            np.frombuffer(self.event_votes, dtype=np.int64),
+        )
+
+
+def rank(events: VoteEvents, by: str = "all", weighted: bool = True, top: int = 20,
+         confidence: float = 0.95) -> Dict[str, Dict]:
+    """Rank the complaints in every group, highest first, keeping the top of each (all of them if top is 0).
+
+    Returns group name -> {"comments": comments in the group, "complaints":
+    rows}. A row has the complaint's like-weighted votes and the number of
+    comments making it, each with a confidence interval that treats the group's
+    comments as a sample: a normal interval for the votes (a sum over
+    comments) and a Wilson interval for the comments. Ties keep the order the
+    complaints were first seen in.
+    """
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    if by == "platform":
+        group_names, comment_group = events.platforms, events.comment_platform.astype(np.int64)
+    elif by == "export":
+        group_names, comment_group = events.exports, events.comment_export.astype(np.int64)
+    else:
+        group_names, comment_group = ["all"], np.zeros(events.comments, dtype=np.int64)
+    group_comments = np.bincount(comment_group, minlength=len(group_names))
+
+    size = max(len(events.complaints), 1)
+    attributed = events.event_comment >= 0
+    # a comment can name a complaint more than once (the reader lists each chunk's complaints),
+    # so add its votes up into one row per comment and complaint before counting comments
+    pairs, pair_positions = np.unique(events.event_comment[attributed] * size + events.event_complaint[attributed],
+                                      return_inverse=True)
+    pair_votes = np.bincount(pair_positions, weights=events.event_votes[attributed], minlength=len(pairs))
+    pair_comments, pair_complaints = np.divmod(pairs, size)
+    # votes without a comment have no platform or export, so only the overall ranking has them
+    loose = ~attributed if by == "all" else np.zeros(len(events), dtype=bool)
+    row_groups = np.concatenate([comment_group[pair_comments], np.zeros(np.count_nonzero(loose), dtype=np.int64)])
+    row_complaints = np.concatenate([pair_complaints, events.event_complaint[loose]])
+    votes = np.concatenate([pair_votes, events.event_votes[loose].astype(np.float64)])
+    in_comment = np.concatenate([np.ones(len(pairs)), np.zeros(np.count_nonzero(loose))])
+    keys, positions = np.unique(row_groups * size + row_complaints, return_inverse=True)
+    totals = np.bincount(positions, weights=votes, minlength=len(keys))
+    counts = np.bincount(positions, weights=in_comment, minlength=len(keys))
+    squares = np.bincount(positions, weights=in_comment * votes * votes, minlength=len(keys))
+    sampled = np.bincount(positions, weights=in_comment * votes, minlength=len(keys))
+
+    groups, complaints = np.divmod(keys, size)
+    n = np.maximum(group_comments[groups], 1).astype(np.float64)
+    # variance of a sum over n sampled comments: n times the variance of a comment's votes
+    spread = z * np.sqrt(np.maximum(squares - sampled * sampled / n, 0.0))
+    share = np.minimum(counts / n, 1.0)
+    centre = (share + z * z / (2 * n)) / (1 + z * z / n)
+    margin = z * np.sqrt(share * (1 - share) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+
+    order = np.lexsort((complaints, -(totals if weighted else counts), groups))
+    starts = np.searchsorted(groups[order], np.arange(len(group_names)))
+    ranks = np.arange(len(order)) - starts[groups[order]]
+    if top:
+        order = order[ranks < top]
+        ranks = ranks[ranks < top]
+
+    report = {name: {"comments": int(group_comments[i]), "complaints": []} for i, name in enumerate(group_names)}
+    columns = zip(groups[order].tolist(), ranks.tolist(), complaints[order].tolist(), totals[order].tolist(),
+                  np.maximum(totals - spread, 0)[order].tolist(), (totals + spread)[order].tolist(),
+                  counts[order].tolist(), (n * (centre - margin))[order].tolist(),
+                  (n * (centre + margin))[order].tolist(), share[order].tolist())
+    for group, position, complaint, total, low, high, count, count_low, count_high, group_share in columns:
+        report[group_names[group]]["complaints"].append({
+            "rank": position + 1,
+            "complaint": events.complaints[complaint],
+            "votes": int(total),
+            "votes_low": round(low, 1),
+            "votes_high": round(high, 1),
+            "comments": int(count),
+            "comments_low": round(max(count_low, 0.0), 1),
+            "comments_high": round(count_high, 1),
+            "share": round(group_share, 6),
+        })
+    return report
+
+
+ROW_FIELDS = ("rank", "complaint", "votes", "votes_low", "votes_high", "comments", "comments_low", "comments_high", "share")
+
+
+def write_csv(report: Dict[str, Dict], path: str, by: str = "all") -> None:
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow((by, "group_comments") + ROW_FIELDS)
+        for group, ranking in report.items():
+            for row in ranking["complaints"]:
+                writer.writerow([group, ranking["comments"]] + [row[field] for field in ROW_FIELDS])
+
+
+def write_json(report: Dict[str, Dict], path: str, by: str = "all", weighted: bool = True,
+               confidence: float = 0.95) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"by": by, "ranked_by": "votes" if weighted else "comments", "confidence": confidence,
+                   "groups": report}, f, indent=2, ensure_ascii=False)
+
+
+def format_report(report: Dict[str, Dict], weighted: bool = True) -> str:
+    lines = []
+    for group, ranking in report.items():
+        if not ranking["complaints"]:
+            continue
+        lines.append(f"{group}: {ranking['comments']} comments")
+        for row in ranking["complaints"]:
+            if weighted:
+                interval = f"{row['votes']:>9} [{row['votes_low']:.0f}-{row['votes_high']:.0f}]"
+            else:
+                interval = f"{row['comments']:>9} [{row['comments_low']:.0f}-{row['comments_high']:.0f}]"
+            lines.append(f"{row['rank']:>4}. {interval:<28} {row['complaint']}")
+    return "\n".join(lines)
+
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Rank complaints per platform or export, with confidence intervals")
+    parser.add_argument("mappings", nargs="*",
+                        help="comments_to_complaints files (default comments_to_complaints.json if no other source is given)")
+    parser.add_argument("--db", help="read a tally from this results database instead")
+    parser.add_argument("--tally", default="like_weighted", choices=["complaints", "like_weighted"],
+                        help="the results database tally to read")
+    parser.add_argument("--queue", help="read the finished comments of this work queue instead")
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="read the like voter's vote_checkpoint.json and vote_journal.jsonl instead")
+    parser.add_argument("--events", help="read votes saved with --save-events instead")
+    parser.add_argument("--records", help="records directory to look up each comment's platform and export in")
+    parser.add_argument("--records-prefix", default="", help="only read record shards whose names start with this")
+    parser.add_argument("--default-platform", default=UNKNOWN,
+                        help="platform for comments in a mapping file that aren't in the records")
+    parser.add_argument("--by", default="platform", choices=GROUPINGS, help="rank within each platform or export")
+    parser.add_argument("--platform", help="only count this platform's comments")
+    parser.add_argument("--raw", action="store_true", help="rank by the number of comments instead of like-weighted votes")
+    parser.add_argument("--top", type=int, default=20, help="complaints per group (0 for all)")
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--csv", help="write the ranking to this CSV file")
+    parser.add_argument("--json", help="write the ranking to this JSON file")
+    parser.add_argument("--save-events", help="save the loaded votes to this .npz file for later reports")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.events:
+        events = VoteEvents.load(args.events)
+    else:
+        sources = RecordSources(args.records, args.records_prefix) if args.records else None
+        builder = EventsBuilder(sources, args.default_platform)
+        if args.db:
+            builder.add_store(args.db, args.tally)
+        elif args.queue:
+            builder.add_queue(args.queue)
+        elif args.checkpoint:
+            builder.add_checkpoint()
+        else:
+            for path in args.mappings or ["comments_to_complaints.json"]:
+                with open(path, "r") as f:
+                    builder.add_mapping(json.load(f))
+        events = builder.build()
+    loaded = time.perf_counter()
+    if args.save_events:
+        events.save(args.save_events)
+    if args.platform:
+        events = events.only_platform(args.platform)
+
+    weighted = not args.raw
+    report = rank(events, args.by, weighted, args.top, args.confidence)
+    ranked = time.perf_counter()
+    if args.csv:
+        write_csv(report, args.csv, args.by)
+    if args.json:
+        write_json(report, args.json, args.by, weighted, args.confidence)
+    if not args.csv and not args.json:
+        print(format_report(report, weighted))
+    print(f"{len(events)} votes on {events.comments} comments loaded in {loaded - started:.2f}s, "
+          f"ranked in {ranked - loaded:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
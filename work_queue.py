@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Work Queue
+A durable SQLite queue of the comments the like voter has to vote on, so a run
+can stop at any point and pick up where it was, and several voter processes,
+on one host or on several sharing a filesystem, can work through the same
+comments at once. A comment goes from pending to leased by one worker until
+its lease runs out, and then to done. After a failure it goes back to pending
+with an exponential backoff before it is tried again. A comment that fails
+max_attempts times is quarantined as failed instead of being retried forever.
+
+The tally lives in the same database. A comment's votes are added in the
+transaction that marks it done, and that transaction only goes through while
+the worker still holds the comment's lease, so a comment that was handed to
+another worker after its lease ran out is never counted twice.
+
+The database keeps SQLite's rollback journal rather than WAL, because WAL needs
+memory shared between processes and so doesn't work across hosts. The shared
+filesystem has to support POSIX locks, as local disks and NFSv4 do.
+"""
+
+import json
+import os
+import random
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from comment_digest import comment_digest, comment_ref
+from like_counts import likes_to_votes
+from vote_journal import comment_id
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+# meta key prefix marking an incremental_ingest.py like update run as applied to the tally
+LIKE_UPDATES_KEY = "like_updates:"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    comment_id TEXT NOT NULL UNIQUE,
+    platform TEXT NOT NULL,
+    text TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_token TEXT,
+    lease_expires REAL,
+    last_error TEXT,
+    complaints TEXT,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS items_state ON items (state, available_at);
+CREATE INDEX IF NOT EXISTS items_digest ON items (digest, state);
+
+-- ids only ever grow, so every worker lists the complaints in the same order
+CREATE TABLE IF NOT EXISTS complaints (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL UNIQUE,
+    votes INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class WorkItem:
+    def __init__(self, seq: int, platform: str, text: str, digest: str, attempts: int, token: str):
+        self.seq = seq
+        self.platform = platform
+        self.text = text
+        self.digest = digest
+        self.attempts = attempts
+        self.token = token
+
+
+class WorkQueue:
+    def __init__(self, path: str = "work_queue.db", lease_seconds: float = 900.0, max_attempts: int = 5,
+                 backoff_seconds: float = 30.0, max_backoff_seconds: float = 3600.0, owner: Optional[str] = None):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        # autocommit, with explicit BEGIN IMMEDIATE transactions below
+        self.conn = sqlite3.connect(path, timeout=60.0, isolation_level=None)
+        self.conn.execute("PRAGMA synchronous=FULL")
+        with self.transaction():
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    self.conn.execute(statement)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """A write transaction; BEGIN IMMEDIATE takes the lock up front so two workers can't both read then write."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    @property
+    def seeded(self) -> bool:
+        return self.conn.execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone() is not None
+
+    def seed(self, tally: Dict[str, int], comments_to_complaints: Dict[str, List[str]],
+             applied_like_updates: Iterable[str] = ()) -> bool:
+        """Start the queue's tally from an existing one, with its comments already done. Only the first call does anything.
+
+        applied_like_updates are the like update runs already in that tally.
+        """
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone():
+                return False
+            conn.executemany("INSERT OR IGNORE INTO complaints (text, votes) VALUES (?, ?)", tally.items())
+            now = time.time()
+            conn.executemany(
+                "INSERT OR IGNORE INTO items (comment_id, platform, text, digest, state, complaints, updated_at) "
+                "VALUES (?, '', ?, ?, 'done', ?, ?)",
+                ((comment_id(text), text, comment_digest(text), json.dumps(complaints), now)
+                 for text, complaints in comments_to_complaints.items()))
+            conn.executemany("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)",
+                             ((LIKE_UPDATES_KEY + run, str(now)) for run in applied_like_updates))
+            conn.execute("INSERT INTO meta (key, value) VALUES ('seeded', ?)", (str(now),))
+        return True
+
+    def enqueue(self, items: Iterable[Tuple[str, str, str]], chunk_size: int = 5000) -> int:
+        """Add (platform, text, digest) items that aren't queued yet. Returns how many were added."""
+        added = 0
+        rows = []
+        for platform, text, digest in items:
+            rows.append((comment_id(text), platform, text, digest))
+            if len(rows) >= chunk_size:
+                added += self._insert(rows)
+                rows = []
+        if rows:
+            added += self._insert(rows)
+        return added
+
+    def _insert(self, rows: List[Tuple[str, str, str, str]]) -> int:
+        with self.transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO items (comment_id, platform, text, digest) VALUES (?, ?, ?, ?)", rows)
+            return conn.total_changes - before
+
+    def lease(self, limit: int) -> List[WorkItem]:
+        """Lease up to limit items that are due, oldest first, including ones whose lease ran out."""
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self.transaction() as conn:
+            # a comment whose leases keep running out probably takes its worker down with it
+            conn.execute("UPDATE items SET state = 'failed', last_error = 'lease ran out ' || attempts || ' times', "
+                         "lease_owner = NULL, lease_token = NULL, updated_at = ? "
+                         "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                         (now, now, self.max_attempts))
+            rows = conn.execute(
+                "SELECT seq, platform, text, digest, attempts FROM items "
+                "WHERE (state = 'pending' AND available_at <= ?) OR (state = 'leased' AND lease_expires < ?) "
+                "ORDER BY seq LIMIT ?", (now, now, limit)).fetchall()
+            conn.executemany(
+                "UPDATE items SET state = 'leased', lease_owner = ?, lease_token = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE seq = ?",
+                ((self.owner, token, now + self.lease_seconds, now, row[0]) for row in rows))
+        return [WorkItem(seq, platform, text, digest, attempts + 1, token)
+                for seq, platform, text, digest, attempts in rows]
+
+    def complete(self, item: WorkItem, votes: List[Tuple[str, int]]) -> bool:
+        """Mark an item done and add its votes to the tally, in one transaction.
+
+        Returns False, changing nothing, if the item's lease ran out and it
+        was leased again (or finished) by another worker in the meantime.
+        """
+        with self.transaction() as conn:
+            updated = conn.execute(
+                "UPDATE items SET state = 'done', complaints = ?, lease_owner = NULL, lease_token = NULL, "
+                "lease_expires = NULL, last_error = NULL, updated_at = ? "
+                "WHERE seq = ? AND state = 'leased' AND lease_token = ?",
+                (json.dumps([complaint for complaint, _ in votes]), time.time(), item.seq, item.token)).rowcount
+            if updated != 1:
+                return False
+            conn.executemany("INSERT INTO complaints (text, votes) VALUES (?, ?) "
+                             "ON CONFLICT (text) DO UPDATE SET votes = votes + excluded.votes", votes)
+        return True
+
+    def apply_like_updates(self, run: str, updates: Iterable[Dict],
+                           resolve: Callable[[str], str] = lambda complaint: complaint) -> Optional[List[List[Tuple[str, int]]]]:
+        """Add the vote changes of an incremental_ingest.py like update run to the tally.
+
+        Each done comment with an update's digest changes its complaints' votes
+        by the difference between its new and old like votes; comments not done
+        yet are counted with their current likes when they are. The run is
+        marked applied in the same transaction, so it's applied at most once.
+        Returns the votes added for each updated comment, or None if the run
+        was already applied.
+        """
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = ?", (LIKE_UPDATES_KEY + run,)).fetchone():
+                return None
+            applied = []
+            for update in updates:
+                row = conn.execute("SELECT complaints FROM items WHERE digest = ? AND state = 'done' LIMIT 1",
+                                   (update["digest"],)).fetchone()
+                delta = likes_to_votes(update["new_likes"]) - likes_to_votes(update["old_likes"])
+                if row is None or not delta:
+                    continue
+                votes = [(complaint, delta) for complaint in dict.fromkeys(map(resolve, json.loads(row[0])))]
+                if not votes:
+                    continue
+                conn.executemany("INSERT INTO complaints (text, votes) VALUES (?, ?) "
+                                 "ON CONFLICT (text) DO UPDATE SET votes = votes + excluded.votes", votes)
+                applied.append(votes)
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (LIKE_UPDATES_KEY + run, str(time.time())))
+        return applied
+
+    def backoff(self, attempts: int) -> float:
+        """Seconds to wait before the next attempt: doubling from backoff_seconds, capped, with jitter."""
+        delay = min(self.backoff_seconds * 2 ** (attempts - 1), self.max_backoff_seconds)
+        return delay * random.uniform(0.5, 1.0)
+
+    def fail(self, item: WorkItem, error: str) -> str:
+        """Put a failed item back to be retried after a backoff, or quarantine it. Returns its new state."""
+        now = time.time()
+        state = FAILED if item.attempts >= self.max_attempts else PENDING
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE items SET state = ?, available_at = ?, last_error = ?, lease_owner = NULL, "
+                "lease_token = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE seq = ? AND state = 'leased' AND lease_token = ?",
+                (state, now + self.backoff(item.attempts), error[:2000], now, item.seq, item.token))
+        return state
+
+    def release(self, items: Iterable[WorkItem]) -> None:
+        """Hand back items this worker won't finish, e.g. when it's stopped, without counting an attempt."""
+        with self.transaction() as conn:
+            conn.executemany(
+                "UPDATE items SET state = 'pending', attempts = attempts - 1, lease_owner = NULL, lease_token = NULL, "
+                "lease_expires = NULL, updated_at = ? WHERE seq = ? AND state = 'leased' AND lease_token = ?",
+                ((time.time(), item.seq, item.token) for item in items))
+
+    def retry_failed(self) -> int:
+        """Give every quarantined item a fresh set of attempts. Returns how many there were."""
+        with self.transaction() as conn:
+            return conn.execute("UPDATE items SET state = 'pending', attempts = 0, available_at = 0, updated_at = ? "
+                                "WHERE state = 'failed'", (time.time(),)).rowcount
+
+    def done_complaints(self, digest: str) -> Optional[List[str]]:
+        """Complaints of a done item with this digest, so reposts are counted without the model."""
+        row = self.conn.execute("SELECT complaints FROM items WHERE digest = ? AND state = 'done' LIMIT 1",
+                                (digest,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def next_due(self) -> Optional[float]:
+        """When the next pending item is due or the next lease runs out, or None if there's nothing left to do."""
+        row = self.conn.execute(
+            "SELECT MIN(CASE state WHEN 'pending' THEN available_at ELSE lease_expires END) FROM items "
+            "WHERE state IN ('pending', 'leased')").fetchone()
+        return row[0]
+
+    def complaints_since(self, after_id: int) -> List[Tuple[int, str]]:
+        return self.conn.execute("SELECT id, text FROM complaints WHERE id > ? ORDER BY id", (after_id,)).fetchall()
+
+    def counts(self) -> Dict[str, int]:
+        counts = dict.fromkeys([PENDING, LEASED, DONE, FAILED], 0)
+        counts.update(self.conn.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+        return counts
+
+    def quarantined(self, limit: int = 20) -> List[Tuple[str, int, str]]:
+        """(text, attempts, last error) of quarantined items."""
+        return self.conn.execute("SELECT text, attempts, last_error FROM items WHERE state = 'failed' "
+                                 "ORDER BY updated_at DESC LIMIT ?", (limit,)).fetchall()
+
+    def tally(self) -> Dict[str, int]:
+        return dict(self.conn.execute("SELECT text, votes FROM complaints ORDER BY id").fetchall())
+
+    def comments_to_complaints(self) -> Dict[str, List[str]]:
+        return {text: json.loads(complaints) for text, complaints in
+                self.conn.execute("SELECT text, complaints FROM items WHERE state = 'done' ORDER BY seq")}
+
+    def summary(self) -> str:
+        counts = self.counts()
+        return ", ".join(f"{count} {state}" for state, count in counts.items())
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show or manage the like voter's work queue")
+    parser.add_argument("path", nargs="?", default="work_queue.db")
+    parser.add_argument("--retry-failed", action="store_true", help="give quarantined comments another set of attempts")
+    parser.add_argument("--show", type=int, default=10, help="quarantined comments to list")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.path)
+    if args.retry_failed:
+        print(f"Requeued {queue.retry_failed()} quarantined comments")
+    print(queue.summary())
+    for text, attempts, error in queue.quarantined(args.show):
+        print(f"  quarantined after {attempts} attempts: {comment_ref(text)}: {error}")
+    queue.close()
+
+
+if __name__ == "__main__":
+    main()